@@ -8,6 +8,11 @@ class AGE2(object):
     def __init__(self, args):
         self.batch_size = args.batch_size
         self.device = args.device
+        # data parallel training: each rank takes every world_size-th batch
+        self.rank = getattr(args, 'rank', 0)
+        self.world_size = getattr(args, 'world_size', 1)
+        self.seed = getattr(args, 'seed', None) or 0
+        self.epoch = 0
         
         data_file = open(args.data_path, 'rb')
         self.train_set, self.dev_set, self.test_set = pickle.load(data_file, encoding='latin1')
@@ -25,6 +30,8 @@ class AGE2(object):
 
         ####### required items
         self.num_train_batches = math.ceil(self.train_size / self.batch_size)
+        if self.world_size > 1:
+            self.num_train_batches = (self.train_size // self.batch_size) // self.world_size
         self.num_valid = self.dev_size
         self.num_test = self.test_size
         self.weight = torch.FloatTensor(self.weight)
@@ -47,12 +54,28 @@ class AGE2(object):
                 }
 
 
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def shuffle(self, x):
+        if self.world_size > 1:
+            # all ranks must shuffle in the same way to get disjoint shards
+            random.Random(self.seed * 100003 + self.epoch).shuffle(x)
+        else:
+            random.shuffle(x)
+
     def train_minibatch_generator(self):
         self.train_ptr = 0
-        random.shuffle(self.train_set)
-        while self.train_ptr <= self.train_size - self.batch_size:
-            self.train_ptr += self.batch_size
-            minibatch = self.train_set[self.train_ptr - self.batch_size : self.train_ptr]
+        # shuffle a fresh order instead of self.train_set in place, so that the order of
+        # an epoch only depends on the rng state at its start (required by --resume)
+        order = list(range(self.train_size))
+        self.shuffle(order)
+        starts = list(range(0, self.train_size - self.batch_size + 1, self.batch_size))
+        if self.world_size > 1:
+            starts = starts[self.rank::self.world_size][:self.num_train_batches]
+        for start in starts:
+            self.train_ptr = start + self.batch_size
+            minibatch = [self.train_set[j] for j in order[self.train_ptr - self.batch_size : self.train_ptr]]
             longest_hypo = numpy.max(list(map(lambda x: len(x[0]), minibatch)), axis=0)
             hypos = numpy.zeros((self.batch_size, longest_hypo), dtype='int32')
             truth = numpy.zeros((self.batch_size,), dtype='int32')
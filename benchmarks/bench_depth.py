@@ -0,0 +1,99 @@
+"""
+Latency/accuracy frontier of the depth budget (--max-tree-depth) of a trained RL or STG
+model: the test set is evaluated once per budget, reporting accuracy and throughput.
+The budget adds no parameters, so a model trained with the full tree can be evaluated
+with any budget; to get the training side of the frontier, train with --max-tree-depth K
+(and measure the training cost with bench_encoders --max-tree-depths).
+
+    python -m benchmarks.bench_depth --ckpt model.pkl --data-path </path/to/data> --depths 0 2 4 6 8 --json depth.json
+"""
+import argparse
+import sys
+import time
+
+import torch
+
+from benchmarks.common import write_results
+from evaluate import eval_iter
+from prune_vocab import load_data, build_model
+from utils.artifact import load_file
+from utils.vocab import IdVocab, remap_words
+
+
+def run_test(model, data, vocab_remap, max_batches=None):
+    """
+    Returns:
+        accuracy, seconds, number of sentences, number of tokens
+    """
+    correct_num = num_sentences = num_tokens = 0
+    seconds = 0.
+    with torch.no_grad():
+        for step, (model_arg, label) in enumerate(data.test_minibatch_generator()):
+            if max_batches is not None and step >= max_batches:
+                break
+            if vocab_remap is not None:
+                model_arg = remap_words(model_arg, vocab_remap)
+            tic = time.perf_counter()
+            correct, _ = eval_iter((model_arg, label), model)
+            seconds += time.perf_counter() - tic
+            correct_num += correct
+            num_sentences += len(label)
+            num_tokens += sum(v.sum().item() for k, v in model_arg.items() if k.endswith('length'))
+    return correct_num / max(1, num_sentences), seconds, num_sentences, num_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt', required=True, help='checkpoint of an RL or STG model')
+    parser.add_argument('--data-path', required=True)
+    parser.add_argument('--depths', nargs='+', type=int, default=[0, 2, 4, 6, 8], help='depth budgets, 0 builds the full tree')
+    parser.add_argument('--max-batches', type=int, help='only evaluate the first batches of the test set')
+    parser.add_argument('--tree-threads', default=1, type=int)
+    parser.add_argument('--threads', type=int, help='torch intra-op threads')
+    parser.add_argument('--csv', help='write results as csv')
+    parser.add_argument('--json', help='write results as json')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    loaded = load_file(args.ckpt)
+    for k, v in loaded['model_kwargs'].items():
+        setattr(args, k, v)
+    if args.model_type not in {'RL', 'STG'}:
+        parser.error('the depth budget only applies to RL and STG models')
+    data = load_data(args)
+    vocab_remap = loaded.get('vocab_remap')
+    vocab = IdVocab(loaded['vocab']) if vocab_remap is not None else args.vocab
+    model = build_model(args, loaded['model'], vocab)
+    model.eval()
+
+    rows = []
+    full_accuracy = None
+    for depth in args.depths:
+        model.encoder.max_tree_depth = depth
+        accuracy, seconds, num_sentences, num_tokens = run_test(model, data, vocab_remap, args.max_batches)
+        if depth == 0:
+            full_accuracy = accuracy
+        row = {
+                'model_type': args.model_type,
+                'max_tree_depth': depth,
+                'accuracy': round(accuracy, 4),
+                'accuracy_change': None if full_accuracy is None else round(accuracy - full_accuracy, 4),
+                'sentences_per_sec': round(num_sentences / seconds, 2),
+                'tokens_per_sec': round(num_tokens / seconds, 2),
+                }
+        rows.append(row)
+        print('%-4s depth=%-3d accuracy %.4f (%s)  %10.1f sent/s %10.1f tok/s' % (
+            args.model_type, depth, row['accuracy'], row['accuracy_change'], row['sentences_per_sec'], row['tokens_per_sec']))
+        sys.stdout.flush()
+
+    meta = {
+            'torch': torch.__version__,
+            'threads': torch.get_num_threads(),
+            'args': { k: v for k, v in vars(args).items() if k in {'ckpt', 'data_path', 'depths', 'max_batches', 'tree_threads', 'threads'} },
+            }
+    write_results(rows, meta, args.csv, args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Microbenchmark of the sentence encoders on random token batches.
+
+    python -m benchmarks.bench_encoders --lengths 5 20 50 --batch-sizes 32 --json new.json
+    python -m benchmarks.bench_encoders --lengths 5 20 50 --batch-sizes 32 --baseline new.json
+    python -m benchmarks.bench_encoders --encoders RL STG --batch-sizes 32 64 128 256 --tree-threads 1 2 4 8
+    python -m benchmarks.bench_encoders --encoders RL STG --lengths 50 200 --max-tree-depths 0 2 4 8
+"""
+import argparse
+import itertools
+import statistics
+import sys
+import time
+
+import torch
+from torch import nn
+
+from benchmarks.common import SyntheticVocab, random_batch, PeakMemory, write_results, compare_with_baseline
+
+KEY_FIELDS = ['encoder', 'mode', 'length', 'batch_size', 'hidden_dim', 'tree_threads', 'max_tree_depth']
+
+
+def build_encoder(name, args, hidden_dim):
+    kwargs = {
+            'vocab': SyntheticVocab(args.num_words),
+            'leaf_rnn_type': args.leaf_rnn_type,
+            'rank_input': args.rank_input,
+            'word_dim': args.word_dim,
+            'hidden_dim': hidden_dim,
+            'sample_num': args.sample_num,
+            }
+    if name == 'RL':
+        from model.RL_AR_Tree import RL_AR_Tree
+        return RL_AR_Tree(**kwargs)
+    elif name == 'STG':
+        from model.STGumbel_AR_Tree import STGumbel_AR_Tree
+        return STGumbel_AR_Tree(**kwargs)
+    elif name == 'Choi':
+        from model.Choi_TreeLSTM import BinaryTreeLSTM
+        return BinaryTreeLSTM(**kwargs)
+
+
+def run_encoder(name, embedding, encoder, words, length):
+    """
+    Returns the tensor whose sum is back-propagated in the backward mode.
+    """
+    words_embed = embedding(words)
+    if name == 'Choi':
+        h, _ = encoder(input=words_embed, length=length)
+        return h
+    elif name == 'STG':
+        h, _, _ = encoder(words_embed, words, length)
+        return h
+    elif name == 'RL':
+        h, _, _, samples = encoder(words_embed, words, length)
+        return torch.cat([h, samples['h']], dim=0)
+
+
+def bench_one(name, mode, embedding, encoder, words, length, args):
+    def step():
+        if mode == 'inference':
+            encoder.eval()
+            with torch.no_grad():
+                run_encoder(name, embedding, encoder, words, length)
+        else:
+            encoder.train()
+            out = run_encoder(name, embedding, encoder, words, length)
+            if mode == 'backward':
+                out.sum().backward()
+                encoder.zero_grad()
+                embedding.zero_grad()
+        if args.device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    for _ in range(args.warmup):
+        step()
+    times = []
+    with PeakMemory(args.device) as mem:
+        for _ in range(args.repeat):
+            tic = time.perf_counter()
+            step()
+            times.append(time.perf_counter() - tic)
+    return statistics.median(times), mem.peak_mb
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--encoders', nargs='+', default=['RL', 'STG', 'Choi'], choices=['RL', 'STG', 'Choi'])
+    parser.add_argument('--modes', nargs='+', default=['forward', 'backward', 'inference'], choices=['forward', 'backward', 'inference'])
+    parser.add_argument('--lengths', nargs='+', type=int, default=[5, 10, 20, 50, 100, 200, 400])
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[32, 128])
+    parser.add_argument('--hidden-dims', nargs='+', type=int, default=[300])
+    parser.add_argument('--word-dim', default=300, type=int)
+    parser.add_argument('--num-words', default=20000, type=int)
+    parser.add_argument('--leaf-rnn-type', default='lstm', choices=['bilstm', 'lstm'])
+    parser.add_argument('--rank-input', default='h', choices=['w', 'h'])
+    parser.add_argument('--sample-num', default=3, type=int)
+    parser.add_argument('--length-jitter', default=0.5, type=float, help='lengths are uniform in [max_length*(1-jitter), max_length]')
+    parser.add_argument('--choi-max-length', default=100, type=int, help='the Choi encoder needs O(length^2) memory, skip longer inputs')
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--warmup', default=1, type=int)
+    parser.add_argument('--threads', type=int, help='torch intra-op threads')
+    parser.add_argument('--tree-threads', nargs='+', type=int, default=[1], help='threads building the trees of a batch (RL and STG), the intra-op threads are divided among them')
+    parser.add_argument('--max-tree-depths', nargs='+', type=int, default=[0], help='depth budgets of the RL and STG trees, 0 builds the full tree')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--cuda', action='store_true')
+    parser.add_argument('--csv', help='write results as csv')
+    parser.add_argument('--json', help='write results as json, which can be used as --baseline later')
+    parser.add_argument('--baseline', help='json results to compare with')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='slowdown ratio reported as regression')
+    args = parser.parse_args()
+    args.device = torch.device('cuda' if args.cuda else 'cpu')
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    intra_op_threads = torch.get_num_threads()
+
+    rows = []
+    sequential_ms = {}
+    for name in args.encoders:
+        for hidden_dim in args.hidden_dims:
+            torch.manual_seed(args.seed)
+            embedding = nn.Embedding(args.num_words, args.word_dim).to(args.device)
+            encoder = build_encoder(name, args, hidden_dim).to(args.device)
+            for batch_size in args.batch_sizes:
+                for max_length in args.lengths:
+                    if name == 'Choi' and max_length > args.choi_max_length:
+                        continue
+                    generator = torch.Generator().manual_seed(args.seed)
+                    words, length = random_batch(args.num_words, batch_size, max_length, args.length_jitter, generator)
+                    words, length = words.to(args.device), length.to(args.device)
+                    num_tokens = length.sum().item()
+                    for mode, tree_threads, max_tree_depth in itertools.product(args.modes, args.tree_threads, args.max_tree_depths):
+                        if name == 'Choi' and (tree_threads > 1 or max_tree_depth > 0):
+                            continue # Choi composes all sentences of a batch at once
+                        encoder.tree_threads = tree_threads
+                        encoder.max_tree_depth = max_tree_depth
+                        torch.set_num_threads(max(1, intra_op_threads // tree_threads))
+                        seconds, peak_mb = bench_one(name, mode, embedding, encoder, words, length, args)
+                        torch.set_num_threads(intra_op_threads)
+                        config = (name, mode, max_length, batch_size, hidden_dim, max_tree_depth)
+                        if tree_threads == 1:
+                            sequential_ms[config] = seconds * 1e3
+                        row = {
+                                'encoder': name,
+                                'mode': mode,
+                                'length': max_length,
+                                'batch_size': batch_size,
+                                'hidden_dim': hidden_dim,
+                                'tree_threads': tree_threads,
+                                'max_tree_depth': max_tree_depth,
+                                'ms_per_batch': round(seconds * 1e3, 3),
+                                'sentences_per_sec': round(batch_size / seconds, 2),
+                                'tokens_per_sec': round(num_tokens / seconds, 2),
+                                'peak_mem_mb': None if peak_mb is None else round(peak_mb, 2),
+                                'speedup_vs_sequential': None,
+                                }
+                        if config in sequential_ms:
+                            row['speedup_vs_sequential'] = round(sequential_ms[config] / row['ms_per_batch'], 3)
+                        rows.append(row)
+                        print('%-5s %-9s len=%-4d bs=%-4d dim=%-4d threads=%-2d depth=%-3d %10.2f ms %10.1f sent/s %10.1f tok/s  peak %s MB  speedup %s' % (
+                            name, mode, max_length, batch_size, hidden_dim, tree_threads, max_tree_depth, row['ms_per_batch'],
+                            row['sentences_per_sec'], row['tokens_per_sec'], row['peak_mem_mb'], row['speedup_vs_sequential']))
+                        sys.stdout.flush()
+
+    meta = {
+            'torch': torch.__version__,
+            'threads': torch.get_num_threads(),
+            'device': str(args.device),
+            'args': { k:v for k,v in vars(args).items() if k not in {'device'} },
+            }
+    write_results(rows, meta, args.csv, args.json)
+    if args.baseline:
+        regressions = compare_with_baseline(rows, args.baseline, KEY_FIELDS, 'ms_per_batch', args.tolerance, defaults={'tree_threads': 1, 'max_tree_depth': 0})
+        if regressions:
+            print(f'{len(regressions)} configurations are slower than the baseline by more than {args.tolerance:.0%}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
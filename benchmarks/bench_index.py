@@ -0,0 +1,151 @@
+"""
+Queries/sec of the nearest-neighbour search of utils.nn_index, exact and IVF, on a
+memory-mapped matrix of random clustered vectors (or real embeddings with --embeddings).
+IVF is reported for each --nprobe and query batch size with its recall against the
+exact search.
+
+    python -m benchmarks.bench_index --num-vectors 1000000 --dim 300 --json index.json
+    python -m benchmarks.bench_index --embeddings encoded/ --num-lists 4096 --nprobe 4 16 64
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.common import write_results, compare_with_baseline, peak_rss_mb
+from utils.nn_index import load_embeddings, ExactIndex, IVFIndex, recall_at_k
+
+KEY_FIELDS = ['index', 'num_vectors', 'dim', 'query_batch', 'nprobe']
+
+
+def synthetic_embeddings(path, num_vectors, dim, num_clusters, block_size, seed):
+    """
+    Gaussian clusters written block by block into a .npy memory map, so that the
+    benchmark does not need the whole matrix in memory.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.randn(num_clusters, dim, generator=generator)
+    embeddings = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(num_vectors, dim))
+    for start in range(0, num_vectors, block_size):
+        num = min(block_size, num_vectors - start)
+        cluster = torch.randint(num_clusters, (num,), generator=generator)
+        embeddings[start:start+num] = (centers[cluster] + 0.5 * torch.randn(num, dim, generator=generator)).numpy()
+    embeddings.flush()
+    return load_embeddings(path)
+
+
+def make_queries(embeddings, num_queries, seed):
+    # perturbed rows of the matrix, like queries close to indexed sentences
+    generator = torch.Generator().manual_seed(seed)
+    rows = torch.randint(len(embeddings), (num_queries,), generator=generator).sort()[0]
+    queries = torch.from_numpy(np.ascontiguousarray(embeddings[rows.numpy()]))
+    return queries + 0.1 * queries.std() * torch.randn(queries.size(), generator=generator)
+
+
+def time_search(search, queries, query_batch, repeat):
+    """
+    Returns:
+        seconds per query (median over repeats), ids of the last repeat
+    """
+    times = []
+    for _ in range(repeat):
+        ids = []
+        tic = time.perf_counter()
+        for b in range(0, len(queries), query_batch):
+            ids.append(search(queries[b:b+query_batch])[1])
+        times.append((time.perf_counter() - tic) / len(queries))
+    return sorted(times)[len(times) // 2], torch.cat(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--embeddings', help='embeddings.npy or output directory of encode_corpus.py, default is random vectors')
+    parser.add_argument('--num-vectors', default=1000000, type=int)
+    parser.add_argument('--dim', default=300, type=int)
+    parser.add_argument('--num-clusters', default=1000, type=int, help='clusters of the random vectors')
+    parser.add_argument('--num-queries', default=1000, type=int)
+    parser.add_argument('--query-batches', nargs='+', type=int, default=[1, 64, 1000], help='queries per search call')
+    parser.add_argument('--k', default=10, type=int)
+    parser.add_argument('--metric', default='cosine', choices=['cosine', 'dot'])
+    parser.add_argument('--block-size', default=65536, type=int)
+    parser.add_argument('--num-lists', default=1024, type=int)
+    parser.add_argument('--nprobe', nargs='+', type=int, default=[1, 4, 16, 64])
+    parser.add_argument('--train-size', default=100000, type=int, help='sample size of the IVF k-means')
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--threads', type=int, help='torch intra-op threads')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--csv', help='write results as csv')
+    parser.add_argument('--json', help='write results as json, which can be used as --baseline later')
+    parser.add_argument('--baseline', help='json results to compare with')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='slowdown ratio reported as regression')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.embeddings:
+            embeddings = load_embeddings(args.embeddings)
+        else:
+            tic = time.time()
+            embeddings = synthetic_embeddings(os.path.join(tmp_dir, 'embeddings.npy'), args.num_vectors, args.dim,
+                                              args.num_clusters, args.block_size, args.seed)
+            print(f'wrote {args.num_vectors} random vectors in {time.time() - tic:.1f} sec')
+        num_vectors, dim = embeddings.shape
+        queries = make_queries(embeddings, args.num_queries, args.seed)
+
+        rows = []
+        def report(name, query_batch, nprobe, seconds, recall, build_sec):
+            row = {
+                    'index': name,
+                    'num_vectors': num_vectors,
+                    'dim': dim,
+                    'query_batch': query_batch,
+                    'nprobe': nprobe,
+                    'ms_per_query': round(seconds * 1e3, 4),
+                    'queries_per_sec': round(1 / seconds, 2),
+                    'recall': None if recall is None else round(recall, 4),
+                    'build_sec': round(build_sec, 2),
+                    }
+            rows.append(row)
+            print('%-5s n=%-8d dim=%-4d batch=%-5d nprobe=%-4s %10.4f ms/query %10.1f queries/s  recall %s' % (
+                name, num_vectors, dim, query_batch, nprobe, row['ms_per_query'], row['queries_per_sec'], row['recall']))
+            sys.stdout.flush()
+
+        tic = time.time()
+        exact = ExactIndex(embeddings, args.metric, args.block_size)
+        build_sec = time.time() - tic
+        exact_ids = None
+        for query_batch in args.query_batches:
+            seconds, ids = time_search(lambda q: exact.search(q, args.k), queries, query_batch, args.repeat)
+            exact_ids = ids
+            report('exact', query_batch, None, seconds, 1., build_sec)
+
+        tic = time.time()
+        ivf = IVFIndex(embeddings, args.metric, args.block_size, args.num_lists).train(args.train_size, seed=args.seed)
+        build_sec = time.time() - tic
+        for nprobe in args.nprobe:
+            for query_batch in args.query_batches:
+                seconds, ids = time_search(lambda q: ivf.search(q, args.k, nprobe), queries, query_batch, args.repeat)
+                report('ivf', query_batch, nprobe, seconds, recall_at_k(exact_ids, ids), build_sec)
+        del embeddings, exact, ivf
+
+    meta = {
+            'torch': torch.__version__,
+            'threads': torch.get_num_threads(),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'args': vars(args),
+            }
+    write_results(rows, meta, args.csv, args.json)
+    if args.baseline:
+        regressions = compare_with_baseline(rows, args.baseline, KEY_FIELDS, 'ms_per_query', args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} configurations are slower than the baseline by more than {args.tolerance:.0%}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
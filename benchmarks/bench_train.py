@@ -0,0 +1,135 @@
+"""
+End-to-end training throughput on synthetic corpora. Each (data type, model type) runs
+train.py in a subprocess for --warmup + --steps steps and reads the timing summary of
+the last --steps steps from timing.jsonl.
+
+    python -m benchmarks.synthetic_data --out-dir /tmp/synth
+    python -m benchmarks.bench_train --synthetic-dir /tmp/synth --steps 50 --json train.json
+    python -m benchmarks.bench_train --synthetic-dir /tmp/synth --data-types age --model-types RL STG --chunk-sizes 0 25 50
+"""
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.common import write_results, compare_with_baseline
+
+KEY_FIELDS = ['data_type', 'model_type', 'batch_size', 'chunk_size']
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def data_args(data_type, synthetic_dir):
+    glove = ['--glove-path', os.path.join(synthetic_dir, 'glove.pkl')]
+    if data_type == 'snli':
+        return ['--data-path', os.path.join(synthetic_dir, 'snli.pt')] + glove
+    elif data_type == 'age':
+        return ['--data-path', os.path.join(synthetic_dir, 'age2.pickle')]
+    else:
+        return ['--data-path', synthetic_dir] + glove
+
+
+def run_train(data_type, model_type, chunk_size, args, save_dir, log_path):
+    total_steps = args.warmup + args.steps
+    cmd = [sys.executable, os.path.join(REPO_DIR, 'train.py'),
+            '--save-dir', save_dir,
+            '--data-type', data_type, '--model-type', model_type,
+            '--leaf-rnn-type', args.leaf_rnn_type,
+            '--word-dim', str(args.word_dim), '--hidden-dim', str(args.hidden_dim),
+            '--clf-hidden-dim', str(args.hidden_dim), '--clf-num-layers', '1',
+            '--dropout', '0.1', '--batch-size', str(args.batch_size), '--max-epoch', '1000',
+            '--lr', '0.001', '--l2reg', '1e-5', '--clip', '5', '--optimizer', 'adam', '--patience', '10',
+            '--sample-num', str(args.sample_num),
+            '--max-steps', str(total_steps), '--timing-every', str(total_steps), '--timing-window', str(args.steps),
+            # keep validation and checkpoints out of the measured steps
+            '--checkpoint-every', str(10 ** 9)] + data_args(data_type, args.synthetic_dir) + args.extra
+    if chunk_size:
+        cmd += ['--chunk-size', str(chunk_size)]
+    env = dict(os.environ)
+    if args.threads:
+        env['OMP_NUM_THREADS'] = str(args.threads)
+    with open(log_path, 'w') as log:
+        proc = subprocess.Popen(cmd, cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 gives the resource usage of this child only
+        _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    peak_rss_mb = rusage.ru_maxrss / 1024
+    timing_path = os.path.join(save_dir, 'timing.jsonl')
+    if proc.returncode != 0 or not os.path.exists(timing_path):
+        return None, peak_rss_mb
+    with open(timing_path) as f:
+        summary = [json.loads(line) for line in f][-1]
+    return summary, peak_rss_mb
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--synthetic-dir', required=True, help='output of benchmarks.synthetic_data')
+    parser.add_argument('--data-types', nargs='+', default=['snli', 'age', 'sst2'], choices=['snli', 'age', 'sst2', 'sst5'])
+    parser.add_argument('--model-types', nargs='+', default=['Choi', 'RL', 'STG'], choices=['Choi', 'RL', 'STG'])
+    parser.add_argument('--steps', default=50, type=int, help='measured steps')
+    parser.add_argument('--warmup', default=5, type=int)
+    parser.add_argument('--batch-size', default=32, type=int)
+    parser.add_argument('--word-dim', default=300, type=int, help='must match the synthetic GloVe dim')
+    parser.add_argument('--hidden-dim', default=300, type=int)
+    parser.add_argument('--leaf-rnn-type', default='lstm', choices=['bilstm', 'lstm'])
+    parser.add_argument('--sample-num', default=3, type=int)
+    parser.add_argument('--chunk-sizes', nargs='+', type=int, default=[0], help='--chunk-size of train.py, 0 is the flat mode (Choi only runs flat)')
+    parser.add_argument('--threads', type=int, help='OMP_NUM_THREADS of each run')
+    parser.add_argument('--work-dir', help='where to keep the save dirs of the runs, default is a temporary directory')
+    parser.add_argument('--csv')
+    parser.add_argument('--json')
+    parser.add_argument('--baseline', help='json results to compare with')
+    parser.add_argument('--tolerance', default=0.1, type=float)
+    parser.add_argument('extra', nargs=argparse.REMAINDER, help='extra train.py arguments after --')
+    args = parser.parse_args()
+    if args.extra and args.extra[0] == '--':
+        args.extra = args.extra[1:]
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='bench_train_')
+    rows = []
+    for data_type in args.data_types:
+        for model_type, chunk_size in itertools.product(args.model_types, args.chunk_sizes):
+            if model_type == 'Choi' and chunk_size:
+                continue
+            save_dir = os.path.join(work_dir, f'{data_type}-{model_type}' + (f'-chunk{chunk_size}' if chunk_size else ''))
+            log_path = save_dir + '.log'
+            summary, peak_rss_mb = run_train(data_type, model_type, chunk_size, args, save_dir, log_path)
+            row = {
+                    'data_type': data_type,
+                    'model_type': model_type,
+                    'batch_size': args.batch_size,
+                    'chunk_size': chunk_size,
+                    'steps_per_sec': None,
+                    'sentences_per_sec': None,
+                    'tokens_per_sec': None,
+                    'data_stall_fraction': None,
+                    'peak_rss_mb': round(peak_rss_mb, 1),
+                    }
+            if summary is None:
+                print(f'{data_type} {model_type} chunk={chunk_size}: failed, see {log_path}')
+            else:
+                row['steps_per_sec'] = round(1e3 / summary['step_ms'], 3)
+                row['sentences_per_sec'] = round(summary['sentences_per_sec'], 2)
+                row['tokens_per_sec'] = round(summary['tokens_per_sec'], 2)
+                row['data_stall_fraction'] = round(summary['phases'].get('data', {}).get('fraction', 0.), 4)
+                print('%-5s %-5s chunk=%-4d %8.3f steps/s %10.1f tok/s  data stall %5.1f%%  peak rss %8.1f MB' % (
+                    data_type, model_type, chunk_size, row['steps_per_sec'], row['tokens_per_sec'],
+                    100 * row['data_stall_fraction'], row['peak_rss_mb']))
+            rows.append(row)
+            sys.stdout.flush()
+
+    meta = {'args': vars(args)}
+    write_results(rows, meta, args.csv, args.json)
+    if args.baseline:
+        regressions = compare_with_baseline(rows, args.baseline, KEY_FIELDS, 'steps_per_sec', args.tolerance,
+                                            lower_is_better=False, defaults={'chunk_size': 0})
+        if regressions:
+            print(f'{len(regressions)} configurations are slower than the baseline by more than {args.tolerance:.0%}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
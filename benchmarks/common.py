@@ -0,0 +1,121 @@
+import json
+import os
+import resource
+import threading
+import time
+
+import torch
+
+
+class SyntheticVocab(object):
+    # the encoders only need id_to_word
+    def __init__(self, num_words):
+        self.id_to_word = ['<unk>', '<pad>'] + ['w%d' % i for i in range(2, num_words)]
+
+
+def random_batch(num_words, batch_size, max_length, jitter=0.5, generator=None):
+    """
+    Returns:
+        words: (batch_size, max_length) LongTensor of random word ids, padded with 1
+        length: (batch_size, ), uniform in [ceil(max_length*(1-jitter)), max_length],
+            the first sentence always has max_length words
+    """
+    min_length = max(1, max_length - int(max_length * jitter))
+    length = torch.randint(min_length, max_length + 1, (batch_size,), generator=generator)
+    length[0] = max_length
+    words = torch.randint(2, num_words, (batch_size, max_length), generator=generator)
+    mask = torch.arange(max_length).unsqueeze(0) < length.unsqueeze(1)
+    words = words.masked_fill(~mask, 1)
+    return words, length
+
+
+def current_rss():
+    # resident set size in bytes, linux only
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+class PeakMemory(object):
+    """
+    Peak memory increase inside the `with` block, in MB. On cuda it is read from the
+    allocator, on cpu the RSS is sampled by a background thread.
+    """
+    def __init__(self, device, interval=0.001):
+        self.device = device
+        self.interval = interval
+        self.peak_mb = None
+
+    def _sample(self):
+        while not self.stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.base = torch.cuda.memory_allocated(self.device)
+        else:
+            self.base = current_rss()
+            if self.base is not None:
+                self.peak = self.base
+                self.stop = threading.Event()
+                self.thread = threading.Thread(target=self._sample, daemon=True)
+                self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+            self.peak_mb = (torch.cuda.max_memory_allocated(self.device) - self.base) / 2**20
+        elif self.base is not None:
+            self.stop.set()
+            self.thread.join()
+            self.peak = max(self.peak, current_rss())
+            self.peak_mb = (self.peak - self.base) / 2**20
+        return False
+
+
+def peak_rss_mb():
+    # peak RSS of this process since its start, ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_results(rows, meta, csv_path=None, json_path=None):
+    if csv_path:
+        fields = list(rows[0].keys()) if rows else []
+        with open(csv_path, 'w') as f:
+            f.write(','.join(fields) + '\n')
+            for row in rows:
+                f.write(','.join('' if row[k] is None else str(row[k]) for k in fields) + '\n')
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({'meta': meta, 'results': rows}, f, indent=1)
+
+
+def compare_with_baseline(rows, baseline_path, key_fields, metric, tolerance, lower_is_better=True, defaults=None):
+    """
+    Print the ratio of `metric` against a json file written by write_results.
+    Returns the list of keys that regressed by more than `tolerance`.
+    """
+    with open(baseline_path) as f:
+        # key fields added after the baseline was written take their value from defaults
+        defaults = defaults or {}
+        baseline = { tuple(r[k] if k in r else defaults[k] for k in key_fields): r for r in json.load(f)['results'] }
+    regressions = []
+    print('%-50s %12s %12s %8s' % ('config', 'baseline', 'current', 'speedup'))
+    for row in rows:
+        key = tuple(row[k] for k in key_fields)
+        if key not in baseline or row[metric] is None or baseline[key][metric] is None:
+            continue
+        old, new = baseline[key][metric], row[metric]
+        speedup = old / new if lower_is_better else new / old
+        flag = ''
+        if speedup < 1 / (1 + tolerance):
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print('%-50s %12.3f %12.3f %7.2fx%s' % (' '.join(map(str, key)), old, new, speedup, flag))
+    return regressions
@@ -0,0 +1,165 @@
+"""
+Write synthetic corpora in the formats consumed by the SNLI, AGE2 and SST loaders,
+plus a pickled GloVe dict (the format of pickle_glove.py), so that train.py can be
+run without downloading anything:
+
+    python -m benchmarks.synthetic_data --out-dir /tmp/synth
+
+    <out-dir>/glove.pkl         --glove-path
+    <out-dir>/snli.pt           --data-type snli --data-path
+    <out-dir>/age2.pickle       --data-type age --data-path
+    <out-dir>/sst/trees/*.txt   --data-type sst2/sst5 --data-path <out-dir>
+"""
+import argparse
+import os
+import pickle
+
+import numpy as np
+
+from snli.dataLoader import SNLIDataset
+
+
+def sample_lengths(rng, n, args):
+    if args.length_dist == 'fixed':
+        lengths = np.full(n, args.mean_length)
+    elif args.length_dist == 'uniform':
+        lengths = rng.randint(args.min_length, args.max_length + 1, size=n)
+    elif args.length_dist == 'lognormal':
+        # mean of the lognormal distribution equals args.mean_length
+        sigma = args.length_sigma
+        mu = np.log(args.mean_length) - sigma ** 2 / 2
+        lengths = np.round(rng.lognormal(mu, sigma, size=n))
+    return np.clip(lengths, args.min_length, args.max_length).astype(np.int64)
+
+
+class Corpus(object):
+    """
+    Words follow a zipfian distribution over a vocab of 'w<i>' tokens.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.rng = np.random.RandomState(args.seed)
+        self.words = ['w%d' % i for i in range(args.vocab_size)]
+        probs = 1. / np.arange(1, args.vocab_size + 1) ** args.zipf
+        self.probs = probs / probs.sum()
+
+    def sentences(self, n):
+        lengths = sample_lengths(self.rng, n, self.args)
+        ids = self.rng.choice(self.args.vocab_size, size=int(lengths.sum()), p=self.probs)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        return [ids[offsets[i]:offsets[i+1]] for i in range(n)]
+
+    def glove(self):
+        # leave some words out, like real corpora have words unknown to GloVe
+        known = self.rng.rand(self.args.vocab_size) < self.args.glove_coverage
+        glove = { w: self.rng.randn(self.args.word_dim).astype(np.float32) * 0.1
+                for w, k in zip(self.words, known) if k }
+        glove['the'] = np.zeros(self.args.word_dim, dtype=np.float32)
+        return glove
+
+
+def write_snli(corpus, args, path):
+    word_wtoi = {'<unk>': 0, '<pad>': 1}
+    for w in corpus.words:
+        word_wtoi[w] = len(word_wtoi)
+    vocab = {
+            'word_token_to_idx': word_wtoi,
+            'word_token_to_freq': dict.fromkeys(word_wtoi, 1),
+            'label_token_to_idx': {'neutral': 0, 'entailment': 1, 'contradiction': 2},
+            }
+    vocab['word_idx_to_token'] = { v:k for k,v in vocab['word_token_to_idx'].items() }
+    vocab['label_idx_to_token'] = { v:k for k,v in vocab['label_token_to_idx'].items() }
+    splits = []
+    for n in [args.num_train, args.num_valid, args.num_test]:
+        # each premise appears with 3 hypotheses, like in SNLI
+        premises = corpus.sentences((n + 2) // 3)
+        hypotheses = corpus.sentences(n)
+        dataset = SNLIDataset.__new__(SNLIDataset)
+        dataset.vocab = vocab
+        dataset.lower = False
+        dataset._max_length = args.max_length
+        dataset._data = []
+        for i in range(n):
+            pre = (premises[i // 3] + 2).tolist()
+            hyp = (hypotheses[i] + 2).tolist()
+            dataset._data.append((pre, hyp, len(pre), len(hyp), int(corpus.rng.randint(3))))
+        splits.append(dataset)
+    with open(path, 'wb') as f:
+        for dataset in splits:
+            pickle.dump(dataset, f)
+
+
+def write_age(corpus, args, path, glove):
+    # the same layout as age/dump_dataset.py, id 0 is reserved for padding
+    w_referred = {'<pad>': 0}
+    for w in corpus.words:
+        w_referred[w] = len(w_referred)
+    inv_w_referred = { v:k for k,v in w_referred.items() }
+    train_dev_test = []
+    for n in [args.num_train, args.num_valid, args.num_test]:
+        pairs = [((s + 1).astype('int32'), int(corpus.rng.randint(5))) for s in corpus.sentences(n)]
+        train_dev_test.append(pairs)
+    weight = np.zeros((len(w_referred), args.word_dim), dtype=np.float32)
+    for w, i in w_referred.items():
+        weight[i] = glove[w] if w in glove else corpus.rng.randn(args.word_dim) * 0.01
+    weight[0] = 0
+    with open(path, 'wb') as f:
+        pickle.dump(train_dev_test, f)
+        pickle.dump(weight, f)
+        pickle.dump(w_referred, f)
+        pickle.dump(inv_w_referred, f)
+
+
+def random_tree(corpus, words):
+    """
+    A random binary PTB tree over words with random sentiment labels, e.g. (3 (2 w1) (4 w2))
+    """
+    if len(words) == 1:
+        return '(%d %s)' % (corpus.rng.randint(5), words[0])
+    split = corpus.rng.randint(1, len(words))
+    return '(%d %s %s)' % (corpus.rng.randint(5), random_tree(corpus, words[:split]), random_tree(corpus, words[split:]))
+
+
+def write_sst(corpus, args, tree_dir):
+    os.makedirs(tree_dir, exist_ok=True)
+    for name, n in [('train', args.num_train), ('dev', args.num_valid), ('test', args.num_test)]:
+        with open(os.path.join(tree_dir, name + '.txt'), 'w') as f:
+            for s in corpus.sentences(n):
+                f.write(random_tree(corpus, [corpus.words[i] for i in s]) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out-dir', required=True)
+    parser.add_argument('--datasets', nargs='+', default=['snli', 'age', 'sst'], choices=['snli', 'age', 'sst'])
+    parser.add_argument('--vocab-size', default=20000, type=int)
+    parser.add_argument('--word-dim', default=300, type=int)
+    parser.add_argument('--zipf', default=1.0, type=float, help='exponent of the zipfian word distribution')
+    parser.add_argument('--glove-coverage', default=0.9, type=float, help='fraction of words with a GloVe vector')
+    parser.add_argument('--num-train', default=10000, type=int)
+    parser.add_argument('--num-valid', default=1000, type=int)
+    parser.add_argument('--num-test', default=1000, type=int)
+    parser.add_argument('--length-dist', default='lognormal', choices=['fixed', 'uniform', 'lognormal'])
+    parser.add_argument('--mean-length', default=20, type=int)
+    parser.add_argument('--length-sigma', default=0.5, type=float, help='sigma of the lognormal length distribution')
+    parser.add_argument('--min-length', default=1, type=int)
+    parser.add_argument('--max-length', default=200, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    corpus = Corpus(args)
+    glove = corpus.glove()
+    with open(os.path.join(args.out_dir, 'glove.pkl'), 'wb') as f:
+        pickle.dump(glove, f)
+    if 'snli' in args.datasets:
+        write_snli(corpus, args, os.path.join(args.out_dir, 'snli.pt'))
+    if 'age' in args.datasets:
+        write_age(corpus, args, os.path.join(args.out_dir, 'age2.pickle'), glove)
+    if 'sst' in args.datasets:
+        write_sst(corpus, args, os.path.join(args.out_dir, 'sst', 'trees'))
+    print(f'Synthetic corpora are written to {args.out_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""
+Parse and encode a large corpus of raw sentences with a trained model, in parallel
+worker processes. The input is a text file with one tokenized sentence per line, or a
+jsonl file whose --field holds a sentence string or token list. Outputs in --out-dir:
+
+    meta.json           the settings of the job, checked when it is resumed
+    embeddings.npy      (num_sentences, hidden_dim) float32, row i is line i of the input,
+                        written in place through a memory map (np.load(..., mmap_mode='r'))
+    shard-00000.npz     for the lines [shard * shard_size, (shard + 1) * shard_size):
+                        labels: predicted class, -1 for empty lines and pair (SNLI) models
+                        tree_offsets, tree_parents: the parent array of the tree of line i is
+                        tree_parents[tree_offsets[i]:tree_offsets[i+1]]
+
+For RL and STG the tree has a node per word (the word itself is a node of AR-Tree), so the
+parent array has one entry per word. For Choi the words are the nodes 0..l-1 and node l+i
+is the one composed at step i (see utils.helper.decode_parents). Roots have parent -1.
+
+A shard file is only written, atomically, after its rows of embeddings.npy are flushed,
+so an interrupted job is resumed by running the same command: completed shards are skipped.
+
+    python encode_corpus.py --ckpt model.artree --input sentences.txt --out-dir encoded --workers 8
+"""
+import argparse
+import json
+import os
+import time
+from collections import deque
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from model.ARTreeEncoder import ARTreeEncoder
+from model.PairModel import PairModel
+from utils.helper import decode_parents
+
+
+def read_sentences(path, fmt, field, lower):
+    """
+    Yields the token list of each line, empty for blank lines.
+    """
+    # only '\n' ends a line, as in count_lines
+    with open(path, encoding='utf8', newline='\n') as f:
+        for line in f:
+            if fmt == 'jsonl':
+                sentence = json.loads(line)[field] if line.strip() else ''
+            else:
+                sentence = line
+            tokens = sentence.split() if isinstance(sentence, str) else list(sentence)
+            if lower:
+                tokens = [t.lower() for t in tokens]
+            yield tokens
+
+
+def count_lines(path):
+    num = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            num += block.count(b'\n')
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            num += f.read(1) != b'\n' # last line without newline
+    return num
+
+
+def shard_path(out_dir, shard):
+    return os.path.join(out_dir, 'shard-%05d.npz' % shard)
+
+
+def tree_parents(root, length):
+    """
+    Parent array of an AR-Tree, whose in-order traversal is the sentence. The words of a
+    pooled leaf (see --max-tree-depth of train.py) all hang from the parent of the leaf.
+    """
+    position = {} # first word of each node
+    num = 0
+    stack, node = [], root
+    while stack or node is not None:
+        if node is not None:
+            stack.append(node)
+            node = node.left
+        else:
+            node = stack.pop()
+            position[id(node)] = num
+            num += node.num_words
+            node = node.right
+    parents = np.full(length, -1, dtype=np.int32)
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for child in [node.left, node.right]:
+            if child is not None:
+                first = position[id(child)]
+                parents[first:first+child.num_words] = position[id(node)]
+                stack.append(child)
+    return parents
+
+
+_worker = {}
+
+def init_worker(args, num_threads):
+    torch.set_num_threads(num_threads)
+    encoder = ARTreeEncoder.from_checkpoint(args.ckpt, batch_size=args.batch_size,
+                                            cache_size=0, optimize=args.optimize)
+    _worker['encoder'] = encoder
+    _worker['embeddings'] = np.load(os.path.join(args.out_dir, 'embeddings.npy'), mmap_mode='r+')
+    _worker['args'] = args
+
+
+def encode_shard(task):
+    """
+    Args:
+        task: (shard, start, list of token lists)
+    Returns:
+        shard, number of sentences, number of tokens
+    """
+    shard, start, sentences = task
+    encoder, embeddings, args = _worker['encoder'], _worker['embeddings'], _worker['args']
+    model = encoder.model
+    labels = np.full(len(sentences), -1, dtype=np.int64)
+    parents = [np.zeros(0, dtype=np.int32)] * len(sentences)
+    ids_list = [encoder.to_ids(tokens) for tokens in sentences]
+    # length buckets: batches of sentences of similar length waste less padding
+    order = sorted((i for i in range(len(ids_list)) if ids_list[i]), key=lambda i: len(ids_list[i]))
+    with torch.no_grad():
+        for b in range(0, len(order), args.batch_size):
+            batch = order[b:b+args.batch_size]
+            length = torch.LongTensor([len(ids_list[i]) for i in batch])
+            words = torch.zeros(len(batch), int(length.max()), dtype=torch.long)
+            for j, i in enumerate(batch):
+                words[j, :length[j]] = torch.LongTensor(ids_list[i])
+            h, trees, select_masks = encoder.forward_batch(words.to(encoder.device), length.to(encoder.device))
+            rows = np.asarray(batch) + start
+            embeddings[rows] = h.cpu().numpy()
+            if not isinstance(model, PairModel): # pair models classify sentence pairs
+                labels[batch] = model.classifier(h).max(1)[1].cpu().numpy()
+            if select_masks is not None:
+                batch_parents = decode_parents(length, select_masks).cpu().numpy()
+                for j, i in enumerate(batch):
+                    parents[i] = batch_parents[j, :2*len(ids_list[i])-1].astype(np.int32)
+            else:
+                for i, tree in zip(batch, trees):
+                    parents[i] = tree_parents(tree, len(ids_list[i]))
+    embeddings.flush()
+
+    tree_offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+    tree_offsets[1:] = np.cumsum([len(p) for p in parents])
+    path = shard_path(args.out_dir, shard)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, labels=labels, tree_offsets=tree_offsets, tree_parents=np.concatenate(parents))
+    os.replace(tmp_path, path)
+    return shard, len(sentences), sum(len(ids) for ids in ids_list)
+
+
+def pending_shards(args, done):
+    """
+    Stream the input and yield the tasks of the shards that are not done yet.
+    """
+    sentences, shard = [], 0
+    for tokens in read_sentences(args.input, args.format, args.field, args.lower):
+        sentences.append(tokens)
+        if len(sentences) == args.shard_size:
+            if shard not in done:
+                yield shard, shard * args.shard_size, sentences
+            sentences, shard = [], shard + 1
+    if sentences and shard not in done:
+        yield shard, shard * args.shard_size, sentences
+
+
+def prepare_output(args, num_sentences):
+    """
+    Create meta.json and embeddings.npy, or check them against the arguments when resuming.
+    Returns:
+        the set of completed shards, the number of shards
+    """
+    encoder = ARTreeEncoder.from_checkpoint(args.ckpt, cache_size=0)
+    meta = {
+            'input': os.path.abspath(args.input),
+            'ckpt': os.path.abspath(args.ckpt),
+            'num_sentences': num_sentences,
+            'shard_size': args.shard_size,
+            'hidden_dim': encoder.hidden_dim,
+            'model_type': encoder.model.model_type,
+            'tree_format': 'binary' if encoder.model.model_type == 'Choi' else 'words',
+            'format': args.format,
+            'field': args.field,
+            'lower': args.lower,
+            }
+    meta_path = os.path.join(args.out_dir, 'meta.json')
+    embeddings_path = os.path.join(args.out_dir, 'embeddings.npy')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            old_meta = json.load(f)
+        changed = [k for k in meta if old_meta.get(k) != meta[k]]
+        if changed:
+            raise ValueError(f'{args.out_dir} was written with different {", ".join(changed)}, use another --out-dir')
+    else:
+        os.makedirs(args.out_dir, exist_ok=True)
+        np.lib.format.open_memmap(embeddings_path, mode='w+', dtype=np.float32,
+                                  shape=(num_sentences, encoder.hidden_dim)).flush()
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f, indent=2)
+    num_shards = (num_sentences + args.shard_size - 1) // args.shard_size
+    return { s for s in range(num_shards) if os.path.exists(shard_path(args.out_dir, s)) }, num_shards
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt', required=True, help='checkpoint or inference artifact')
+    parser.add_argument('--input', required=True)
+    parser.add_argument('--out-dir', required=True)
+    parser.add_argument('--format', choices=['text', 'jsonl'], help='default is jsonl for *.jsonl files, otherwise text')
+    parser.add_argument('--field', default='sentence', help='field of the sentence in jsonl input')
+    parser.add_argument('--lower', action='store_true', help='lowercase the tokens')
+    parser.add_argument('--workers', default=1, type=int, help='number of worker processes, 0 to encode in this process')
+    parser.add_argument('--shard-size', default=100000, type=int, help='sentences per shard, the unit of resumption')
+    parser.add_argument('--batch-size', default=128, type=int)
+    parser.add_argument('--optimize', action='store_true', help='see model.export.optimize_for_inference')
+    args = parser.parse_args()
+    if args.format is None:
+        args.format = 'jsonl' if args.input.endswith('.jsonl') else 'text'
+
+    num_sentences = count_lines(args.input)
+    done, num_shards = prepare_output(args, num_sentences)
+    print(f'{num_sentences} sentences in {num_shards} shards, {len(done)} already done')
+    if len(done) == num_shards:
+        return
+
+    tic = time.time()
+    total_sentences = total_tokens = 0
+    def report(result):
+        nonlocal total_sentences, total_tokens
+        shard, num, tokens = result
+        done.add(shard)
+        total_sentences += num
+        total_tokens += tokens
+        elapsed = time.time() - tic
+        print(f'shard {shard} done ({len(done)}/{num_shards}), '
+              f'{total_sentences / elapsed:.1f} sentences/sec, {total_tokens / elapsed:.1f} tokens/sec')
+
+    if args.workers == 0:
+        init_worker(args, torch.get_num_threads())
+        for task in pending_shards(args, done):
+            report(encode_shard(task))
+    else:
+        num_threads = max(1, (os.cpu_count() or 1) // args.workers)
+        ctx = mp.get_context('spawn')
+        with ctx.Pool(args.workers, initializer=init_worker, initargs=(args, num_threads)) as pool:
+            # a bounded number of shards in flight, so the input is streamed rather than read at once
+            in_flight = deque()
+            for task in pending_shards(args, done):
+                in_flight.append(pool.apply_async(encode_shard, (task,)))
+                while len(in_flight) >= 2 * args.workers:
+                    report(in_flight.popleft().get())
+            while in_flight:
+                report(in_flight.popleft().get())
+    print(f'encoded {total_sentences} sentences in {time.time() - tic:.1f} sec')
+
+
+if __name__ == '__main__':
+    main()
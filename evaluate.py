@@ -1,4 +1,5 @@
 import argparse
+import os
 import numpy as np
 import torch
 from model.SingleModel import SingleModel
@@ -7,6 +8,11 @@ from age.dataLoader import AGE2
 from sst.dataLoader import SST
 from snli.dataLoader import SNLI
 from ete3 import Tree
+from utils.profiling import StepProfiler, step_range
+from utils.vocab import IdVocab, remap_words
+from utils.artifact import load_file
+from model.export import optimize_for_inference
+from utils.helper import parse_tree_avg_depth
 
 def eval_iter(batch, model):
     model.eval()
@@ -19,7 +25,7 @@ def eval_iter(batch, model):
 
 
 def legal(s):
-    return s.replace(',', '<comma>')
+    return s.replace(',', '<comma>').replace(' ', '_') # pooled leaves have several words
 
 def postOrder(root):
     def recursion(node):
@@ -52,12 +58,17 @@ def recoverSentence(ids, length, vocab):
 def main(args):
     device = torch.device('cuda' if args.cuda else 'cpu')
     args.device = device
+    if args.tree_threads > 1:
+        torch.set_num_threads(max(1, torch.get_num_threads() // args.tree_threads))
     args.batch_size = 128 if args.mode == 'val' else 1 # batch_size=1 for visualize
     # load model parameters from checkpoint
-    loaded = torch.load(args.ckpt, map_location={'cuda:0':'cpu'})
+    loaded = load_file(args.ckpt) # also reads the artifacts of export_artifact.py
     model_kwargs = loaded['model_kwargs']
+    max_tree_depth = args.max_tree_depth
     for k, v in model_kwargs.items():
         setattr(args, k, v)
+    if max_tree_depth is not None: # the depth budget adds no parameters, so it can be changed at test time
+        args.max_tree_depth = max_tree_depth
 
     ################################  data  ###################################
     if args.data_type == 'sst2':
@@ -70,6 +81,11 @@ def main(args):
         data = AGE2(args)
     elif args.data_type == 'snli':
         data = SNLI(args) 
+    vocab_remap = loaded.get('vocab_remap')
+    if vocab_remap is not None:
+        # checkpoint exported by prune_vocab.py, the batches are mapped to its vocab
+        args.vocab = IdVocab(loaded['vocab'])
+        args.num_words = len(args.vocab.id_to_word)
     ################################  model  ###################################
     if args.data_type == 'snli':
         Model = PairModel
@@ -88,22 +104,52 @@ def main(args):
     model.load_state_dict(loaded['model'])
     model.eval()
     model = model.to(device)
+    if args.optimize:
+        model_arg, _ = next(data.test_minibatch_generator())
+        if vocab_remap is not None:
+            model_arg = remap_words(model_arg, vocab_remap)
+        model = optimize_for_inference(model, check_batches=[model_arg])
+
+    profiler = None
+    if args.profile_steps is not None:
+        save_dir = args.save_dir or os.path.dirname(os.path.abspath(args.ckpt))
+        profiler = StepProfiler(args.profile_steps, save_dir, 'eval', use_cuda=args.cuda)
 
     if args.mode == 'val': # validate
         print('validate on test set......')
         correct_num = 0
-        for test_batch in data.test_minibatch_generator():
+        depth_sum = word_num = 0
+        for step, test_batch in enumerate(data.test_minibatch_generator()):
+            if profiler is not None:
+                profiler.before_step(step)
+            if vocab_remap is not None:
+                test_batch = (remap_words(test_batch[0], vocab_remap), test_batch[1])
             correct, supplements = eval_iter(test_batch, model)
-            correct_sum += correct
-            for t in supplements['tree']:
-                print(t)
+            if profiler is not None:
+                profiler.after_step(step)
+            correct_num += correct
+            if args.model_type == 'Choi':
+                model_arg = test_batch[0]
+                for prefix in (['pre_', 'hyp_'] if args.data_type == 'snli' else ['']):
+                    length = model_arg[prefix + 'length'] if prefix else model_arg['length']
+                    depth, num = parse_tree_avg_depth(length, supplements[prefix + 'select_masks'])
+                    depth_sum += depth
+                    word_num += num
         print(f'Accuracy: {correct_num / data.num_test:.4f}')
+        if word_num > 0:
+            print(f'Average word depth of the trees: {depth_sum / word_num:.3f}')
+        if args.dedup:
+            print(f'Dedup hit rate: {model.dedup_stats.hit_rate():.2%} of {model.dedup_stats.num_sentences} sentences')
+        if profiler is not None:
+            profiler.stop()
     elif args.mode == 'vis': # visualize
         print('visualize learned tree structures.......')
         cnt = 0
         for test_batch in data.test_minibatch_generator():
             cnt += 1
             model_arg, label = test_batch
+            if vocab_remap is not None:
+                model_arg = remap_words(model_arg, vocab_remap)
             logits, supplements = model(**model_arg)
             if args.data_type =='snli':
                 visualizeTree(postOrder(supplements['pre_tree'][0]))
@@ -127,7 +173,12 @@ if __name__ == '__main__':
     parser.add_argument('--data-path', required=True)
     parser.add_argument('--cuda', action='store_true')
     parser.add_argument('--mode', choices=['vis', 'val'], help='visualize or validate')
-    parser.add_argument('--glove', default='glove.840B.300d', help='used only by torchtext')
+    parser.add_argument('--profile-steps', type=step_range, help='START:END, run torch.profiler over these test batches (--mode val)')
+    parser.add_argument('--save-dir', help='where to save the profile, default is the directory of --ckpt')
+    parser.add_argument('--optimize', action='store_true', help='fold batchnorm, strip dropout and split the composition weights before evaluating')
+    parser.add_argument('--dedup', action='store_true', help='encode each distinct sentence of a batch only once')
+    parser.add_argument('--tree-threads', default=1, type=int, help='number of threads building the trees of a batch')
+    parser.add_argument('--max-tree-depth', type=int, help='override the depth budget of the RL and STG trees, 0 builds the full tree')
     args = parser.parse_args()
     main(args)
 
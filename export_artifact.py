@@ -0,0 +1,31 @@
+"""
+Export a checkpoint of train.py or prune_vocab.py as a self-contained inference artifact
+(see utils/artifact.py), which evaluate.py and ARTreeEncoder load without any dataset.
+
+    python export_artifact.py --ckpt model.pkl --out model.artree
+"""
+import argparse
+import os
+import time
+
+import torch
+
+from utils.artifact import make_artifact, save_artifact, load_artifact
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt', required=True)
+    parser.add_argument('--out', required=True)
+    args = parser.parse_args()
+
+    loaded = torch.load(args.ckpt, map_location='cpu', weights_only=False)
+    save_artifact(make_artifact(loaded), args.out)
+    tic = time.time()
+    model, vocab, _ = load_artifact(args.out)
+    print(f'{args.out}: {os.path.getsize(args.out) / 2**20:.2f} MB, '
+          f'{len(vocab.id_to_word)} words, model loaded in {time.time() - tic:.3f} sec')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+from collections import OrderedDict
+
+import torch
+
+from model.SingleModel import SingleModel
+from model.PairModel import PairModel
+from utils.vocab import IdVocab
+from model.export import optimize_for_inference
+from utils import artifact
+
+
+class ARTreeEncoder(object):
+    """
+    Encode sentences into the sentence embedding h of a trained model.
+
+        encoder = ARTreeEncoder.from_checkpoint('model-3.00-0.850-0.845.pkl')
+        h = encoder.encode(['a good movie', ['not', 'bad']]) # (2, hidden_dim)
+        h, trees = encoder.encode(sentences, return_trees=True)
+
+    Sentences are strings (split on whitespace) or lists of tokens, and should be
+    tokenized (and lowercased) in the same way as the training data.
+    Unknown words are mapped to '<unk>', or to id 0 if the vocab has no '<unk>'.
+    Requests are batched by length, and the encodings of the last cache_size distinct
+    sentences are kept in an LRU cache keyed on their token ids.
+    """
+    def __init__(self, model, vocab, device='cpu', batch_size=128, cache_size=10000, optimize=False):
+        self.device = torch.device(device)
+        self.model = model.to(self.device)
+        self.model.eval()
+        if optimize:
+            self.model = optimize_for_inference(self.model)
+        self.vocab = vocab
+        self.unk_id = vocab.word_to_id.get('<unk>', 0)
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.cache = OrderedDict() # token ids -> (h, tree)
+        self.hits = self.misses = self.evictions = 0
+
+    @classmethod
+    def from_checkpoint(cls, path, vocab=None, **kwargs):
+        """
+        Args:
+            path: a model or full-state checkpoint written by train.py, prune_vocab.py,
+                or an inference artifact of export_artifact.py (loaded with mmap)
+            vocab: list of words indexed by id, or a data loader with id_to_word. Only
+                needed for checkpoints saved before the vocab was stored in them.
+            kwargs: device, batch_size, cache_size, optimize (see model.export), see __init__
+        """
+        loaded = artifact.load_file(path)
+        if artifact.is_artifact(loaded):
+            model, vocab = artifact.build_model(loaded)
+            return cls(model, vocab, **kwargs)
+        if vocab is None:
+            if 'vocab' not in loaded:
+                raise ValueError(f'{path} has no vocab, pass the vocab of its training data')
+            vocab = loaded['vocab']
+        elif hasattr(vocab, 'id_to_word'):
+            vocab = vocab.id_to_word
+        if isinstance(vocab, dict): # id -> word
+            vocab = [vocab[i] for i in range(len(vocab))]
+        vocab = IdVocab(vocab)
+
+        state_dict = loaded['model']
+        model_kwargs = dict(loaded['model_kwargs'])
+        model_kwargs.update({
+            'vocab': vocab,
+            'num_words': state_dict['word_embedding.weight'].size(0),
+            'num_classes': state_dict['classifier.clf_linear.weight'].size(0),
+            })
+        Model = PairModel if model_kwargs['data_type'] == 'snli' else SingleModel
+        model = Model(**model_kwargs)
+        model.load_state_dict(state_dict)
+        return cls(model, vocab, **kwargs)
+
+    @property
+    def hidden_dim(self):
+        return self.model.encoder.hidden_dim
+
+    def to_ids(self, sentence):
+        tokens = sentence.split() if isinstance(sentence, str) else sentence
+        return tuple(self.vocab.word_to_id.get(w, self.unk_id) for w in tokens)
+
+    def run_encoder(self, ids_list):
+        """
+        Args:
+            ids_list: list of token id tuples
+        Returns:
+            h: (len(ids_list), hidden_dim) on cpu
+            trees: list of Node, None for the Choi encoder
+        """
+        length = torch.LongTensor([len(ids) for ids in ids_list])
+        words = torch.zeros(len(ids_list), int(length.max()), dtype=torch.long)
+        for i, ids in enumerate(ids_list):
+            words[i, :len(ids)] = torch.LongTensor(ids)
+        h, trees, _ = self.forward_batch(words.to(self.device), length.to(self.device))
+        return h.cpu(), trees
+
+    def forward_batch(self, words, length):
+        """
+        Args:
+            words: (batch_size, max_len) padded token ids on self.device
+            length: (batch_size, )
+        Returns:
+            h: (batch_size, hidden_dim)
+            trees: list of Node, None for the Choi encoder
+            select_masks: compositions of the Choi encoder (see utils.helper), None for RL and STG
+        """
+        model = self.model
+        if model.model_type in {'RL', 'STG'} and model.encoder.rank_input == 'w':
+            model.encoder.update_score_table(model.word_embedding.weight)
+        words_embed = model.word_embedding(words)
+        select_masks = None
+        if model.model_type == 'Choi':
+            h, _, select_masks = model.encoder(input=words_embed, length=length, return_select_masks=True)
+            trees = [None] * len(length)
+        elif model.model_type == 'STG':
+            h, _, trees = model.encoder(words_embed, words, length)
+        elif model.model_type == 'RL':
+            h, _, trees, _ = model.encoder(words_embed, words, length)
+        return h, trees, select_masks
+
+    def encode(self, sentences, return_trees=False):
+        """
+        Args:
+            sentences: list of strings or token lists
+            return_trees: whether to also return the tree of each sentence
+        Returns:
+            h: (len(sentences), hidden_dim)
+            trees: list of Node, only if return_trees
+        """
+        if return_trees and self.model.model_type == 'Choi':
+            raise ValueError('the Choi encoder does not build explicit trees')
+        keys = [self.to_ids(s) for s in sentences]
+        for key in keys:
+            if len(key) == 0:
+                raise ValueError('can not encode an empty sentence')
+        results = {}
+        missing = []
+        for key in dict.fromkeys(keys): # distinct, in order
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                results[key] = self.cache[key]
+                self.hits += 1
+            else:
+                missing.append(key)
+                self.misses += 1
+        # similar lengths in a batch waste less padding
+        missing.sort(key=len)
+        with torch.no_grad():
+            for b in range(0, len(missing), self.batch_size):
+                batch = missing[b:b+self.batch_size]
+                h, trees = self.run_encoder(batch)
+                for key, h_i, tree in zip(batch, h, trees):
+                    # a copy, a row view would keep the whole batch alive in the cache
+                    h_i = h_i.clone()
+                    results[key] = (h_i, tree)
+                    self.put(key, (h_i, tree))
+        h = torch.stack([results[key][0] for key in keys]) if keys else torch.zeros(0, self.hidden_dim)
+        if return_trees:
+            return h, [results[key][1] for key in keys]
+        return h
+
+    def put(self, key, value):
+        if self.cache_size <= 0:
+            return
+        self.cache[key] = value
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+
+    def cache_info(self):
+        lookups = self.hits + self.misses
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.cache),
+                'max_size': self.cache_size,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.,
+                }
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.hits = self.misses = self.evictions = 0
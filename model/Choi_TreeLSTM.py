@@ -3,10 +3,9 @@ from torch import nn
 from torch.autograd import Variable
 from torch.nn import init, Parameter
 import numpy as np
-from IPython import embed
 
 from . import basic
-import conf
+from utils import timing, profiling
 
 
 class BinaryTreeLSTMLayer(nn.Module):
@@ -22,6 +21,7 @@ class BinaryTreeLSTMLayer(nn.Module):
         init.kaiming_normal(self.comp_linear.weight.data)
         init.constant(self.comp_linear.bias.data, val=0)
 
+    @profiling.ranged('treelstm_layer')
     def forward(self, l=None, r=None):
         """
         Args:
@@ -141,6 +141,7 @@ class BinaryTreeLSTM(nn.Module):
         # Note interval_lens must be FloatTensor
         interval_lens = length_mask.clone().float()
 
+        timing.begin('leaf_rnn')
         if self.leaf_rnn_type in {'lstm', 'bilstm'}:
             hs = []
             cs = []
@@ -181,9 +182,11 @@ class BinaryTreeLSTM(nn.Module):
                 hs = torch.cat([hs, hs_bw], dim=2)
                 cs = torch.cat([cs, cs_bw], dim=2)
             state = (hs, cs, interval_lens)
+        timing.end()
         nodes = []
         if self.intra_attention:
             nodes.append(state[0])
+        timing.begin('tree')
         for i in range(max_depth - 1):
             h, c, lens = state
             if c is not None:
@@ -192,7 +195,8 @@ class BinaryTreeLSTM(nn.Module):
             else:
                 l = (h[:, :-1, :], None, lens[:, :-1])
                 r = (h[:, 1:, :], None, lens[:, 1:])  
-            new_state = self.treelstm_layer(l=l, r=r)
+            with timing.phase('composition'):
+                new_state = self.treelstm_layer(l=l, r=r)
             if i < max_depth - 2:
                 # We don't need to greedily select the composition in the
                 # last iteration, since it has only one option left.
@@ -208,6 +212,7 @@ class BinaryTreeLSTM(nn.Module):
                                       done_mask=done_mask)
             if self.intra_attention and i >= max_depth - 2:
                 nodes.append(state[0])
+        timing.end()
         h, c, lens = state
         if self.intra_attention:
             att_mask = torch.cat([length_mask, length_mask[:, 1:]], dim=1)
@@ -1,6 +1,12 @@
+from collections import defaultdict
+
 import torch
 from torch import nn
 from torch.nn import init
+import torch.nn.functional as F
+
+from model import basic
+from utils import timing
 
 class Classifier(nn.Module):
 
@@ -42,6 +48,7 @@ class Classifier(nn.Module):
         init.constant_(self.clf_linear.bias, val=0)
 
     def forward(self, pre, hyp):
+        timing.begin('classifier')
         f1 = pre
         f2 = hyp
         f3 = torch.abs(pre - hyp)
@@ -55,6 +62,7 @@ class Classifier(nn.Module):
             mlp_output = self.bn_mlp_output(mlp_output)
         mlp_output = self.dropout(mlp_output)
         logits = self.clf_linear(mlp_output)
+        timing.end()
         return logits
 
 
@@ -65,7 +73,7 @@ class PairModel(nn.Module):
         model_type = self.model_type = kwargs['model_type']
 
         if model_type == 'Choi':
-            from model.Choi_Treelstm import BinaryTreeLSTM
+            from model.Choi_TreeLSTM import BinaryTreeLSTM
             Encoder = BinaryTreeLSTM
         elif model_type == 'RL':
             from model.RL_AR_Tree import RL_AR_Tree
@@ -76,10 +84,14 @@ class PairModel(nn.Module):
 
 
         self.word_embedding = nn.Embedding(num_embeddings=kwargs['num_words'],
-                                           embedding_dim=kwargs['word_dim'])
+                                           embedding_dim=kwargs['word_dim'],
+                                           sparse=kwargs.get('sparse_embedding', False))
         self.encoder = Encoder(**kwargs)
         self.classifier = Classifier(**kwargs)
         self.dropout = nn.Dropout(kwargs['dropout'])
+        # encode each distinct sentence of a batch only once, e.g. the premise shared by several hypotheses
+        self.dedup = kwargs.get('dedup', False)
+        self.dedup_stats = basic.DedupStats()
         self.reset_parameters()
 
     def reset_parameters(self):
@@ -87,40 +99,81 @@ class PairModel(nn.Module):
         self.encoder.reset_parameters()
         self.classifier.reset_parameters()
 
+    @staticmethod
+    def merge_probs(pre_probs, hyp_probs):
+        """
+        The REINFORCE log-probabilities of a sampled (premise, hypothesis) pair, keyed by word.
+        """
+        merged = []
+        for pre_p, hyp_p in zip(pre_probs, hyp_probs):
+            probs = defaultdict(list)
+            for p in (pre_p, hyp_p):
+                for w, v in p.items():
+                    probs[w] += v
+            merged.append(probs)
+        return merged
+
     def forward(self, pre, pre_length, hyp, hyp_length):
-        pre_embeddings = self.word_embedding(pre)
-        hyp_embeddings = self.word_embedding(hyp)
-        pre_embeddings = self.dropout(pre_embeddings)
-        hyp_embeddings = self.dropout(hyp_embeddings)
+        """
+        Premises and hypotheses are encoded as one batch of 2*batch_size sentences,
+        padded to the longer of the two, and the outputs are split back.
+        Padding does not change the states of the words within the lengths.
+        With dedup, only the distinct sentences of the 2*batch_size are encoded.
+        """
+        batch_size = pre.size(0)
+        max_length = max(pre.size(1), hyp.size(1))
+        words = torch.cat([
+            F.pad(pre, (0, max_length - pre.size(1))),
+            F.pad(hyp, (0, max_length - hyp.size(1)))], dim=0)
+        length = torch.cat([pre_length, hyp_length], dim=0)
+        if self.dedup:
+            index, inverse = basic.unique_sentences(words, length)
+            self.dedup_stats.update(len(length), len(index))
+            words, length = words[index], length[index]
+        if not self.training and self.model_type in {'RL', 'STG'} and self.encoder.rank_input == 'w':
+            # tree structures become a lookup of precomputed word scores
+            self.encoder.update_score_table(self.word_embedding.weight)
+        with timing.phase('embedding'):
+            embeddings = self.word_embedding(words)
+            embeddings = self.dropout(embeddings)
 
         ############################################################################
         if self.model_type == 'Choi': 
             supplements = {}
-            pre_h, _, pre_select_masks = self.encoder(input=pre_embeddings, length=pre_length, return_select_masks=True)
-            hyp_h, _, hyp_select_masks = self.encoder(input=hyp_embeddings, length=hyp_length, return_select_masks=True)
+            h, _, select_masks = self.encoder(input=embeddings, length=length, return_select_masks=True)
+            if self.dedup:
+                h, select_masks = h[inverse], [m[inverse] for m in select_masks]
+            pre_h, hyp_h = h[:batch_size], h[batch_size:]
             logits = self.classifier(pre=pre_h, hyp=hyp_h)
-            supplements['pre_select_masks'] = pre_select_masks
-            supplements['hyp_select_masks'] = hyp_select_masks
+            supplements['pre_select_masks'] = [m[:batch_size] for m in select_masks]
+            supplements['hyp_select_masks'] = [m[batch_size:] for m in select_masks]
         ############################################################################
         elif self.model_type == 'STG':
-            pre_h, _, pre_tree = self.encoder(sentence_embedding=pre_embeddings, sentence_word=pre, length=pre_length)
-            hyp_h, _, hyp_tree = self.encoder(sentence_embedding=hyp_embeddings, sentence_word=hyp, length=hyp_length)
+            h, _, tree = self.encoder(sentence_embedding=embeddings, sentence_word=words, length=length)
+            if self.dedup:
+                h, tree = h[inverse], [tree[i] for i in inverse.tolist()]
+            pre_h, hyp_h = h[:batch_size], h[batch_size:]
             logits = self.classifier(pre=pre_h, hyp=hyp_h)
-            supplements = {'pre_tree': pre_tree, 'hyp_tree': hyp_tree}
+            supplements = {'pre_tree': tree[:batch_size], 'hyp_tree': tree[batch_size:]}
         ############################################################################
         elif self.model_type == 'RL':
-            pre_h, _, pre_tree, pre_samples = self.encoder(sentence_embedding=pre_embeddings, sentence_word=pre, length=pre_length)
-            hyp_h, _, hyp_tree, hyp_samples = self.encoder(sentence_embedding=hyp_embeddings, sentence_word=hyp, length=hyp_length)
+            h, _, tree, samples = self.encoder(sentence_embedding=embeddings, sentence_word=words, length=length)
+            if self.dedup:
+                h, tree = h[inverse], [tree[i] for i in inverse.tolist()]
+                samples = basic.expand_samples(samples, inverse)
+            pre_h, hyp_h = h[:batch_size], h[batch_size:]
             logits = self.classifier(pre=pre_h, hyp=hyp_h)
-            supplements = {'pre_tree': pre_tree, 'hyp_tree': hyp_tree}
-            # samples prediction for REINFORCE
-            sample_logits = self.classifier(pre=pre_samples['h'], hyp=hyp_samples['h'])
+            supplements = {'pre_tree': tree[:batch_size], 'hyp_tree': tree[batch_size:]}
+            # samples prediction for REINFORCE, sample j of sentence i is at i*sample_num+j
+            num_samples = len(samples['trees']) // 2
+            sample_logits = self.classifier(pre=samples['h'][:num_samples], hyp=samples['h'][num_samples:])
             supplements['sample_logits'] = sample_logits
-            supplements['pre_probs'] = pre_samples['probs']
-            supplements['hyp_probs'] = hyp_samples['probs']
-            supplements['pre_sample_trees'] = pre_samples['trees']
-            supplements['hyp_sample_trees'] = hyp_samples['trees']
+            supplements['pre_probs'] = samples['probs'][:num_samples]
+            supplements['hyp_probs'] = samples['probs'][num_samples:]
+            supplements['probs'] = self.merge_probs(supplements['pre_probs'], supplements['hyp_probs'])
+            supplements['pre_sample_trees'] = samples['trees'][:num_samples]
+            supplements['hyp_sample_trees'] = samples['trees'][num_samples:]
+            supplements['sample_trees'] = list(zip(supplements['pre_sample_trees'], supplements['hyp_sample_trees']))
         ############################################################################
 
         return logits, supplements
-
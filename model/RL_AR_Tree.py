@@ -5,8 +5,9 @@ from torch.nn.functional import log_softmax, softmax
 from collections import defaultdict
 
 from . import basic
-from .basic import TriPadLSTMLayer, Node
+from .basic import TriPadLSTMLayer, Node, parallel_map
 import numpy as np
+from utils import timing, profiling
 import random
 
 
@@ -18,6 +19,12 @@ class RL_AR_Tree(nn.Module):
         self.leaf_rnn_type = kwargs['leaf_rnn_type'] 
         self.sample_num = kwargs.get('sample_num', 3) 
         self.rank_input = kwargs['rank_input'] 
+        self.tree_threads = kwargs.get('tree_threads') or 1 # build the trees of a batch concurrently
+        # split long inputs into segments, whose roots are composed by a second-level tree
+        self.chunk_size = kwargs.get('chunk_size') or 0
+        # spans below this depth are pooled into one leaf, 0 builds the full tree
+        self.max_tree_depth = kwargs.get('max_tree_depth') or 0
+        self.boundary_ids = basic.sentence_boundary_ids(self.vocab) if kwargs.get('chunk_by') == 'sentence' else frozenset()
         word_dim = kwargs['word_dim']
         hidden_dim = self.hidden_dim = kwargs['hidden_dim'] 
         assert self.vocab.id_to_word
@@ -43,6 +50,15 @@ class RL_AR_Tree(nn.Module):
                 nn.ReLU(),
                 nn.Linear(in_features=128, out_features=1, bias=False),
             )
+        if self.chunk_size:
+            # ranks the segments by their embedding h
+            self.chunk_rank = nn.Sequential(
+                    nn.Linear(in_features=hidden_dim, out_features=128, bias=False),
+                    nn.ReLU(),
+                    nn.Linear(in_features=128, out_features=1, bias=False),
+                )
+        # scores of all words for rank_input 'w' at test time, see update_score_table
+        self.score_table = self.score_table_version = None
         self.reset_parameters()
 
     def reset_parameters(self):
@@ -63,6 +79,10 @@ class RL_AR_Tree(nn.Module):
         for layer in self.rank:
             if type(layer)==nn.Linear:
                 init.kaiming_normal_(layer.weight.data)
+        if self.chunk_size:
+            for layer in self.chunk_rank:
+                if type(layer)==nn.Linear:
+                    init.kaiming_normal_(layer.weight.data)
 
 
     def calc_score(self, x):
@@ -70,14 +90,45 @@ class RL_AR_Tree(nn.Module):
         return s
 
 
-    def greedy_build(self, sentence, embedding, hs, cs, start, end, collector):
+    def batch_scores(self, sentence_embedding, sentence_word, hs):
+        """
+        Scores of all the words of a batch, (batch_size, max_length, 1). The rank MLP
+        scores each word independently, so the scores of a span are a slice of them.
+        """
+        if self.rank_input == 'h':
+            return self.calc_score(hs)
+        if self.score_table is not None and not self.training:
+            return self.score_table[sentence_word]
+        return self.calc_score(sentence_embedding)
+
+
+    def update_score_table(self, word_embedding):
+        """
+        With rank_input 'w', the score of a word at test time only depends on its id, so
+        keep the scores of the whole vocab. They are recomputed when the embedding or the
+        rank weights have been changed in place since, e.g. by the optimizer or load_state_dict.
+        Args:
+            word_embedding: (num_words, word_dim), weight of the word embedding
+        """
+        params = [word_embedding] + list(self.rank.parameters())
+        version = tuple((p.data_ptr(), p._version) for p in params)
+        if version != self.score_table_version:
+            with torch.no_grad():
+                self.score_table = self.calc_score(word_embedding)
+            self.score_table_version = version
+
+
+    @profiling.ranged('greedy_build')
+    def greedy_build(self, sentence, scores, hs, cs, start, end, collector, max_depth=None):
         """
         Args:
+            scores: (length, 1). rank scores of the words
             hs: (length, 1, hidden_dim)
             cs: (length, 1, hidden_dim)
             start: int
             end: int
             collector: dict
+            max_depth: levels of words left to place, the span is pooled at 0. None for no limit
         Output:
             h, c: (1, hidden_dim), embedding of sentence[start:end]
             all probabilities 
@@ -87,33 +138,40 @@ class RL_AR_Tree(nn.Module):
         elif end == start+1:
             root = Node(sentence[start])
             return (hs[start], cs[start]), root 
+        elif max_depth == 0:
+            return basic.pooled_leaf(sentence, hs, cs, start, end)
         
-        scores = self.calc_score(embedding[start:end])
-        pos = start + torch.max(scores, dim=0)[1].item()
+        span_scores = scores[start:end]
+        pos = start + torch.max(span_scores, dim=0)[1].item()
         word = sentence[pos]
-        collector[word].append((end - start) * log_softmax(scores, dim=0)[pos-start])
+        collector[word].append((end - start) * log_softmax(span_scores, dim=0)[pos-start])
 
-        left_state, left_tree = self.greedy_build(sentence, embedding, hs, cs, start, pos, collector)
-        right_state, right_tree = self.greedy_build(sentence, embedding, hs, cs, pos+1, end, collector)
+        max_depth = None if max_depth is None else max_depth - 1
+        left_state, left_tree = self.greedy_build(sentence, scores, hs, cs, start, pos, collector, max_depth)
+        right_state, right_tree = self.greedy_build(sentence, scores, hs, cs, pos+1, end, collector, max_depth)
         output_state = self.treelstm_layer(left_state, right_state, (hs[pos], cs[pos]))
         root = Node(word, left_tree, right_tree)
         return output_state, root
 
 
-    def sample(self, sentence, embedding, hs, cs, start, end, collector):
+    @profiling.ranged('sample')
+    def sample(self, sentence, scores, hs, cs, start, end, collector, rng=random, max_depth=None):
         """
         To sample a tree structure for REINFORCE.
+        rng: the random module, or a random.Random of the sentence when trees are built in threads
+        max_depth: see greedy_build
         """
         if end == start:
             return None, None
         elif end == start+1:
             root = Node(sentence[start])
             return (hs[start], cs[start]), root 
+        elif max_depth == 0:
+            return basic.pooled_leaf(sentence, hs, cs, start, end)
 
-        scores = self.calc_score(embedding[start:end])
-        probs = softmax(scores, dim=0)
+        probs = softmax(scores[start:end], dim=0)
         cum = 0
-        p = random.random()
+        p = rng.random()
         pos = end - 1
         for i in range(start, end):
             cum = cum + probs[i-start].item()
@@ -123,8 +181,9 @@ class RL_AR_Tree(nn.Module):
         word = sentence[pos]
         collector[word].append((end - start) * torch.log(1e-9 + probs[pos-start]))  # collect log-probability of pos-th word
 
-        left_state, left_tree = self.sample(sentence, embedding, hs, cs, start, pos, collector)
-        right_state, right_tree = self.sample(sentence, embedding, hs, cs, pos+1, end, collector)
+        max_depth = None if max_depth is None else max_depth - 1
+        left_state, left_tree = self.sample(sentence, scores, hs, cs, start, pos, collector, rng, max_depth)
+        right_state, right_tree = self.sample(sentence, scores, hs, cs, pos+1, end, collector, rng, max_depth)
         output_state = self.treelstm_layer(left_state, right_state, (hs[pos], cs[pos]))
         root = Node(word, left_tree, right_tree)
         return output_state, root
@@ -137,7 +196,85 @@ class RL_AR_Tree(nn.Module):
             sentence_word: (batch_size, max_length). word id
             length: (batch_size, ). sentence length
         """
+        if self.chunk_size and (sentence_embedding.size(1) > self.chunk_size or self.boundary_ids):
+            return self.chunked_forward(sentence_embedding, sentence_word, length)
+        return self.flat_forward(sentence_embedding, sentence_word, length)
+
+
+    def chunked_forward(self, sentence_embedding, sentence_word, length):
+        """
+        Encode the segments of all sentences as one batch, then build a tree over the
+        segments of each sentence, in which a segment is composed from its (h, c) like a word.
+        Sample j of a sentence composes the sample j of its segments.
+        """
+        chunk_embedding, chunk_word, chunk_length, doc_chunks = basic.split_chunks(
+                sentence_embedding, sentence_word, length, self.chunk_size, self.boundary_ids)
+        hs, cs, chunk_trees, chunk_samples = self.flat_forward(chunk_embedding, chunk_word, chunk_length)
+        sample_num = len(chunk_samples['trees']) // len(chunk_trees)
+
+        def compose(args):
+            (first, end), rng = args
+            num = end - first
+            segments = list(range(num)) # the decisions of this level are collected under segment indices
+            scores = chunk_scores[first:end]
+            probs = defaultdict(list)
+            state, top = self.greedy_build(segments, scores, hs[first:end].unsqueeze(1), cs[first:end].unsqueeze(1), 0, num, probs)
+            greedy = (state, basic.graft_tree(top, chunk_trees[first:end]))
+
+            sampled = []
+            for j in range(sample_num):
+                ks = [k * sample_num + j for k in range(first, end)]
+                sample_probs = defaultdict(list)
+                for k in ks:
+                    for w, p in chunk_samples['probs'][k].items():
+                        sample_probs[w] += p
+                if j == 0: # the greedy tree over the greedy segment trees
+                    for w, p in probs.items():
+                        sample_probs[w] += p
+                    state, tree = greedy
+                else:
+                    state, top = self.sample(segments, scores, chunk_samples['h'][ks].unsqueeze(1),
+                                             chunk_samples['c'][ks].unsqueeze(1), 0, num, sample_probs, rng)
+                    tree = basic.graft_tree(top, [chunk_samples['trees'][k] for k in ks])
+                sampled.append((state, sample_probs, tree))
+            return greedy, sampled
+
+        if self.tree_threads > 1:
+            jobs = [(span, random.Random(random.getrandbits(64))) for span in doc_chunks]
+        else:
+            jobs = [(span, random) for span in doc_chunks]
+        with timing.phase('tree'):
+            chunk_scores = self.chunk_rank(hs)
+            results = parallel_map(compose, jobs, self.tree_threads)
+        return self.collect(results)
+
+
+    def collect(self, results):
+        """
+        Stack the (greedy, sampled) results of the sentences of a batch.
+        """
+        h_res, c_res, structure, samples = [], [], [], {}
+        samples['h'], samples['c'], samples['probs'], samples['trees'] = [], [], [], []
+        for (state, tree), sampled in results:
+            h, c = state
+            h_res.append(h)
+            c_res.append(c)
+            structure.append(tree)
+            for sample_state, probs, sample_tree in sampled:
+                samples['h'].append(sample_state[0])
+                samples['c'].append(sample_state[1])
+                samples['probs'].append(probs) # a list of dict of Variable
+                samples['trees'].append(sample_tree)
+        h_res, c_res = torch.stack(h_res, dim=0), torch.stack(c_res, dim=0)
+        h_res, c_res = h_res.squeeze(1), c_res.squeeze(1)
+        samples['h'] = torch.stack(samples['h'], dim=0).squeeze(1)
+        samples['c'] = torch.stack(samples['c'], dim=0).squeeze(1)
+        return h_res, c_res, structure, samples
+
+
+    def flat_forward(self, sentence_embedding, sentence_word, length):
         batch_size, max_length, _ = sentence_embedding.size()
+        timing.begin('leaf_rnn')
         if self.leaf_rnn_type in {'bilstm', 'lstm'}:
             hs = []
             cs = []
@@ -176,40 +313,40 @@ class RL_AR_Tree(nn.Module):
                     inputs=cs_bw, lengths=lengths_list, batch_first=True)
                 hs = torch.cat([hs, hs_bw], dim=2)
                 cs = torch.cat([cs, cs_bw], dim=2)
+        timing.end()
 
-        h_res, c_res, structure, samples = [], [], [], {}
-        samples['h'], samples['probs'], samples['trees'] = [], [], []
         length = length.tolist() 
         
-        # iterate each sentence
-        for i in range(batch_size):
+        def encode(args):
+            i, rng = args
             sentence = list(map(lambda i: self.vocab.id_to_word[i], sentence_word[i].tolist()))
 
-            if self.rank_input == 'w':
-                embedding = sentence_embedding[i]
-            elif self.rank_input == 'h':
-                embedding = hs[i]
-
-            # calculate global scores for each word
             probs = defaultdict(list)
-            state, tree = self.greedy_build(sentence, embedding, hs[i].unsqueeze(1), cs[i].unsqueeze(1), 0, length[i], probs)
-            h, c = state
-            h_res.append(h)
-            c_res.append(c)
-            structure.append(tree)
-            
+            state, tree = self.greedy_build(sentence, scores[i], hs[i].unsqueeze(1), cs[i].unsqueeze(1), 0, length[i], probs, max_depth)
+            greedy = (state, tree)
+
             ##################################
             # Monte Carlo
-            for j in range(self.sample_num):
+            sampled = []
+            for j in range(sample_num):
                 if j > 0: # if j==0, just use the state+probs from greedy_build
                     probs = defaultdict(list)
-                    state, tree = self.sample(sentence, embedding, hs[i].unsqueeze(1), cs[i].unsqueeze(1), 0, length[i], probs)
-                samples['h'].append(state[0])
-                samples['probs'].append(probs) # a list of dict of Variable
-                samples['trees'].append(tree)
-        h_res, c_res = torch.stack(h_res, dim=0), torch.stack(c_res, dim=0)
-        h_res, c_res = h_res.squeeze(1), c_res.squeeze(1)
-        samples['h'] = torch.stack(samples['h'], dim=0).squeeze(1)
+                    state, tree = self.sample(sentence, scores[i], hs[i].unsqueeze(1), cs[i].unsqueeze(1), 0, length[i], probs, rng, max_depth)
+                sampled.append((state, probs, tree))
+            return greedy, sampled
 
-        return h_res, c_res, structure, samples
+        sample_num = self.sample_num
+        max_depth = self.max_tree_depth or None
+        if self.tree_threads > 1:
+            # draw the seeds in order, so that the samples do not depend on thread scheduling
+            jobs = [(i, random.Random(random.getrandbits(64))) for i in range(batch_size)]
+        else:
+            jobs = [(i, random) for i in range(batch_size)]
+        timing.begin('tree')
+        # calculate global scores for each word
+        scores = self.batch_scores(sentence_embedding, sentence_word, hs)
+        # iterate each sentence, sentences are independent so they may run in threads
+        results = parallel_map(encode, jobs, self.tree_threads)
+        timing.end()
+        return self.collect(results)
 
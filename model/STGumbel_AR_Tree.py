@@ -2,9 +2,10 @@ import torch
 from torch import nn
 from torch.nn import init
 import torch.nn.functional as F
-from .basic import TriPadLSTMLayer, Node, reverse_padded_sequence, greedy_select
+from . import basic
+from .basic import TriPadLSTMLayer, Node, reverse_padded_sequence, greedy_select, parallel_map
 import numpy as np
-from IPython import embed
+from utils import timing, profiling
 
 
 class STGumbel_AR_Tree(nn.Module):
@@ -15,6 +16,12 @@ class STGumbel_AR_Tree(nn.Module):
         self.leaf_rnn_type = kwargs['leaf_rnn_type'] 
         self.rank_input = kwargs['rank_input'] 
         self.temperature = 1
+        self.tree_threads = kwargs.get('tree_threads') or 1 # build the trees of a batch concurrently
+        # split long inputs into segments, whose roots are composed by a second-level tree
+        self.chunk_size = kwargs.get('chunk_size') or 0
+        # spans below this depth are pooled into one leaf, 0 builds the full tree
+        self.max_tree_depth = kwargs.get('max_tree_depth') or 0
+        self.boundary_ids = basic.sentence_boundary_ids(self.vocab) if kwargs.get('chunk_by') == 'sentence' else frozenset()
         word_dim = kwargs['word_dim']
         hidden_dim = self.hidden_dim = kwargs['hidden_dim'] 
         assert self.vocab.id_to_word
@@ -38,6 +45,15 @@ class STGumbel_AR_Tree(nn.Module):
                 nn.ReLU(),
                 nn.Linear(in_features=128, out_features=1, bias=False),
             )
+        if self.chunk_size:
+            # ranks the segments by their embedding h
+            self.chunk_rank = nn.Sequential(
+                    nn.Linear(in_features=hidden_dim, out_features=128, bias=False),
+                    nn.ReLU(),
+                    nn.Linear(in_features=128, out_features=1, bias=False),
+                )
+        # scores of all words for rank_input 'w' at test time, see update_score_table
+        self.score_table = self.score_table_version = None
         self.reset_parameters()
 
     def reset_parameters(self):
@@ -58,6 +74,10 @@ class STGumbel_AR_Tree(nn.Module):
         for layer in self.rank:
             if type(layer)==nn.Linear:
                 init.kaiming_normal_(layer.weight.data)
+        if self.chunk_size:
+            for layer in self.chunk_rank:
+                if type(layer)==nn.Linear:
+                    init.kaiming_normal_(layer.weight.data)
 
 
     def calc_score(self, x):
@@ -65,15 +85,46 @@ class STGumbel_AR_Tree(nn.Module):
         return s
 
 
-    def build(self, sentence, embedding, hs, cs, start, end):
+    def batch_scores(self, sentence_embedding, sentence_word, hs):
+        """
+        Scores of all the words of a batch, (batch_size, max_length, 1). The rank MLP
+        scores each word independently, so the scores of a span are a slice of them.
+        """
+        if self.rank_input == 'h':
+            return self.calc_score(hs)
+        if self.score_table is not None and not self.training:
+            return self.score_table[sentence_word]
+        return self.calc_score(sentence_embedding)
+
+
+    def update_score_table(self, word_embedding):
+        """
+        With rank_input 'w', the score of a word at test time only depends on its id, so
+        keep the scores of the whole vocab. They are recomputed when the embedding or the
+        rank weights have been changed in place since, e.g. by the optimizer or load_state_dict.
+        Args:
+            word_embedding: (num_words, word_dim), weight of the word embedding
+        """
+        params = [word_embedding] + list(self.rank.parameters())
+        version = tuple((p.data_ptr(), p._version) for p in params)
+        if version != self.score_table_version:
+            with torch.no_grad():
+                self.score_table = self.calc_score(word_embedding)
+            self.score_table_version = version
+
+
+    @profiling.ranged('build')
+    def build(self, sentence, scores, hs, cs, start, end, max_depth=None, generator=None):
         """
         Args:
             sentence: list of string
-            embedding: Tensor. hidden embedding to build the tree
+            scores: (length, 1). rank scores of the words
             hs: (length, hidden_dim)
             cs: (length, hidden_dim)
             start: int
             end: int
+            max_depth: levels of words left to place, the span is pooled at 0. None for no limit
+            generator: torch.Generator of the gumbel noise of this sentence, None for the global rng
         Output:
             h, c: (1, hidden_dim), embedding of sentence[start:end]
             root: (Node)
@@ -83,9 +134,13 @@ class STGumbel_AR_Tree(nn.Module):
         elif end == start+1:
             root = Node(sentence[start])
             return (hs[start].unsqueeze(0), cs[start].unsqueeze(0)), root
+        elif max_depth == 0:
+            return basic.pooled_leaf(sentence, hs.unsqueeze(1), cs.unsqueeze(1), start, end)
         
-        logits = self.calc_score(embedding[start:end])
-        if self.training:
+        logits = scores[start:end]
+        if self.training and generator is not None:
+            gate = basic.st_gumbel_softmax(logits.t(), generator=generator) # (1, end-start)
+        elif self.training:
             gate = F.gumbel_softmax(logits.t(), tau=1, hard=True) # (1, end-start)
         else:
             gate = greedy_select(logits.t()) # (1, end-start)
@@ -93,13 +148,27 @@ class STGumbel_AR_Tree(nn.Module):
         c = torch.matmul(gate, cs[start:end]) # (1, hidden_dim)
         pos = start + torch.max(gate, dim=1)[1].item()
 
-        left_state, left_tree = self.build(sentence, embedding, hs, cs, start, pos)
-        right_state, right_tree = self.build(sentence, embedding, hs, cs, pos+1, end)
+        max_depth = None if max_depth is None else max_depth - 1
+        left_state, left_tree = self.build(sentence, scores, hs, cs, start, pos, max_depth, generator)
+        right_state, right_tree = self.build(sentence, scores, hs, cs, pos+1, end, max_depth, generator)
         output_state = self.treelstm_layer(left_state, right_state, (h, c))
         root = Node(sentence[pos], left_tree, right_tree)
         return output_state, root 
 
 
+    def noise_generators(self, num, device):
+        """
+        One generator of gumbel noise per tree when the trees are built by threads, seeded
+        in order so that the noise does not depend on thread scheduling, like the samples of RL.
+        Returns:
+            list of torch.Generator, or of None to use the global rng
+        """
+        if not (self.training and self.tree_threads > 1):
+            return [None] * num
+        seeds = torch.randint(2**62, (num,)).tolist()
+        return [torch.Generator(device=device).manual_seed(seed) for seed in seeds]
+
+
     def forward(self, sentence_embedding, sentence_word, length):
         """
         Args:
@@ -109,7 +178,43 @@ class STGumbel_AR_Tree(nn.Module):
                             if it is a list, it contains strings directly
             length: (batch_size, ). sentence length
         """
+        if self.chunk_size and (sentence_embedding.size(1) > self.chunk_size or self.boundary_ids):
+            return self.chunked_forward(sentence_embedding, sentence_word, length)
+        return self.flat_forward(sentence_embedding, sentence_word, length)
+
+
+    def chunked_forward(self, sentence_embedding, sentence_word, length):
+        """
+        Encode the segments of all sentences as one batch, then build a tree over the
+        segments of each sentence, in which a segment is composed from its (h, c) like a word.
+        """
+        chunk_embedding, chunk_word, chunk_length, doc_chunks = basic.split_chunks(
+                sentence_embedding, sentence_word, length, self.chunk_size, self.boundary_ids)
+        hs, cs, chunk_trees = self.flat_forward(chunk_embedding, chunk_word, chunk_length)
+
+        def compose(job):
+            (first, end), generator = job
+            state, top = self.build(list(range(end - first)), chunk_scores[first:end], hs[first:end], cs[first:end], 0, end - first,
+                                    generator=generator)
+            return state, basic.graft_tree(top, chunk_trees[first:end])
+
+        h_res, c_res, structure = [], [], []
+        timing.begin('tree')
+        chunk_scores = self.chunk_rank(hs)
+        jobs = list(zip(doc_chunks, self.noise_generators(len(doc_chunks), hs.device)))
+        for (h, c), tree in parallel_map(compose, jobs, self.tree_threads):
+            h_res.append(h)
+            c_res.append(c)
+            structure.append(tree)
+        timing.end()
+        h_res, c_res = torch.stack(h_res), torch.stack(c_res)
+        h_res, c_res = h_res.squeeze(1), c_res.squeeze(1)
+        return h_res, c_res, structure
+
+
+    def flat_forward(self, sentence_embedding, sentence_word, length):
         batch_size = length.size(0)
+        timing.begin('leaf_rnn')
         if self.leaf_rnn_type in {'bilstm', 'lstm'}:
             max_length = sentence_embedding.size(1)
             hs = []
@@ -149,23 +254,26 @@ class STGumbel_AR_Tree(nn.Module):
                     inputs=cs_bw, lengths=lengths_list, batch_first=True)
                 hs = torch.cat([hs, hs_bw], dim=2)
                 cs = torch.cat([cs, cs_bw], dim=2) # (batch_size, max_len, dim_h)
+        timing.end()
 
-        h_res, c_res, structure = [], [], []
-        # iterate each sentence
-        for i in range(batch_size):
+        def encode(job):
+            i, generator = job
             sentence = list(map(lambda j: self.vocab.id_to_word[j], sentence_word[i].tolist()))
+            return self.build(sentence, scores[i], hs[i], cs[i], 0, lengths[i], self.max_tree_depth or None, generator)
 
-            if self.rank_input == 'w':
-                embedding = sentence_embedding[i]
-            elif self.rank_input == 'h':
-                embedding = hs[i]
-
-            # calculate scores for each word
-            state, tree = self.build(sentence, embedding, hs[i], cs[i], 0, length[i].item())
+        h_res, c_res, structure = [], [], []
+        lengths = length.tolist()
+        timing.begin('tree')
+        # calculate scores for each word
+        scores = self.batch_scores(sentence_embedding, sentence_word, hs)
+        # iterate each sentence, sentences are independent so they may run in threads
+        jobs = list(zip(range(batch_size), self.noise_generators(batch_size, hs.device)))
+        for state, tree in parallel_map(encode, jobs, self.tree_threads):
             h, c = state
             h_res.append(h)
             c_res.append(c)
             structure.append(tree)
+        timing.end()
             
         h_res, c_res = torch.stack(h_res), torch.stack(c_res)
         h_res, c_res = h_res.squeeze(1), c_res.squeeze(1)
@@ -1,6 +1,9 @@
 from torch import nn
 from torch.nn import init
 
+from model import basic
+from utils import timing
+
 class Classifier(nn.Module):
 
     def __init__(self, **kwargs):
@@ -38,6 +41,7 @@ class Classifier(nn.Module):
         init.constant_(self.clf_linear.bias, val=0)
 
     def forward(self, sentence):
+        timing.begin('classifier')
         mlp_input = sentence
         if self.use_batchnorm:
             mlp_input = self.bn_mlp_input(mlp_input)
@@ -47,6 +51,7 @@ class Classifier(nn.Module):
             mlp_output = self.bn_mlp_output(mlp_output)
         mlp_output = self.dropout(mlp_output)
         logits = self.clf_linear(mlp_output)
+        timing.end()
         return logits
 
 
@@ -57,7 +62,7 @@ class SingleModel(nn.Module):
         model_type = self.model_type = kwargs['model_type']
 
         if model_type == 'Choi':
-            from model.Choi_Treelstm import BinaryTreeLSTM
+            from model.Choi_TreeLSTM import BinaryTreeLSTM
             Encoder = BinaryTreeLSTM
         elif model_type == 'RL':
             from model.RL_AR_Tree import RL_AR_Tree
@@ -67,30 +72,49 @@ class SingleModel(nn.Module):
             Encoder = STGumbel_AR_Tree
 
         self.word_embedding = nn.Embedding(num_embeddings=kwargs['num_words'],
-                                           embedding_dim=kwargs['word_dim'])
+                                           embedding_dim=kwargs['word_dim'],
+                                           sparse=kwargs.get('sparse_embedding', False))
         self.encoder = Encoder(**kwargs)
         self.classifier = Classifier(**kwargs)
         self.dropout = nn.Dropout(kwargs['dropout'])
+        # encode each distinct sentence of a batch only once
+        self.dedup = kwargs.get('dedup', False)
+        self.dedup_stats = basic.DedupStats()
         init.normal_(self.word_embedding.weight, mean=0, std=0.01)
         self.classifier.reset_parameters()
 
     def forward(self, words, length):
-        words_embed = self.word_embedding(words)
-        words_embed = self.dropout(words_embed)
+        if self.dedup:
+            index, inverse = basic.unique_sentences(words, length)
+            self.dedup_stats.update(len(length), len(index))
+            words, length = words[index], length[index]
+        if not self.training and self.model_type in {'RL', 'STG'} and self.encoder.rank_input == 'w':
+            # tree structures become a lookup of precomputed word scores
+            self.encoder.update_score_table(self.word_embedding.weight)
+        with timing.phase('embedding'):
+            words_embed = self.word_embedding(words)
+            words_embed = self.dropout(words_embed)
 
         ############################################################################
         if self.model_type == 'Choi': 
             h, _, select_masks = self.encoder(input=words_embed, length=length, return_select_masks=True)
+            if self.dedup:
+                h, select_masks = h[inverse], [m[inverse] for m in select_masks]
             logits = self.classifier(h)
             supplements = {'select_masks': select_masks}
         ############################################################################
         elif self.model_type == 'STG':
             h, _, tree = self.encoder(words_embed, words, length)
+            if self.dedup:
+                h, tree = h[inverse], [tree[i] for i in inverse.tolist()]
             logits = self.classifier(h)
             supplements = {'tree': tree}
         ############################################################################
         elif self.model_type == 'RL':
             h, _, tree, samples = self.encoder(words_embed, words, length)
+            if self.dedup:
+                h, tree = h[inverse], [tree[i] for i in inverse.tolist()]
+                samples = basic.expand_samples(samples, inverse)
             logits = self.classifier(h)
             supplements = {'tree': tree}
             # samples prediction for REINFORCE
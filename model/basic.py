@@ -1,13 +1,19 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 from torch import nn
 from torch.nn import functional, init, Parameter
 import numpy as np
 
+from utils import timing
+
 class Node():
-    def __init__(self, word, left=None, right=None):
+    def __init__(self, word, left=None, right=None, num_words=1):
         self.word = word
         self.left = left
         self.right = right
+        self.num_words = num_words # > 1 for a pooled leaf of a depth-budgeted tree
 
 
 class NaryLSTMLayer(nn.Module): # N-ary Tree-LSTM in the paper of treelstm
@@ -52,12 +58,41 @@ class TriPadLSTMLayer(nn.Module): # used in my paper
         self.hidden_dim = hidden_dim
         self.comp_linear = nn.Linear(in_features=3 * hidden_dim,
                                     out_features=6 * hidden_dim)
+        self.comp_split = None # per-child weight blocks, see split_comp_linear
         self.reset_parameters()
 
     def reset_parameters(self):
         init.kaiming_normal_(self.comp_linear.weight.data)
         init.constant_(self.comp_linear.bias.data, val=0)
 
+    def split_comp_linear(self):
+        """
+        For inference: keep the weight blocks of the left, middle and right child apart,
+        (hidden_dim, 6*hidden_dim) each, so that missing children cost no matmul.
+        They are snapshots, call it again after the weights change.
+        """
+        with torch.no_grad():
+            blocks = self.comp_linear.weight.chunk(3, dim=1)
+            self.comp_split = tuple(b.t().contiguous() for b in blocks)
+
+    def split_forward(self, l, r, m):
+        w_l, w_m, w_r = self.comp_split
+        hm, cm = m
+        comp_vector = torch.addmm(self.comp_linear.bias, hm, w_m)
+        if l is not None:
+            comp_vector = comp_vector.addmm(l[0], w_l)
+        if r is not None:
+            comp_vector = comp_vector.addmm(r[0], w_r)
+        i, fl, fm, fr, u, o = torch.chunk(comp_vector, chunks=6, dim=1)
+        c = cm*(fm+1).sigmoid() + u.tanh()*i.sigmoid()
+        if l is not None:
+            c = c + l[1]*(fl+1).sigmoid()
+        if r is not None:
+            c = c + r[1]*(fr+1).sigmoid()
+        h = o.sigmoid() * c.tanh()
+        return h, c
+
+    @timing.timed('composition')
     def forward(self, l=None, r=None, m=None):
         """
         Args:
@@ -67,6 +102,8 @@ class TriPadLSTMLayer(nn.Module): # used in my paper
         Returns:
             h, c : The hidden and cell state of the composed parent
         """
+        if self.comp_split is not None:
+            return self.split_forward(l, r, m)
         hm, cm = m
         zero = torch.zeros(1, self.hidden_dim).to(hm.device)
         if l is None:
@@ -264,7 +301,7 @@ def greedy_select(logits, mask=None):
     return one_hot
 
 
-def st_gumbel_softmax(logits, temperature=1.0, mask=None):
+def st_gumbel_softmax(logits, temperature=1.0, mask=None, generator=None):
     """
     Return the result of Straight-Through Gumbel-Softmax Estimation.
     It approximates the discrete sampling via Gumbel-Softmax trick
@@ -282,12 +319,13 @@ def st_gumbel_softmax(logits, temperature=1.0, mask=None):
             so that indices of '0' mask values are not selected.
             The size is (batch_size, num_classes).
         weights (Tensor, optional) : Must have the same size with mask
+        generator (torch.Generator, optional): draws the noise instead of the global rng
     Returns:
         y: The sampled output, which has the property explained above.
     """
 
     eps = 1e-20
-    u = logits.data.new(*logits.size()).uniform_(0.001, 0.999)
+    u = logits.data.new(*logits.size()).uniform_(0.001, 0.999, generator=generator)
     gumbel_noise = -torch.log(-torch.log(u + eps) + eps)
     y = logits + gumbel_noise
     y = masked_softmax(logits=y / temperature, mask=mask)
@@ -340,3 +378,162 @@ def reverse_padded_sequence(inputs, lengths, batch_first=False):
     if not batch_first:
         reversed_inputs = reversed_inputs.transpose(0, 1)
     return reversed_inputs
+
+
+_tree_pools = {}
+
+
+def parallel_map(fn, items, num_threads):
+    """
+    [fn(x) for x in items], run by a pool of num_threads threads when num_threads > 1.
+    Torch ops release the GIL, so the per-sentence tree builds of a batch overlap.
+    The grad mode of the caller is applied in the worker threads, since it is thread local.
+    """
+    items = list(items)
+    if num_threads <= 1 or len(items) <= 1:
+        return [fn(x) for x in items]
+    # one pool per process, pools are not inherited by forked children
+    key = (os.getpid(), num_threads)
+    if key not in _tree_pools:
+        _tree_pools[key] = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='tree')
+    grad_enabled = torch.is_grad_enabled()
+    def run(x):
+        with torch.set_grad_enabled(grad_enabled):
+            return fn(x)
+    return list(_tree_pools[key].map(run, items))
+
+
+def unique_sentences(words, length):
+    """
+    Find the distinct sentences of a batch. Tokens beyond the length are ignored.
+    Args:
+        words: (batch_size, max_length). word id
+        length: (batch_size, )
+    Returns:
+        index: (num_unique, ), position of the first copy of each distinct sentence
+        inverse: (batch_size, ), sentence i is a copy of sentence index[inverse[i]]
+    """
+    batch_size, max_length = words.size()
+    keys = words.masked_fill(~sequence_mask(length, max_length), 0)
+    keys = torch.cat([length.unsqueeze(1).to(keys.dtype), keys], dim=1)
+    _, inverse = torch.unique(keys, dim=0, return_inverse=True)
+    num_unique = int(inverse.max()) + 1
+    positions = torch.arange(batch_size, device=words.device)
+    index = positions.new_full((num_unique,), batch_size).scatter_reduce_(0, inverse, positions, reduce='amin')
+    return index, inverse
+
+
+def expand_samples(samples, inverse):
+    """
+    Scatter the REINFORCE samples of the unique sentences back to the whole batch,
+    keeping the layout that sample j of sentence i is at i*sample_num+j.
+    """
+    sample_num = len(samples['trees']) // (int(inverse.max()) + 1)
+    sample_index = (inverse.unsqueeze(1) * sample_num + torch.arange(sample_num, device=inverse.device)).view(-1)
+    sample_list = sample_index.tolist()
+    return {
+            'h': samples['h'][sample_index],
+            'c': samples['c'][sample_index],
+            'probs': [samples['probs'][k] for k in sample_list],
+            'trees': [samples['trees'][k] for k in sample_list],
+            }
+
+
+def pooled_leaf(sentence, hs, cs, start, end):
+    """
+    The leaf that replaces the subtree of sentence[start:end] below the depth budget.
+    Args:
+        hs, cs: (length, 1, hidden_dim)
+    Returns:
+        (h, c): (1, hidden_dim), the mean of the states of the span
+        root: Node of the joined words
+    """
+    root = Node(' '.join(sentence[start:end]), num_words=end - start)
+    return (hs[start:end].mean(0), cs[start:end].mean(0)), root
+
+
+def split_chunks(sentence_embedding, sentence_word, length, chunk_size, boundary_ids=()):
+    """
+    Split each sentence into consecutive segments of at most chunk_size words, ending a
+    segment early after a word of boundary_ids (e.g. the ids of '.', '!' and '?').
+    Args:
+        sentence_embedding: (batch_size, max_length, word_dim)
+        sentence_word: (batch_size, max_length)
+        length: (batch_size, )
+    Returns:
+        chunk_embedding: (num_chunks, chunk_length, word_dim)
+        chunk_word: (num_chunks, chunk_length)
+        chunk_length: (num_chunks, )
+        doc_chunks: list of (first, end), the segments of sentence i are chunks[first:end]
+    """
+    batch_size, max_length = sentence_word.size()
+    starts, lengths, doc_chunks = [], [], []
+    for i, (words, l) in enumerate(zip(sentence_word.tolist(), length.tolist())):
+        first = len(starts)
+        start = 0
+        for j in range(l):
+            if j + 1 - start == chunk_size or j + 1 == l or words[j] in boundary_ids:
+                starts.append(i * max_length + start)
+                lengths.append(j + 1 - start)
+                start = j + 1
+        doc_chunks.append((first, len(starts)))
+    device = sentence_word.device
+    chunk_length = torch.tensor(lengths, dtype=torch.long, device=device)
+    positions = torch.arange(int(chunk_length.max()), device=device).unsqueeze(0)
+    # padding positions repeat the first word of the segment
+    positions = positions.masked_fill(~sequence_mask(chunk_length, positions.size(1)), 0)
+    index = torch.tensor(starts, dtype=torch.long, device=device).unsqueeze(1) + positions
+    chunk_embedding = sentence_embedding.reshape(batch_size * max_length, -1)[index]
+    chunk_word = sentence_word.reshape(-1)[index]
+    return chunk_embedding, chunk_word, chunk_length, doc_chunks
+
+
+def sentence_boundary_ids(vocab, boundaries=('.', '!', '?')):
+    id_to_word = vocab.id_to_word
+    items = id_to_word.items() if isinstance(id_to_word, dict) else enumerate(id_to_word)
+    return frozenset(i for i, w in items if w in boundaries)
+
+
+def graft_tree(top, chunk_trees):
+    """
+    Turn a tree over segments, whose node words are segment indices, into a tree over
+    words: each node is replaced by the tree of its segment, with the left (right) subtree
+    hung below the leftmost (rightmost) word, which keeps the in-order traversal.
+    """
+    if top is None:
+        return None
+    root = chunk_trees[top.word]
+    left, right = graft_tree(top.left, chunk_trees), graft_tree(top.right, chunk_trees)
+    if left is not None:
+        node = root
+        while node.left is not None:
+            node = node.left
+        node.left = left
+    if right is not None:
+        node = root
+        while node.right is not None:
+            node = node.right
+        node.right = right
+    return root
+
+
+class DedupStats(object):
+    """
+    Count the sentences fed to a model and the distinct ones actually encoded.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.num_sentences = 0
+        self.num_unique = 0
+
+    def update(self, num_sentences, num_unique):
+        self.num_sentences += num_sentences
+        self.num_unique += num_unique
+
+    def hit_rate(self):
+        # fraction of the sentences whose encoding is reused
+        if self.num_sentences == 0:
+            return 0.
+        return 1 - self.num_unique / self.num_sentences
@@ -0,0 +1,123 @@
+"""
+Inference-only rewrites of a trained SingleModel/PairModel:
+- eval-mode BatchNorm of the classifier is folded into the following nn.Linear
+- dropout modules are removed
+- Linear+ReLU pairs of the classifier MLP become one fused module
+- TriPadLSTMLayer.comp_linear is split into per-child weight blocks
+The rewritten model is checked against the original on a batch before it is returned.
+"""
+import copy
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from model.basic import TriPadLSTMLayer
+from model.PairModel import PairModel
+
+
+class LinearReLU(nn.Module):
+    """
+    relu(linear(x)) with the relu done in place on the output of linear.
+    """
+    def __init__(self, linear):
+        super().__init__()
+        self.weight = linear.weight
+        self.bias = linear.bias
+
+    def forward(self, x):
+        return F.linear(x, self.weight, self.bias).relu_()
+
+
+def fold_batchnorm(bn, linear):
+    """
+    Fold an eval-mode BatchNorm1d applied to the input of linear into its weight and bias:
+    W (s*x + t) + b = (W*s) x + (W t + b), where s = gamma/sqrt(var+eps), t = beta - mean*s
+    """
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias - bn.running_mean * scale
+        bias = linear.bias if linear.bias is not None else torch.zeros_like(linear.weight[:, 0])
+        linear.bias = nn.Parameter(bias + torch.mv(linear.weight, shift))
+        linear.weight = nn.Parameter(linear.weight * scale.unsqueeze(0))
+
+
+def mlp_linears(mlp):
+    # SingleModel: Sequential(Linear, ReLU, ...), PairModel: Sequential(Sequential(Linear, ReLU), ...)
+    return [m for m in mlp.modules() if isinstance(m, nn.Linear)]
+
+
+def optimize_classifier(classifier):
+    linears = mlp_linears(classifier.mlp)
+    if classifier.use_batchnorm:
+        # bn_mlp_output feeds clf_linear, bn_mlp_input feeds the first linear of the mlp
+        # (clf_linear itself when there is no mlp layer, after bn_mlp_output is folded)
+        fold_batchnorm(classifier.bn_mlp_output, classifier.clf_linear)
+        fold_batchnorm(classifier.bn_mlp_input, linears[0] if linears else classifier.clf_linear)
+        classifier.use_batchnorm = False
+        del classifier.bn_mlp_input, classifier.bn_mlp_output
+    classifier.mlp = nn.Sequential(*[LinearReLU(l) for l in linears])
+
+
+def strip_dropout(module):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Dropout):
+            setattr(module, name, nn.Identity())
+        else:
+            strip_dropout(child)
+
+
+def random_batch(model, batch_size=16, max_length=20, generator=None):
+    """
+    A batch of random word ids in the format of the data loaders, for checking outputs.
+    """
+    num_words = model.word_embedding.num_embeddings
+    device = model.word_embedding.weight.device
+    def sentences():
+        length = torch.randint(1, max_length + 1, (batch_size,), generator=generator)
+        length[0] = max_length
+        words = torch.randint(0, num_words, (batch_size, max_length), generator=generator)
+        return words.to(device), length.to(device)
+    if isinstance(model, PairModel):
+        (pre, pre_length), (hyp, hyp_length) = sentences(), sentences()
+        return {'pre': pre, 'pre_length': pre_length, 'hyp': hyp, 'hyp_length': hyp_length}
+    words, length = sentences()
+    return {'words': words, 'length': length}
+
+
+def max_difference(model_a, model_b, batches):
+    diff = 0.
+    with torch.no_grad():
+        for model_arg in batches:
+            logits_a, _ = model_a(**model_arg)
+            logits_b, _ = model_b(**model_arg)
+            diff = max(diff, (logits_a - logits_b).abs().max().item())
+    return diff
+
+
+def optimize_for_inference(model, check_batches=None, atol=1e-4):
+    """
+    Args:
+        model: a trained SingleModel or PairModel, left unchanged
+        check_batches: list of model.forward kwargs to compare the outputs on,
+                       default is a random batch
+        atol: max absolute difference of the logits
+    Returns:
+        the optimized copy in eval mode, only usable for inference
+    """
+    model.eval()
+    optimized = copy.deepcopy(model)
+    optimize_classifier(optimized.classifier)
+    strip_dropout(optimized)
+    for module in optimized.modules():
+        if isinstance(module, TriPadLSTMLayer):
+            module.split_comp_linear()
+    optimized.requires_grad_(False)
+
+    if check_batches is None:
+        check_batches = [random_batch(model, generator=torch.Generator().manual_seed(0))]
+    diff = max_difference(model, optimized, check_batches)
+    if diff > atol:
+        raise ValueError(f'the optimized model differs from the original by {diff:.2e} > {atol:.2e}')
+    print(f'optimized model for inference, max logit difference {diff:.2e}')
+    return optimized
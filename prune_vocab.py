@@ -0,0 +1,192 @@
+"""
+Export a compact checkpoint whose word embedding only keeps the words that are
+frequent enough, either in the training data or in a sample of real traffic. The
+dropped words are mapped to <unk>, and the mapping from the old ids is saved as
+'vocab_remap' in the checkpoint, which evaluate.py and ARTreeEncoder understand.
+
+    python prune_vocab.py --ckpt model.pkl --data-path </path/to/data> --min-freq 2 --out model-pruned.pkl --evaluate
+    python prune_vocab.py --ckpt model.pkl --data-path </path/to/data> --traffic queries.txt --out model-pruned.pkl
+"""
+import argparse
+import os
+import time
+from collections import Counter
+
+import torch
+
+from model.SingleModel import SingleModel
+from model.PairModel import PairModel
+import train
+from evaluate import eval_iter
+from utils.vocab import Vocab, IdVocab, remap_words, id_to_word_list
+
+
+def load_data(args):
+    # on cpu, the batch size only changes the speed of the counting and the evaluation
+    args.device = torch.device('cpu')
+    args.batch_size = 128
+    return train.load_data(args)
+
+
+def train_frequencies(data, words):
+    """
+    Returns:
+        list of the frequency of each word id in the training data
+    """
+    if hasattr(data, 'word_freq'): # SST
+        return list(data.word_freq)
+    if hasattr(data, 'vocab') and 'word_token_to_freq' in data.vocab: # SNLI
+        freq = data.vocab['word_token_to_freq']
+        return [freq.get(w, 0) for w in words]
+    # count every training example once, the training batches are shuffled and Age drops
+    # the last partial one
+    counts = Counter()
+    if hasattr(data, 'train_loader'): # SNLI: (pre, hyp, pre_length, hyp_length, label)
+        for pre, hyp, *_ in data.train_loader.dataset:
+            counts.update(pre)
+            counts.update(hyp)
+    else: # Age: (word ids, label)
+        for ids, _ in data.train_set:
+            counts.update(ids)
+    return [counts.get(i, 0) for i in range(len(words))]
+
+
+def traffic_frequencies(path, words, lower):
+    """
+    Frequencies in a traffic sample, one tokenized sentence per line.
+    """
+    counter = Counter()
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            counter.update((line.lower() if lower else line).split())
+    return [counter.get(w, 0) for w in words]
+
+
+def vocab_file_frequencies(path, words, use_df):
+    """
+    Term or document frequencies of a vocab file in the format of utils.vocab.Vocab.from_file.
+    """
+    vocab = Vocab.from_file(path, add_pad=False, add_unk=False)
+    freq = []
+    for w in words:
+        if vocab.has_word(w):
+            i = vocab.word_to_id(w)
+            freq.append(vocab.id_to_df(i) if use_df else vocab.id_to_tf(i))
+        else:
+            freq.append(0)
+    return freq
+
+
+def prune(state_dict, words, freq, min_freq, max_size=None):
+    """
+    Keep the special words (<unk> and <pad>, if the vocab has them) and the words whose
+    frequency is at least min_freq, at most max_size of them, in the order of their old ids.
+    The dropped words are mapped to <unk>. A vocab without <unk> (e.g. Age) gets one,
+    appended after the kept words with the mean vector of the dropped words.
+    Returns:
+        state_dict: a copy with the pruned embedding
+        kept_words: list of the words of the pruned vocab
+        remap: LongTensor (num_words, ), new id of each old id, dropped words go to <unk>
+    """
+    special = { i for i, w in enumerate(words) if w in {'<unk>', '<pad>'} }
+    add_unk = '<unk>' not in words
+    candidates = [i for i in range(len(words)) if i not in special and freq[i] >= min_freq]
+    if max_size is not None and len(special) + add_unk + len(candidates) > max_size:
+        candidates = sorted(candidates, key=lambda i: -freq[i])[:max(0, max_size - len(special) - add_unk)]
+    kept = sorted(special | set(candidates))
+    kept_words = [words[i] for i in kept]
+    weight = state_dict['word_embedding.weight']
+    pruned_weight = weight[torch.LongTensor(kept)].clone()
+    if len(kept) < len(words) and add_unk:
+        dropped = torch.ones(len(words), dtype=torch.bool)
+        dropped[torch.LongTensor(kept)] = False
+        kept_words.append('<unk>')
+        pruned_weight = torch.cat([pruned_weight, weight[dropped].mean(0, keepdim=True)])
+    unk_id = kept_words.index('<unk>') if '<unk>' in kept_words else 0 # nothing is dropped without <unk>
+    remap = torch.full((len(words),), unk_id, dtype=torch.long)
+    remap[torch.LongTensor(kept)] = torch.arange(len(kept))
+    state_dict = dict(state_dict)
+    state_dict['word_embedding.weight'] = pruned_weight
+    return state_dict, kept_words, remap
+
+
+def accuracy(model, generator, num, remap=None):
+    correct_num = 0
+    for model_arg, label in generator:
+        if remap is not None:
+            model_arg = remap_words(model_arg, remap)
+        correct, _ = eval_iter((model_arg, label), model)
+        correct_num += correct
+    return correct_num / num
+
+
+def build_model(args, state_dict, vocab):
+    Model = PairModel if args.data_type == 'snli' else SingleModel
+    kwargs = dict(vars(args))
+    kwargs['vocab'] = vocab
+    kwargs['num_words'] = state_dict['word_embedding.weight'].size(0)
+    model = Model(**kwargs)
+    model.load_state_dict(state_dict)
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt', required=True)
+    parser.add_argument('--data-path', required=True, help='data the model was trained on, for its vocab and the accuracy report')
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--min-freq', default=1, type=int, help='keep the words occurring at least this many times')
+    parser.add_argument('--max-size', type=int, help='keep at most this many words, the most frequent ones')
+    parser.add_argument('--traffic', help='count the frequencies in this sample of tokenized sentences (one per line) instead of the training data')
+    parser.add_argument('--lower', action='store_true', help='lowercase the traffic sample')
+    parser.add_argument('--vocab-file', help='use the tf (or df with --use-df) of a utils.vocab.Vocab file instead of the training data')
+    parser.add_argument('--use-df', action='store_true')
+    parser.add_argument('--evaluate', action='store_true', help='report the dev/test accuracy of the original and the pruned model')
+    args = parser.parse_args()
+
+    loaded = torch.load(args.ckpt, map_location='cpu', weights_only=False)
+    if 'vocab_remap' in loaded:
+        parser.error(f'{args.ckpt} is already pruned')
+    for k, v in loaded['model_kwargs'].items():
+        setattr(args, k, v)
+    data = load_data(args)
+    words = id_to_word_list(args.vocab)
+
+    if args.traffic:
+        freq = traffic_frequencies(args.traffic, words, args.lower)
+    elif args.vocab_file:
+        freq = vocab_file_frequencies(args.vocab_file, words, args.use_df)
+    else:
+        freq = train_frequencies(data, words)
+    state_dict, kept_words, remap = prune(loaded['model'], words, freq, args.min_freq, args.max_size)
+    kept_set = set(kept_words)
+    covered = sum(f for w, f in zip(words, freq) if w in kept_set)
+    total = sum(freq)
+    print(f'Kept {len(kept_words)} of {len(words)} words, covering {covered / max(1, total):.2%} of the counted tokens')
+
+    pruned = {
+            'model': state_dict,
+            'model_kwargs': loaded['model_kwargs'],
+            'vocab': kept_words,
+            'vocab_remap': remap,
+            }
+    torch.save(pruned, args.out)
+    for path in [args.ckpt, args.out]:
+        tic = time.time()
+        torch.load(path, map_location='cpu', weights_only=False)
+        print(f'{path}: {os.path.getsize(path) / 2**20:.2f} MB, loaded in {time.time() - tic:.3f} sec')
+
+    if args.evaluate:
+        full_model = build_model(args, loaded['model'], args.vocab)
+        pruned_model = build_model(args, state_dict, IdVocab(kept_words))
+        for split, generator, num in [('dev', data.dev_minibatch_generator, data.num_valid),
+                                      ('test', data.test_minibatch_generator, data.num_test)]:
+            with torch.no_grad():
+                full_accuracy = accuracy(full_model, generator(), num)
+                pruned_accuracy = accuracy(pruned_model, generator(), num, remap)
+            print(f'{split} accuracy: full {full_accuracy:.4f}, pruned {pruned_accuracy:.4f}, '
+                  f'change {pruned_accuracy - full_accuracy:+.4f}')
+
+
+if __name__ == '__main__':
+    main()
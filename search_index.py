@@ -0,0 +1,85 @@
+"""
+Find the nearest sentences of a corpus encoded by encode_corpus.py, for query sentences
+encoded by the same checkpoint.
+
+    python search_index.py --ckpt model.artree --embeddings encoded/ --corpus sentences.txt --k 5
+    python search_index.py --ckpt model.artree --embeddings encoded/ --ivf encoded/ivf.pt --num-lists 4096 --nprobe 16 < queries.txt
+
+Query sentences are read one per line from --queries, or from stdin. With --ivf the
+IVF index is loaded from that path, or trained and saved there if it does not exist.
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+from model.ARTreeEncoder import ARTreeEncoder
+from utils.nn_index import load_embeddings, ExactIndex, IVFIndex
+
+
+def corpus_lines(path, ids):
+    """
+    The lines of the given ids, read in one pass over the corpus.
+    """
+    wanted = set(ids)
+    lines = {}
+    with open(path, encoding='utf8', newline='\n') as f:
+        for i, line in enumerate(f):
+            if i in wanted:
+                lines[i] = line.rstrip('\n')
+                if len(lines) == len(wanted):
+                    break
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt', required=True, help='the checkpoint or artifact the corpus was encoded with')
+    parser.add_argument('--embeddings', required=True, help='embeddings.npy or the output directory of encode_corpus.py')
+    parser.add_argument('--corpus', help='input of encode_corpus.py, to print the found sentences instead of their line numbers')
+    parser.add_argument('--queries', help='file of query sentences, default stdin')
+    parser.add_argument('--lower', action='store_true', help='lowercase the queries')
+    parser.add_argument('--k', default=10, type=int)
+    parser.add_argument('--metric', default='cosine', choices=['cosine', 'dot'])
+    parser.add_argument('--block-size', default=65536, type=int, help='rows per matmul of the exact search')
+    parser.add_argument('--ivf', help='path of the IVF index, approximate search if given')
+    parser.add_argument('--num-lists', default=1024, type=int, help='k-means clusters of a new IVF index')
+    parser.add_argument('--nprobe', default=8, type=int, help='clusters scanned per query, trades latency for recall')
+    args = parser.parse_args()
+
+    embeddings = load_embeddings(args.embeddings)
+    tic = time.time()
+    if args.ivf and os.path.exists(args.ivf):
+        index = IVFIndex.load(args.ivf, embeddings, args.block_size, args.nprobe)
+        if index.metric != args.metric:
+            parser.error(f'{args.ivf} was built for the {index.metric} metric')
+    elif args.ivf:
+        index = IVFIndex(embeddings, args.metric, args.block_size, args.num_lists, args.nprobe).train()
+        index.save(args.ivf)
+    else:
+        index = ExactIndex(embeddings, args.metric, args.block_size)
+    print(f'{len(index)} vectors indexed in {time.time() - tic:.2f} sec', file=sys.stderr)
+
+    encoder = ARTreeEncoder.from_checkpoint(args.ckpt)
+    with open(args.queries, encoding='utf8') if args.queries else sys.stdin as f:
+        queries = [line.split() for line in f if line.strip()]
+    if args.lower:
+        queries = [[w.lower() for w in q] for q in queries]
+    if not queries:
+        return
+    tic = time.time()
+    scores, ids = index.search(encoder.encode(queries), args.k)
+    print(f'{len(queries)} queries searched in {time.time() - tic:.3f} sec', file=sys.stderr)
+
+    lines = corpus_lines(args.corpus, ids[ids >= 0].tolist()) if args.corpus else {}
+    for query, query_scores, query_ids in zip(queries, scores.tolist(), ids.tolist()):
+        print(' '.join(query))
+        for score, i in zip(query_scores, query_ids):
+            if i >= 0:
+                print(f'\t{score:.4f}\t{i}\t{lines.get(i, "")}')
+
+
+if __name__ == '__main__':
+    main()
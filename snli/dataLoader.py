@@ -1,4 +1,5 @@
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 import jsonlines
 import torch
 from nltk import word_tokenize
@@ -80,6 +81,7 @@ class SNLI(object):
     def __init__(self, args):
         self.batch_size = args.batch_size
         self.device = args.device
+        self.world_size = getattr(args, 'world_size', 1)
 
         tic = time.time()
         with open(args.data_path, 'rb') as f:
@@ -87,8 +89,15 @@ class SNLI(object):
             valid_dataset = pickle.load(f)
             test_dataset = pickle.load(f)
 
+        if self.world_size > 1:
+            # data parallel training: each rank takes a disjoint shard of the shuffled data
+            self.train_sampler = DistributedSampler(train_dataset, num_replicas=self.world_size,
+                                  rank=args.rank, shuffle=True, seed=getattr(args, 'seed', None) or 0)
+        else:
+            self.train_sampler = None
         self.train_loader = DataLoader(dataset=train_dataset, batch_size=args.batch_size,
-                                  shuffle=True, num_workers=0,
+                                  shuffle=self.train_sampler is None, sampler=self.train_sampler,
+                                  num_workers=0,
                                   collate_fn=train_dataset.collate,
                                   pin_memory=True)
         self.valid_loader = DataLoader(dataset=valid_dataset, batch_size=args.batch_size,
@@ -104,7 +113,7 @@ class SNLI(object):
         self.word_to_id = self.vocab['word_token_to_idx']
         self.id_to_word = self.vocab['word_idx_to_token']
         #### load glove
-        if hasattr(args, 'glove_path'):
+        if getattr(args, 'glove_path', None):
             print("load glove from %s" % (args.glove_path))
             glove = pickle.load(open(args.glove_path, 'rb'))
             dim = len(glove['the'])
@@ -138,6 +147,10 @@ class SNLI(object):
             label = batch.pop('label')
             yield batch, label
 
+    def set_epoch(self, epoch):
+        if self.train_sampler is not None:
+            self.train_sampler.set_epoch(epoch)
+
     def train_minibatch_generator(self):
         return self.generator(self.train_loader) 
 
@@ -1,35 +1,179 @@
-from torchtext import data, datasets
+import os
+import pickle
+import random
+import time
+from collections import Counter
+
+import numpy as np
+import torch
+from nltk import Tree
+
+CACHE_VERSION = 1
+
+
+def get_label_str(label, fine_grained):
+    # the same label names as torchtext.datasets.SST
+    pre = 'very ' if fine_grained else ''
+    return {'0': pre + 'negative', '1': 'negative', '2': 'neutral',
+            '3': 'positive', '4': pre + 'positive'}[label]
+
+
+def build_itos(counter, specials):
+    """
+    Same ordering as torchtext's Vocab: specials first, then by frequency (descending),
+    ties broken alphabetically. Keeping it identical lets checkpoints trained with the
+    old torchtext pipeline be evaluated with this loader.
+    """
+    words_and_frequencies = sorted(counter.items(), key=lambda tup: tup[0])
+    words_and_frequencies.sort(key=lambda tup: tup[1], reverse=True)
+    return specials + [w for w, _ in words_and_frequencies if w not in specials]
+
+
+def find_tree_dir(data_path):
+    # torchtext downloads the treebank into <root>/sst/trees
+    for d in [os.path.join(data_path, 'sst', 'trees'), os.path.join(data_path, 'trees'), data_path]:
+        if os.path.exists(os.path.join(d, 'train.txt')):
+            return d
+    raise FileNotFoundError(f'can not find train.txt/dev.txt/test.txt of SST under {data_path}')
+
+
+def read_split(path, fine_grained, subtrees):
+    """
+    Returns:
+        a list of (tokens, label_str), one for each (sub)tree
+    """
+    examples = []
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            tree = Tree.fromstring(line)
+            nodes = tree.subtrees() if subtrees else [tree]
+            for t in nodes:
+                label = get_label_str(t.label(), fine_grained)
+                if not fine_grained and label == 'neutral':
+                    continue
+                examples.append((t.leaves(), label))
+    return examples
+
+
+def build_cache(tree_dir, fine_grained, glove_path):
+    splits = {
+            'train': read_split(os.path.join(tree_dir, 'train.txt'), fine_grained, subtrees=True),
+            'dev': read_split(os.path.join(tree_dir, 'dev.txt'), fine_grained, subtrees=False),
+            'test': read_split(os.path.join(tree_dir, 'test.txt'), fine_grained, subtrees=False),
+            }
+    word_counter, label_counter = Counter(), Counter()
+    for examples in splits.values():
+        for tokens, label in examples:
+            word_counter.update(tokens)
+            label_counter[label] += 1
+    itos = build_itos(word_counter, ['<unk>', '<pad>'])
+    label_itos = build_itos(label_counter, ['<unk>'])
+    stoi = { w:i for i,w in enumerate(itos) }
+    label_stoi = { w:i for i,w in enumerate(label_itos) }
+
+    cache = {
+            'version': CACHE_VERSION,
+            'fine_grained': fine_grained,
+            'itos': itos,
+            'label_itos': label_itos,
+            'word_freq': [word_counter.get(w, 0) for w in itos],
+            }
+    for name, examples in splits.items():
+        lengths = [len(tokens) for tokens, _ in examples]
+        offsets = np.zeros(len(examples) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        tokens = np.fromiter((stoi[w] for t, _ in examples for w in t), dtype=np.int32, count=int(offsets[-1]))
+        cache[name] = {
+                'tokens': torch.from_numpy(tokens),
+                'offsets': torch.from_numpy(offsets),
+                'labels': torch.LongTensor([label_stoi[l] for _, l in examples]),
+                }
+    cache.update(load_glove_subset(glove_path, itos))
+    return cache
+
+
+def load_glove_subset(glove_path, itos):
+    if glove_path is None:
+        return {'glove_path': None, 'weight': None}
+    print("load glove from %s" % (glove_path))
+    with open(glove_path, 'rb') as f:
+        glove = pickle.load(f)
+    dim = len(glove['the'])
+    weight = np.zeros((len(itos), dim), dtype=np.float32)
+    for i, w in enumerate(itos):
+        if w in glove:
+            weight[i] = glove[w]
+    weight[1] = 0 # <pad>
+    return {'glove_path': os.path.abspath(glove_path), 'weight': torch.from_numpy(weight)}
+
 
 class SST(object):
+    """
+    Parse the treebank once and keep the tokenized (sub)tree examples, the vocab and the GloVe
+    subset in a binary cache next to the treebank files. Batches are bucketed by length
+    in the same way as torchtext's BucketIterator.
+    """
     def __init__(self, args):
-        text_field = data.Field(lower=False, include_lengths=True, batch_first=True)
-        label_field = data.Field(sequential=False)
-
-        filter_pred = None
-        if not args.fine_grained:
-            filter_pred = lambda ex: ex.label != 'neutral'
-        dataset_splits = datasets.SST.splits(
-            root=args.data_path, text_field=text_field, label_field=label_field,
-            fine_grained=args.fine_grained, train_subtrees=True,
-            filter_pred=filter_pred)
-        train_dataset, valid_dataset, test_dataset = dataset_splits
-        text_field.build_vocab(*dataset_splits, vectors=args.glove)
-        label_field.build_vocab(*dataset_splits)
-        self.train_loader, self.valid_loader, self.test_loader = data.BucketIterator.splits(
-                datasets=dataset_splits, batch_size=args.batch_size, device=args.device, sort_within_batch=True)
-
-        text_field.vocab.id_to_word = text_field.vocab.itos
-        num_classes = len(label_field.vocab)
+        self.batch_size = args.batch_size
+        self.device = args.device
+        # data parallel training: each rank takes every world_size-th batch
+        self.rank = getattr(args, 'rank', 0)
+        self.world_size = getattr(args, 'world_size', 1)
+        self.seed = getattr(args, 'seed', None) or 0
+        self.epoch = 0
+
+        tic = time.time()
+        fine_grained = args.fine_grained
+        glove_path = getattr(args, 'glove_path', None)
+        tree_dir = find_tree_dir(args.data_path)
+        cache_path = os.path.join(tree_dir, 'sst%d.cache.pt' % (5 if fine_grained else 2))
+        cache = None
+        if os.path.exists(cache_path):
+            cache = torch.load(cache_path)
+            if cache.get('version') != CACHE_VERSION:
+                cache = None
+        if cache is None:
+            print('build SST cache from %s' % (tree_dir))
+            cache = build_cache(tree_dir, fine_grained, glove_path)
+            self.save_cache(cache, cache_path)
+        elif glove_path is not None and cache['glove_path'] != os.path.abspath(glove_path):
+            cache.update(load_glove_subset(glove_path, cache['itos']))
+            self.save_cache(cache, cache_path)
+
+        self.id_to_word = cache['itos']
+        self.word_to_id = { w:i for i,w in enumerate(self.id_to_word) }
+        self.word_freq = cache['word_freq']
+        self.label_itos = cache['label_itos']
+        self.pad_id = self.word_to_id['<pad>']
+        self.train_set, self.dev_set, self.test_set = cache['train'], cache['dev'], cache['test']
+        if glove_path is not None:
+            self.weight = cache['weight']
+        else:
+            self.weight = None
+            print("no glove")
+
+        num_classes = len(self.label_itos)
         print(f'Number of classes: {num_classes}')
         ####### required items
-        self.num_train_batches = len(self.train_loader)
-        self.num_valid = len(valid_dataset)
-        self.num_test = len(test_dataset)
-        self.weight = text_field.vocab.vectors
+        self.num_train_batches = (len(self.train_set['labels']) + self.batch_size - 1) // self.batch_size
+        if self.world_size > 1:
+            self.num_train_batches //= self.world_size
+        self.num_valid = len(self.dev_set['labels'])
+        self.num_test = len(self.test_set['labels'])
         args.num_classes = num_classes
-        args.num_words = len(text_field.vocab)
-        args.vocab = text_field.vocab
+        args.num_words = len(self.id_to_word)
+        args.vocab = self
         #######
+        print('It takes %.2f sec to load datafile. train/dev/test: %d/%d/%d.' % (time.time() - tic, len(self.train_set['labels']), self.num_valid, self.num_test))
+
+    @staticmethod
+    def save_cache(cache, cache_path):
+        tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        try:
+            torch.save(cache, tmp_path)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print('can not write SST cache to %s: %s' % (cache_path, e))
 
     def wrap_to_model_arg(self, words, length): # should match the kwargs of model.forward
         return {
@@ -37,27 +181,57 @@ class SST(object):
                 'length': length
                 }
 
-    def train_minibatch_generator(self):
-        for i, batch in enumerate(self.train_loader):
-            if i >= self.num_train_batches:
-                break
-            words, length = batch.text
-            label = batch.label
-            model_arg = self.wrap_to_model_arg(words, length)
-            yield model_arg, label
+    def make_batch(self, split, index):
+        """
+        Args:
+            split: dict of tokens/offsets/labels
+            index: LongTensor, ids of examples in this batch, sorted by decreasing length
+        """
+        starts = split['offsets'][index]
+        length = split['offsets'][index + 1] - starts
+        positions = torch.arange(int(length.max()))
+        mask = positions.unsqueeze(0) < length.unsqueeze(1)
+        gather_index = (starts.unsqueeze(1) + positions.unsqueeze(0)).clamp(max=len(split['tokens']) - 1)
+        words = split['tokens'][gather_index].long().masked_fill_(~mask, self.pad_id)
+        label = split['labels'][index]
+        model_arg = self.wrap_to_model_arg(words.to(self.device), length.to(self.device))
+        return model_arg, label.to(self.device)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batch_indices(self, split, shuffle):
+        lengths = (split['offsets'][1:] - split['offsets'][:-1]).tolist()
+        order = list(range(len(lengths)))
+        batches = []
+        if shuffle:
+            # all ranks must shuffle in the same way to get disjoint shards
+            rng = random.Random(self.seed * 100003 + self.epoch) if self.world_size > 1 else random
+            # like torchtext's pool(): sort by length inside chunks of 100 batches, then shuffle batches
+            rng.shuffle(order)
+            chunk_size = self.batch_size * 100
+            for p in range(0, len(order), chunk_size):
+                chunk = sorted(order[p:p+chunk_size], key=lambda i: lengths[i])
+                chunk_batches = [chunk[b:b+self.batch_size] for b in range(0, len(chunk), self.batch_size)]
+                rng.shuffle(chunk_batches)
+                batches.extend(chunk_batches)
+            if self.world_size > 1:
+                batches = batches[self.rank::self.world_size][:self.num_train_batches]
+        else:
+            order.sort(key=lambda i: lengths[i])
+            batches = [order[b:b+self.batch_size] for b in range(0, len(order), self.batch_size)]
+        # sort within batch by decreasing length
+        return [sorted(b, key=lambda i: -lengths[i]) for b in batches]
 
+    def generator(self, split, shuffle):
+        for index in self.batch_indices(split, shuffle):
+            yield self.make_batch(split, torch.LongTensor(index))
+
+    def train_minibatch_generator(self):
+        return self.generator(self.train_set, shuffle=True)
 
     def dev_minibatch_generator(self):
-        for batch in self.valid_loader:
-            words, length = batch.text
-            label = batch.label
-            model_arg = self.wrap_to_model_arg(words, length)
-            yield model_arg, label
+        return self.generator(self.dev_set, shuffle=False)
 
     def test_minibatch_generator(self):
-        for batch in self.test_loader:
-            words, length = batch.text
-            label = batch.label
-            model_arg = self.wrap_to_model_arg(words, length)
-            yield model_arg, label
-
+        return self.generator(self.test_set, shuffle=False)
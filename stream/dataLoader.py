@@ -0,0 +1,244 @@
+import os
+import random
+import time
+
+import torch
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+
+from utils.eval_cache import LENGTH_KEYS
+from utils.vocab import IdVocab
+
+
+FIELDS = {False: ['words'], True: ['pre', 'hyp']} # by whether the examples are sentence pairs
+META_FILE = 'meta.pt'
+
+
+def pack_examples(examples, pair):
+    """
+    Pack examples into flat tensors, like the splits of the SST cache.
+    Args:
+        examples: list of (token id lists, label), with one token list per field
+    Returns:
+        dict of '<field>_tokens', '<field>_offsets' (num_examples+1, ) and 'labels'
+    """
+    packed = {}
+    for f, field in enumerate(FIELDS[pair]):
+        lengths = torch.LongTensor([len(e[0][f]) for e in examples])
+        offsets = torch.zeros(len(examples) + 1, dtype=torch.long)
+        offsets[1:] = lengths.cumsum(0)
+        tokens = [w for e in examples for w in e[0][f]]
+        packed[field + '_tokens'] = torch.IntTensor(tokens)
+        packed[field + '_offsets'] = offsets
+    packed['labels'] = torch.LongTensor([e[1] for e in examples])
+    return packed
+
+
+def save_atomic(obj, path):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_shard(data_dir, index, examples, pair):
+    """
+    Returns:
+        (file name, number of examples) of the shard, as listed in the meta file
+    """
+    name = 'shard-%05d.pt' % index
+    save_atomic(pack_examples(examples, pair), os.path.join(data_dir, name))
+    return name, len(examples)
+
+
+def write_meta(data_dir, data_type, num_classes, vocab, pad_id, weight, shards, dev_examples, test_examples):
+    """
+    Write the meta file of a stream directory, after all its shards. A corpus that does
+    not fit in memory can be converted with write_shard and write_meta directly.
+    Args:
+        vocab: list of words, indexed by id
+        weight: FloatTensor (num_words, word_dim) of pretrained vectors, or None
+        shards: list of the (file name, number of examples) returned by write_shard
+        dev_examples, test_examples: list of (token id lists, label)
+    """
+    pair = data_type == 'snli'
+    meta = {
+            'data_type': data_type,
+            'pair': pair,
+            'num_classes': num_classes,
+            'vocab': list(vocab),
+            'pad_id': pad_id,
+            'weight': weight,
+            'shards': list(shards),
+            'dev': pack_examples(dev_examples, pair),
+            'test': pack_examples(test_examples, pair),
+            }
+    save_atomic(meta, os.path.join(data_dir, META_FILE))
+
+
+def unpack_examples(packed, pair):
+    """
+    Yields (token id lists, label) of the packed examples, in order.
+    """
+    fields = FIELDS[pair]
+    tokens = [packed[f + '_tokens'].tolist() for f in fields]
+    offsets = [packed[f + '_offsets'].tolist() for f in fields]
+    for i, label in enumerate(packed['labels'].tolist()):
+        yield [t[o[i]:o[i+1]] for t, o in zip(tokens, offsets)], label
+
+
+def collate(examples, pair, pad_id):
+    # sorted by decreasing length of the first field, like the SST batches
+    examples = sorted(examples, key=lambda e: -len(e[0][0]))
+    model_arg = {}
+    for f, field in enumerate(FIELDS[pair]):
+        length = torch.LongTensor([len(e[0][f]) for e in examples])
+        words = torch.full((len(examples), int(length.max())), pad_id, dtype=torch.long)
+        for i, e in enumerate(examples):
+            words[i, :len(e[0][f])] = torch.LongTensor(e[0][f])
+        model_arg[field] = words
+        model_arg[LENGTH_KEYS[field]] = length
+    label = torch.LongTensor([e[1] for e in examples])
+    return model_arg, label
+
+
+class ShardStream(IterableDataset):
+    """
+    One pass over the training shards: the shards are read in a shuffled order, one at a
+    time, their examples go through a shuffle buffer of bounded size, and batches are cut
+    from pools of bucket_batches batches sorted by length. Only full batches are yielded,
+    the rest of a pool is carried over to the next one.
+    With several loader workers, worker w reads the shards w, w+num_workers, ...; with data
+    parallel training, rank r keeps the examples r, r+world_size, ... of every shard.
+    """
+    def __init__(self, data_dir, shards, pair, pad_id, batch_size, shuffle_buffer, bucket_batches, rank, world_size):
+        self.data_dir = data_dir
+        self.shards = shards
+        self.pair = pair
+        self.pad_id = pad_id
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer
+        self.bucket_batches = bucket_batches
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = 0 # set for each epoch by StreamData
+
+    def examples(self, shards):
+        for name in shards:
+            packed = torch.load(os.path.join(self.data_dir, name))
+            for i, example in enumerate(unpack_examples(packed, self.pair)):
+                if i % self.world_size == self.rank:
+                    yield example
+
+    def shuffled(self, examples, rng):
+        buffer = []
+        for example in examples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(example)
+                continue
+            # replace a random element of the full buffer
+            j = rng.randrange(len(buffer))
+            yield buffer[j]
+            buffer[j] = example
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        # the same shard order in every worker and rank, each takes its part of it
+        shards = list(self.shards)
+        random.Random(self.seed).shuffle(shards)
+        rng = random.Random(self.seed * 1000 + worker_id + 1)
+        pool = []
+        pool_size = self.batch_size * self.bucket_batches
+        for example in self.shuffled(self.examples(shards[worker_id::num_workers]), rng):
+            pool.append(example)
+            if len(pool) == pool_size:
+                pool.sort(key=lambda e: len(e[0][0]))
+                batches = [pool[b:b+self.batch_size] for b in range(0, pool_size, self.batch_size)]
+                rng.shuffle(batches)
+                for batch in batches:
+                    yield collate(batch, self.pair, self.pad_id)
+                pool = []
+        pool.sort(key=lambda e: len(e[0][0]))
+        for b in range(0, len(pool) - self.batch_size + 1, self.batch_size):
+            yield collate(pool[b:b+self.batch_size], self.pair, self.pad_id)
+
+
+class StreamData(object):
+    """
+    Train from the shards written by stream/dump_shards.py without loading the training
+    set into memory. An epoch is one pass over all shards; num_train_batches is the
+    expected number of batches of a pass, used for the progress and validation intervals.
+    The dev and test sets are small and kept in memory.
+    """
+    def __init__(self, args):
+        self.batch_size = args.batch_size
+        self.device = args.device
+        self.rank = getattr(args, 'rank', 0)
+        self.world_size = getattr(args, 'world_size', 1)
+        self.seed = getattr(args, 'seed', None) or 0
+        self.epoch = 0
+
+        tic = time.time()
+        meta = torch.load(os.path.join(args.data_path, META_FILE))
+        if meta['data_type'] != args.data_type and {meta['data_type'], args.data_type} != {'sst2', 'sst5'}:
+            raise ValueError(f'{args.data_path} holds {meta["data_type"]} data, not {args.data_type}')
+        self.pair = meta['pair']
+        self.pad_id = meta['pad_id']
+        vocab = IdVocab(meta['vocab'])
+        self.id_to_word, self.word_to_id = vocab.id_to_word, vocab.word_to_id
+        self.weight = meta['weight']
+        self.dev_set, self.test_set = meta['dev'], meta['test']
+
+        shard_sizes = [num for _, num in meta['shards']]
+        self.num_train = sum(shard_sizes)
+        self.dataset = ShardStream(args.data_path, [name for name, _ in meta['shards']], self.pair, self.pad_id,
+                                   self.batch_size, args.shuffle_buffer, args.bucket_batches, self.rank, self.world_size)
+        self.loader = DataLoader(self.dataset, batch_size=None, num_workers=args.stream_workers,
+                                 pin_memory=self.device.type == 'cuda')
+        ####### required items
+        self.num_train_batches = self.num_train // self.world_size // self.batch_size
+        if self.world_size > 1:
+            # every rank must run the same number of steps, take the least a rank can get:
+            # its share of each shard, less the partial pool dropped by each loader worker
+            least = sum(num // self.world_size for num in shard_sizes) - max(1, args.stream_workers) * self.batch_size * args.bucket_batches
+            self.num_train_batches = max(1, least // self.batch_size)
+        self.num_valid = len(self.dev_set['labels'])
+        self.num_test = len(self.test_set['labels'])
+        args.num_classes = meta['num_classes']
+        args.num_words = len(self.id_to_word)
+        args.vocab = self
+        #######
+        print('It takes %.2f sec to load the stream meta. train/dev/test: %d (%d shards)/%d/%d.' % (
+            time.time() - tic, self.num_train, len(shard_sizes), self.num_valid, self.num_test))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def to_device(self, batch):
+        model_arg, label = batch
+        return { k: v.to(self.device) for k, v in model_arg.items() }, label.to(self.device)
+
+    def train_minibatch_generator(self):
+        if self.world_size > 1:
+            # all ranks read the shards in the same order, like the shuffle of SST
+            self.dataset.seed = self.seed * 100003 + self.epoch
+        else:
+            # drawn from the global rng, so that --resume replays the order of the epoch
+            self.dataset.seed = random.getrandbits(32)
+        for step, batch in enumerate(self.loader):
+            if self.world_size > 1 and step >= self.num_train_batches:
+                break
+            yield self.to_device(batch)
+
+    def generator(self, split):
+        examples = list(unpack_examples(split, self.pair))
+        order = sorted(range(len(examples)), key=lambda i: len(examples[i][0][0]))
+        for b in range(0, len(order), self.batch_size):
+            yield self.to_device(collate([examples[i] for i in order[b:b+self.batch_size]], self.pair, self.pad_id))
+
+    def dev_minibatch_generator(self):
+        return self.generator(self.dev_set)
+
+    def test_minibatch_generator(self):
+        return self.generator(self.test_set)
@@ -0,0 +1,70 @@
+"""
+Convert the training data of train.py (--data-type/--data-path) into the shard
+directory read by --stream: the training examples are written in shards of
+--shard-size examples, the vocab, GloVe subset, dev and test sets into meta.pt.
+
+    python -m stream.dump_shards --data-type snli --data-path snli.pickle --glove-path glove.pickle --out-dir snli-stream --shard-size 50000
+
+The examples are written in the order of one shuffled training epoch, so that each
+shard is a random sample of the corpus and the shuffle buffer only has to mix shards.
+"""
+import argparse
+import os
+import random
+import time
+
+import torch
+
+from train import load_data
+from stream.dataLoader import FIELDS, write_shard, write_meta
+from utils.eval_cache import LENGTH_KEYS
+from utils.vocab import id_to_word_list
+
+
+def examples_of(generator, pair):
+    # the loaders are run with batch size 1, which also keeps the last partial batch of AGE
+    for model_arg, label in generator:
+        example = []
+        for field in FIELDS[pair]:
+            length = model_arg[LENGTH_KEYS[field]][0].item()
+            example.append(model_arg[field][0, :length].tolist())
+        yield example, label[0].item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-type', required=True, choices=['sst2', 'sst5', 'age', 'snli'])
+    parser.add_argument('--data-path', required=True)
+    parser.add_argument('--glove-path', help='pickled GloVe dict produced by pickle_glove.py')
+    parser.add_argument('--out-dir', required=True)
+    parser.add_argument('--shard-size', default=100000, type=int, help='training examples per shard')
+    parser.add_argument('--seed', default=0, type=int, help='seed of the order of the training examples')
+    args = parser.parse_args()
+    args.device = torch.device('cpu')
+    args.batch_size = 1
+    args.rank, args.world_size = 0, 1
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    tic = time.time()
+    data = load_data(args)
+    pair = args.data_type == 'snli'
+    os.makedirs(args.out_dir, exist_ok=True)
+    shards, buffer = [], []
+    for example in examples_of(data.train_minibatch_generator(), pair):
+        buffer.append(example)
+        if len(buffer) == args.shard_size:
+            shards.append(write_shard(args.out_dir, len(shards), buffer, pair))
+            buffer = []
+    if buffer:
+        shards.append(write_shard(args.out_dir, len(shards), buffer, pair))
+    write_meta(args.out_dir, args.data_type, args.num_classes, id_to_word_list(data),
+               data.word_to_id.get('<pad>', 0), data.weight, shards,
+               list(examples_of(data.dev_minibatch_generator(), pair)),
+               list(examples_of(data.test_minibatch_generator(), pair)))
+    print('wrote %d training examples in %d shards, %d/%d dev/test examples to %s in %.1f sec' % (
+        sum(n for _, n in shards), len(shards), data.num_valid, data.num_test, args.out_dir, time.time() - tic))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""
+Run a grid or random search over train.py arguments, several runs at a time on one
+machine. The dataset and GloVe are loaded once by this process; runs are forked from it,
+so they share its pages (copy-on-write) instead of each unpickling its own copy.
+
+    python sweep.py --spec sweep.json --out-dir sweeps/age --parallel 4
+
+The spec is a json file, keys are train.py flags without the leading dashes:
+
+    {
+        "base": {"data-type": "age", "data-path": "age2.pickle", "model-type": "STG",
+                 "hidden-dim": 300, "clf-hidden-dim": 1024, "clf-num-layers": 1,
+                 "batch-size": 32, "max-epoch": 10, "optimizer": "adam", "l2reg": 1e-5,
+                 "clip": 5, "patience": 3, "use-batchnorm": true},
+        "grid": {"lr": [0.001, 0.0005], "leaf-rnn-type": ["lstm", "bilstm"]},
+        "random": {"dropout": {"uniform": [0.1, 0.5]}, "rank-input": {"choice": ["w", "h"]}},
+        "num_samples": 4,
+        "seed": 0
+    }
+
+Every combination of "grid" is run with "num_samples" random draws of "random"
+(uniform, log_uniform, int or choice). A true value adds a flag, a false one omits it.
+A run without a "seed" flag in "base", "grid" or "random" is given --seed <spec seed +
+run index>: the forked runs would otherwise share the random state of this process.
+Each run trains in --out-dir/run-NNN (with its stdout.log), and the best dev accuracy,
+the test accuracy of that model and the training throughput of all runs are written to
+results.csv and results.json. Completed runs are skipped when the sweep is run again.
+"""
+import argparse
+import gc
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+from multiprocessing.connection import wait
+
+import torch
+
+import train
+from benchmarks.common import write_results
+
+# arguments that determine the loaded data, runs that differ in them do not share it
+DATA_FIELDS = ['data_type', 'data_path', 'glove_path', 'batch_size', 'word_dim', 'stream', 'shuffle_buffer', 'bucket_batches', 'stream_workers']
+# what the data loaders set on args, copied to the args of each run
+LOADER_FIELDS = ['num_classes', 'num_words', 'vocab', 'fine_grained']
+
+
+def draw(dist, rng):
+    (kind, values), = dist.items()
+    if kind == 'uniform':
+        return rng.uniform(*values)
+    elif kind == 'log_uniform':
+        return math.exp(rng.uniform(math.log(values[0]), math.log(values[1])))
+    elif kind == 'int':
+        return rng.randint(*values)
+    elif kind == 'choice':
+        return rng.choice(values)
+    raise ValueError(f'unknown distribution {kind}')
+
+
+def expand_spec(spec):
+    """
+    Returns:
+        list of dicts of flag -> value, one per run, each with its own train.py seed
+    """
+    seed = spec.get('seed', 0)
+    rng = random.Random(seed)
+    grid = spec.get('grid', {})
+    random_space = spec.get('random', {})
+    num_samples = spec.get('num_samples', 1) if random_space else 1
+    configs = []
+    for values in itertools.product(*grid.values()):
+        for _ in range(num_samples):
+            config = dict(spec.get('base', {}))
+            config.update(zip(grid.keys(), values))
+            config.update({ k: draw(dist, rng) for k, dist in random_space.items() })
+            config.setdefault('seed', seed + len(configs))
+            configs.append(config)
+    return configs
+
+
+def to_argv(config, save_dir):
+    argv = ['--save-dir', save_dir]
+    for k, v in config.items():
+        if v is True:
+            argv.append('--' + k)
+        elif v is not False and v is not None:
+            argv += ['--' + k, str(v)]
+    return argv
+
+
+def load_shared_data(args):
+    """
+    Load the data of a run in this process, before forking the runs that use it.
+    """
+    args.device = torch.device('cpu')
+    args.rank = 0
+    data = train.load_data(args)
+    # objects created before the fork are never collected, so the collector of the runs
+    # does not write to (and copy) their pages
+    gc.collect()
+    gc.freeze()
+    return data, { k: getattr(args, k) for k in LOADER_FIELDS if hasattr(args, k) }
+
+
+def run(args, data, loader_args, threads, result_path):
+    """
+    Body of a forked run.
+    """
+    torch.set_num_threads(threads)
+    log = open(os.path.join(args.save_dir, 'stdout.log'), 'w')
+    sys.stdout = sys.stderr = log
+    for k, v in loader_args.items():
+        setattr(args, k, v)
+    args.rank = 0
+    train.setup_logging(args.save_dir, to_file=False) # the log handler writes to the redirected stderr
+    summary = train.train(args, data)
+    with open(result_path + '.tmp', 'w') as f:
+        json.dump(summary, f)
+    os.replace(result_path + '.tmp', result_path)
+    log.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spec', required=True, help='json sweep spec, see the docstring of sweep.py')
+    parser.add_argument('--out-dir', required=True)
+    parser.add_argument('--parallel', default=2, type=int, help='number of runs at a time')
+    parser.add_argument('--threads-per-run', type=int, help='torch intra-op threads of each run, default is the cores divided by --parallel')
+    parser.add_argument('--dry-run', action='store_true', help='only print the train.py arguments of the runs')
+    args = parser.parse_args()
+    threads = args.threads_per_run or max(1, (os.cpu_count() or 1) // args.parallel)
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    configs = expand_spec(spec)
+    os.makedirs(args.out_dir, exist_ok=True)
+    runs = []
+    for i, config in enumerate(configs):
+        save_dir = os.path.join(args.out_dir, 'run-%03d' % i)
+        run_args = train.parse_args(to_argv(config, save_dir))
+        if run_args.world_size > 1 or run_args.cuda:
+            parser.error('sweep runs are single process cpu runs')
+        runs.append((i, config, run_args))
+        print('run-%03d: %s' % (i, ' '.join(to_argv(config, save_dir)[2:])))
+    if args.dry_run:
+        return
+
+    # no parallel region in this process, so that the forked runs can start their own thread pools
+    torch.set_num_threads(1)
+    ctx = multiprocessing.get_context('fork')
+    shared = {} # data key -> (data, loader args)
+    running = {} # sentinel -> (process, run index, run args)
+    results = {}
+    def wait_one():
+        sentinel = wait(list(running))[0]
+        process, i, run_args = running.pop(sentinel)
+        process.join()
+        result_path = os.path.join(run_args.save_dir, 'result.json')
+        if process.exitcode == 0 and os.path.exists(result_path):
+            with open(result_path) as f:
+                results[i] = json.load(f)
+            print(f'run-{i:03d} done: {results[i]}')
+        else:
+            print(f'run-{i:03d} failed with exit code {process.exitcode}, see {run_args.save_dir}/stdout.log')
+        sys.stdout.flush()
+
+    for i, config, run_args in runs:
+        result_path = os.path.join(run_args.save_dir, 'result.json')
+        if os.path.exists(result_path):
+            with open(result_path) as f:
+                results[i] = json.load(f)
+            print(f'run-{i:03d} already done')
+            continue
+        key = tuple(getattr(run_args, k) for k in DATA_FIELDS)
+        if key not in shared:
+            print(f'loading data for {dict(zip(DATA_FIELDS, key))}')
+            shared[key] = load_shared_data(argparse.Namespace(**vars(run_args)))
+        while len(running) >= args.parallel:
+            wait_one()
+        if os.path.exists(run_args.save_dir):
+            shutil.rmtree(run_args.save_dir)
+        os.makedirs(run_args.save_dir)
+        data, loader_args = shared[key]
+        process = ctx.Process(target=run, args=(run_args, data, loader_args, threads, result_path))
+        sys.stdout.flush() # or the buffered output is printed again by the child
+        process.start()
+        running[process.sentinel] = (process, i, run_args)
+    while running:
+        wait_one()
+
+    rows = []
+    for i, config, run_args in runs:
+        result = results.get(i, {})
+        row = { 'run': 'run-%03d' % i }
+        row.update(config)
+        for k in ['best_valid_accuracy', 'test_accuracy', 'steps', 'sentences_per_sec', 'tokens_per_sec']:
+            value = result.get(k)
+            row[k] = round(value, 4) if isinstance(value, float) else value
+        rows.append(row)
+    rows.sort(key=lambda r: -(r['best_valid_accuracy'] or 0))
+    write_results(rows, {'spec': spec, 'threads_per_run': threads},
+                  os.path.join(args.out_dir, 'results.csv'), os.path.join(args.out_dir, 'results.json'))
+    print('%-8s %10s %10s %12s' % ('run', 'dev', 'test', 'sent/s'))
+    for row in rows:
+        print('%-8s %10s %10s %12s' % (row['run'], row['best_valid_accuracy'], row['test_accuracy'], row['sentences_per_sec']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import torch
+
+import train
+from utils.vocab import IdVocab
+
+WORDS = ['<unk>', '<pad>'] + ['w%d' % i for i in range(20)]
+
+
+def make_args(save_dir, data_type, model_type, *extra):
+    """
+    train.py arguments of a tiny model, with what the loaders set on args.
+    """
+    args = train.parse_args([
+            '--save-dir', str(save_dir), '--data-path', str(save_dir),
+            '--data-type', data_type, '--model-type', model_type,
+            '--word-dim', '8', '--hidden-dim', '16', '--clf-hidden-dim', '16', '--clf-num-layers', '1',
+            '--dropout', '0.1', '--batch-size', '4', '--max-epoch', '1', '--lr', '0.001', '--l2reg', '0',
+            '--clip', '5', '--optimizer', 'adam', '--patience', '1', '--sample-num', '2', *extra])
+    args.device = torch.device('cpu')
+    args.rank = 0
+    args.num_words = len(WORDS)
+    args.num_classes = 3 if data_type == 'snli' else 2
+    args.vocab = IdVocab(WORDS)
+    return args
+
+
+def random_words(lengths, generator):
+    # a padded batch of word ids, the real words start after <unk> and <pad>
+    words = torch.full((len(lengths), max(lengths)), WORDS.index('<pad>'), dtype=torch.long)
+    for i, l in enumerate(lengths):
+        words[i, :l] = torch.randint(2, len(WORDS), (l,), generator=generator)
+    return words, torch.LongTensor(lengths)
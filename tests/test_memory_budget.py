@@ -0,0 +1,39 @@
+import torch
+from torch import nn, optim
+
+import train
+from model.SingleModel import SingleModel
+from tests.helpers import make_args, random_words
+from utils.memory_budget import batch_mb, split_batch, merge_singletons
+
+
+def test_merge_singletons():
+    assert merge_singletons([[0], [1, 2, 3]]) == [[0, 1], [2, 3]]
+    assert merge_singletons([[0], [1, 2]]) == [[0, 1, 2]]
+    assert merge_singletons([[0, 1, 2], [3, 4], [5]]) == [[0, 1, 2], [3, 4, 5]]
+    assert merge_singletons([[0, 1, 2], [3]]) == [[0, 1], [2, 3]]
+    assert merge_singletons([[0, 1], [2], [3]]) == [[0, 1], [2, 3]]
+    assert merge_singletons([[0]]) == [[0]]
+
+
+def test_split_over_budget_example_with_batchnorm(tmp_path):
+    lengths = [3, 12, 2, 3, 2, 3]
+    args = make_args(tmp_path, 'sst2', 'STG', '--use-batchnorm')
+    # the sentence of 12 words is over the budget alone
+    args.memory_budget = batch_mb([[3, 3, 3]], args)
+    assert batch_mb([[12]], args) > args.memory_budget
+    torch.manual_seed(0)
+    generator = torch.Generator().manual_seed(0)
+    words, length = random_words(lengths, generator)
+    batch = ({'words': words, 'length': length}, torch.LongTensor([0, 1, 0, 1, 1, 0]))
+
+    micro_batches = split_batch(batch, args.memory_budget, args)
+
+    assert len(micro_batches) > 1
+    assert all(len(label) >= 2 for _, label in micro_batches)
+    assert sorted(l for model_arg, _ in micro_batches for l in model_arg['length'].tolist()) == sorted(lengths)
+    model = SingleModel(**vars(args))
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = optim.Adam(params, lr=args.lr)
+    loss, accuracy = train.train_iter(args, micro_batches, model, params, nn.CrossEntropyLoss(), optimizer)
+    assert torch.isfinite(loss)
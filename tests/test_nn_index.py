@@ -0,0 +1,24 @@
+import numpy as np
+import torch
+
+from utils.nn_index import ExactIndex, IVFIndex
+
+
+def test_ivf_batched_search_matches_exact():
+    rng = np.random.RandomState(0)
+    embeddings = rng.randn(500, 16).astype(np.float32)
+    queries = rng.randn(37, 16).astype(np.float32)
+    exact_scores, exact_ids = ExactIndex(embeddings, block_size=128).search(queries, k=5)
+    ivf = IVFIndex(embeddings, block_size=128, num_lists=8).train(sample_size=200, iters=5)
+
+    # probing every list scans every row once, as the exact search
+    scores, ids = ivf.search(queries, k=5, nprobe=8)
+    assert torch.equal(ids, exact_ids)
+    assert torch.allclose(scores, exact_scores, atol=1e-5)
+
+    # a batch gives the same result as the queries one at a time
+    scores, ids = ivf.search(queries, k=5, nprobe=2)
+    for q in [0, 13, 36]:
+        single_scores, single_ids = ivf.search(queries[q:q+1], k=5, nprobe=2)
+        assert torch.equal(single_ids[0], ids[q])
+        assert torch.allclose(single_scores[0], scores[q])
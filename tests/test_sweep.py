@@ -0,0 +1,14 @@
+import sweep
+
+
+def test_runs_get_distinct_seeds():
+    spec = {'base': {'lr': 0.001}, 'grid': {'hidden-dim': [16, 32]},
+            'random': {'dropout': {'uniform': [0.1, 0.5]}}, 'num_samples': 3, 'seed': 5}
+    configs = sweep.expand_spec(spec)
+    assert [c['seed'] for c in configs] == list(range(5, 11))
+    assert '--seed' in sweep.to_argv(configs[0], 'run-000')
+
+
+def test_explicit_seed_is_kept():
+    configs = sweep.expand_spec({'base': {'seed': 3}, 'grid': {'lr': [0.1, 0.01]}})
+    assert [c['seed'] for c in configs] == [3, 3]
@@ -0,0 +1,27 @@
+import torch
+from torch import nn, optim
+
+import train
+from model.PairModel import PairModel
+from tests.helpers import make_args, random_words
+
+
+def test_snli_rl_step(tmp_path):
+    args = make_args(tmp_path, 'snli', 'RL')
+    torch.manual_seed(0)
+    generator = torch.Generator().manual_seed(0)
+    model = PairModel(**vars(args))
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = optim.Adam(params, lr=args.lr)
+    pre, pre_length = random_words([5, 4, 3, 2], generator)
+    hyp, hyp_length = random_words([2, 6, 3, 1], generator)
+    batch = ({'pre': pre, 'pre_length': pre_length, 'hyp': hyp, 'hyp_length': hyp_length}, torch.LongTensor([0, 1, 2, 1]))
+    before = [p.detach().clone() for p in params]
+
+    loss, rl_loss, accuracy = train.train_rl_iter(args, [batch], model, params, nn.CrossEntropyLoss(), optimizer)
+
+    assert torch.isfinite(loss)
+    assert 0 <= accuracy.item() <= 1
+    assert any(not torch.equal(b, p) for b, p in zip(before, params))
+    _, supplements = model(**batch[0])
+    assert len(supplements['sample_trees']) == len(supplements['sample_logits'])
@@ -1,14 +1,20 @@
 import argparse
+import contextlib
 import logging
 import os
+import random
+import socket
 import time
 import shutil
 from collections import defaultdict
 
+import numpy as np
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from torch import nn, optim
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import lr_scheduler
-from torch.nn.utils import clip_grad_norm_
 from torch.nn.functional import softmax
 
 from model.SingleModel import SingleModel
@@ -16,79 +22,137 @@ from model.PairModel import PairModel
 from age.dataLoader import AGE2
 from sst.dataLoader import SST
 from snli.dataLoader import SNLI
+from stream.dataLoader import StreamData
 from evaluate import eval_iter
+from utils import timing
+from utils.profiling import StepProfiler, step_range
+from utils.optimizers import OptimizerGroup, SchedulerGroup, clip_grad_norm
+from utils.eval_cache import CachedBatches
+from utils.memory_budget import split_batch, SplitStats
+from utils.vocab import id_to_word_list
+from utils.checkpoint import AsyncCheckpointer, latest_checkpoint, load_checkpoint, get_rng_state, set_rng_state
 
 
-def train_iter(args, batch, model, params, criterion, optimizer):
+def accumulate(model, last):
+    # with DistributedDataParallel, only all-reduce the gradients of the last micro-batch
+    if last or not hasattr(model, 'no_sync'):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+
+def train_iter(args, micro_batches, model, params, criterion, optimizer):
+    """
+    One optimizer step over a batch, given as its micro-batches (see --memory-budget).
+    The loss of each micro-batch is weighted by its share of the batch, so that the
+    accumulated gradients are those of the whole batch.
+    """
     model.train(True)
-    model_arg, label = batch
-    logits, supplements = model(**model_arg)
-    label_pred = logits.max(1)[1]
-    accuracy = torch.eq(label, label_pred).float().mean()
-    loss = criterion(input=logits, target=label)
-    optimizer.zero_grad()
-    loss.backward()
-    clip_grad_norm_(parameters=params, max_norm=args.clip)
-    optimizer.step()
-    return loss, accuracy
-
-
-def train_rl_iter(args, batch, model, params, criterion, optimizer):
+    batch_size = sum(len(label) for _, label in micro_batches)
+    total_loss = total_accuracy = 0
+    for m, (model_arg, label) in enumerate(micro_batches):
+        share = len(label) / batch_size
+        with accumulate(model, last=m == len(micro_batches) - 1):
+            logits, supplements = model(**model_arg)
+            with timing.phase('loss'):
+                label_pred = logits.max(1)[1]
+                accuracy = torch.eq(label, label_pred).float().mean()
+                loss = criterion(input=logits, target=label) * share
+            with timing.phase('backward'):
+                if m == 0:
+                    optimizer.zero_grad()
+                loss.backward()
+        total_loss += loss.detach()
+        total_accuracy += accuracy * share
+    with timing.phase('optimizer'):
+        clip_grad_norm(parameters=params, max_norm=args.clip)
+        optimizer.step()
+    return total_loss, total_accuracy
+
+
+def train_rl_iter(args, micro_batches, model, params, criterion, optimizer):
+    """
+    Like train_iter. The rl loss averages over the words of each micro-batch, so a split
+    batch weights the words a little differently than the whole batch would.
+    """
     model.train(True)
-    model_arg, label = batch
     sample_num = args.sample_num
-    logits, supplements = model(**model_arg)
-    label_pred = logits.max(1)[1]
-    accuracy = torch.eq(label, label_pred).float().mean()
-    sv_loss = criterion(input=logits, target=label)
-    ###########################
-    # rl training loss for sampled trees
-    sample_logits, probs, sample_trees = supplements['sample_logits'], supplements['probs'], supplements['sample_trees']
-    sample_label_pred = sample_logits.max(1)[1]
-    sample_label_gt = label.unsqueeze(1).expand(-1, sample_num).contiguous().view(-1)
-    
-    rl_rewards = torch.eq(sample_label_gt, sample_label_pred).float().detach() * 2 - 1
-    rl_loss = 0
-    # average of word
-    final_probs = defaultdict(list)
-    for i in range(len(label)):
-        cand_rewards = rl_rewards[i*sample_num: (i+1)*sample_num]
-        for j in range(sample_num):
-            k = i * sample_num + j
-            for w in probs[k]:
-                final_probs[w] += [p*rl_rewards[k] for p in probs[k][w]]
-    for w in final_probs:
-        rl_loss += - sum(final_probs[w]) / len(final_probs[w])
-    if len(final_probs) > 0:
-        rl_loss /= len(final_probs)
-
-    rl_loss *= args.rl_weight
-    ###########################
-    total_loss = sv_loss + rl_loss
-    optimizer.zero_grad()
-    total_loss.backward()
-    clip_grad_norm_(parameters=params, max_norm=args.clip)
-    optimizer.step()
-    return total_loss, rl_loss, accuracy
-
-
-
-
-def train(args):
+    batch_size = sum(len(label) for _, label in micro_batches)
+    sum_loss = sum_rl_loss = sum_accuracy = 0
+    for m, (model_arg, label) in enumerate(micro_batches):
+        share = len(label) / batch_size
+        with accumulate(model, last=m == len(micro_batches) - 1):
+            logits, supplements = model(**model_arg)
+            with timing.phase('loss'):
+                label_pred = logits.max(1)[1]
+                accuracy = torch.eq(label, label_pred).float().mean()
+                sv_loss = criterion(input=logits, target=label)
+            ###########################
+            # rl training loss for sampled trees
+            with timing.phase('rl_loss'):
+                sample_logits, probs = supplements['sample_logits'], supplements['probs']
+                sample_label_pred = sample_logits.max(1)[1]
+                sample_label_gt = label.unsqueeze(1).expand(-1, sample_num).contiguous().view(-1)
+            
+                rl_rewards = torch.eq(sample_label_gt, sample_label_pred).float().detach() * 2 - 1
+                rl_loss = 0
+                # average of word
+                final_probs = defaultdict(list)
+                for i in range(len(label)):
+                    cand_rewards = rl_rewards[i*sample_num: (i+1)*sample_num]
+                    for j in range(sample_num):
+                        k = i * sample_num + j
+                        for w in probs[k]:
+                            final_probs[w] += [p*rl_rewards[k] for p in probs[k][w]]
+                for w in final_probs:
+                    rl_loss += - sum(final_probs[w]) / len(final_probs[w])
+                if len(final_probs) > 0:
+                    rl_loss /= len(final_probs)
+
+                rl_loss *= args.rl_weight
+            ###########################
+            total_loss = (sv_loss + rl_loss) * share
+            with timing.phase('backward'):
+                if m == 0:
+                    optimizer.zero_grad()
+                total_loss.backward()
+        sum_loss += total_loss.detach()
+        sum_rl_loss += (rl_loss.detach() if torch.is_tensor(rl_loss) else rl_loss) * share
+        sum_accuracy += accuracy * share
+    with timing.phase('optimizer'):
+        clip_grad_norm(parameters=params, max_norm=args.clip)
+        optimizer.step()
+    return sum_loss, sum_rl_loss, sum_accuracy
+
+
+
+
+def train(args, data=None):
+    """
+    Args:
+        data: a loaded data loader to train on, e.g. shared by the runs of sweep.py. Its
+            num_classes, num_words and vocab must already be set on args.
+    Returns:
+        summary of the run: best valid accuracy, test accuracy of the best model, throughput
+    """
     device = torch.device('cuda' if args.cuda else 'cpu')
     args.device = device
+    is_master = args.rank == 0
+    if args.seed is not None:
+        # different dropout masks and tree samples on each rank
+        seed = args.seed + args.rank
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+    if args.memory_budget and args.use_batchnorm and is_master:
+        logging.warning('* --use-batchnorm with --memory-budget: the batch norm statistics of a split batch '
+                        'are those of each micro-batch, not of the whole batch')
+    if args.tree_threads > 1:
+        # each tree thread runs small ops, give the cores to the threads instead of the ops
+        torch.set_num_threads(max(1, torch.get_num_threads() // args.tree_threads))
 
     ################################  data  ###################################
-    if args.data_type == 'sst2':
-        args.fine_grained = False
-        data = SST(args) # some extra info will be appended into args
-    elif args.data_type == 'sst5':
-        args.fine_grained = True
-        data = SST(args)
-    elif args.data_type == 'age':
-        data = AGE2(args)
-    elif args.data_type == 'snli':
-        data = SNLI(args)
+    if data is None:
+        data = load_data(args)
     num_train_batches = data.num_train_batches # number of batches per epoch
     ################################  model  ###################################
     if args.data_type == 'snli':
@@ -96,8 +160,9 @@ def train(args):
     else:
         Model = SingleModel
     model_kwargs = { k:v for k,v in vars(args).items() if k in
-            {'data_type', 'model_type', 'leaf_rnn_type', 'rank_input', 'word_dim', 'hidden_dim', 'clf_hidden_dim', 'clf_num_layers', 'dropout', 'use_batchnorm'}
+            {'data_type', 'model_type', 'leaf_rnn_type', 'rank_input', 'word_dim', 'hidden_dim', 'clf_hidden_dim', 'clf_num_layers', 'dropout', 'use_batchnorm', 'chunk_size', 'chunk_by', 'max_tree_depth'}
             } # just for save, not complete for Model __init__
+    vocab = id_to_word_list(args.vocab) # saved with the model for model.ARTreeEncoder
     model = Model(**vars(args))
     if data.weight is not None:
         logging.info('* Loading GloVe pretrained vectors...')
@@ -116,71 +181,293 @@ def train(args):
         optimizer_class = optim.Adagrad
     elif args.optimizer == 'adadelta':
         optimizer_class = optim.Adadelta
-    optimizer = optimizer_class(params=params, lr=args.lr, weight_decay=args.l2reg)
-    scheduler = lr_scheduler.ReduceLROnPlateau(optimizer=optimizer, mode='max', factor=0.5, patience=args.patience, verbose=True)
+    if args.sparse_embedding and model.word_embedding.weight.requires_grad:
+        # only the rows of the words in a batch are updated, the sparse updates have no weight decay
+        sparse_lr = args.sparse_lr or args.lr
+        dense_params = [p for p in params if p is not model.word_embedding.weight]
+        if args.optimizer == 'adam':
+            logging.info(f'* Will update word embeddings with SparseAdam, lr {sparse_lr}')
+            sparse_optimizer = optim.SparseAdam(params=[model.word_embedding.weight], lr=sparse_lr)
+        else: # Adagrad accepts sparse gradients itself
+            logging.info(f'* Will update word embeddings with sparse Adagrad, lr {sparse_lr}')
+            sparse_optimizer = optim.Adagrad(params=[model.word_embedding.weight], lr=sparse_lr)
+        optimizers = [
+                sparse_optimizer,
+                optimizer_class(params=dense_params, lr=args.lr, weight_decay=args.l2reg)]
+        optimizer = OptimizerGroup(optimizers)
+        scheduler = SchedulerGroup([lr_scheduler.ReduceLROnPlateau(optimizer=o, mode='max', factor=0.5, patience=args.patience, verbose=True) for o in optimizers])
+    else:
+        optimizer = optimizer_class(params=params, lr=args.lr, weight_decay=args.l2reg)
+        scheduler = lr_scheduler.ReduceLROnPlateau(optimizer=optimizer, mode='max', factor=0.5, patience=args.patience, verbose=True)
     criterion = nn.CrossEntropyLoss()
-    trpack = [model, params, criterion, optimizer]
+    if args.world_size > 1:
+        # tree shapes vary across ranks and the rl loss does not reach every parameter
+        train_model = DistributedDataParallel(model, find_unused_parameters=True)
+    else:
+        train_model = model
+    trpack = [train_model, params, criterion, optimizer]
 
     #logging.info(f'num_train_batches: {num_train_batches}')
-    validate_every = num_train_batches // 10
+    validate_every = max(1, num_train_batches // 10)
+    print_every = max(1, num_train_batches // 100)
+    checkpoint_every = args.checkpoint_every or validate_every
     best_vaild_accuacy = 0
-    tic = time.time()
-
-    for epoch_num in range(args.max_epoch):
-        for batch_iter, train_batch in enumerate(data.train_minibatch_generator()):
-            progress = epoch_num + batch_iter / num_train_batches
-            ################################# train iteration ####################################
-            if args.model_type == 'Choi':
-                train_loss, train_accuracy = train_iter(args, train_batch, *trpack)
-            elif args.model_type == 'RL':
-                train_loss, train_rl_loss, train_accuracy = train_rl_iter(args, train_batch, *trpack)
-            elif args.model_type == 'STG':
-                train_loss, train_accuracy = train_iter(args, train_batch, *trpack)
-            else:
-                raise Exception('unknown model')
-            ########################################################################################
-            if (batch_iter + 1) % (num_train_batches // 100) == 0:
-                tac = (time.time() - tic) / 60
-                print(f'   {tac:.2f} minutes\tprogress: {progress:.2f}, loss: {train_loss.item():.4f}')
-            if (batch_iter + 1) % validate_every == 0:
-                correct_sum = 0
-                for valid_batch in data.dev_minibatch_generator():
-                    correct, supplements = eval_iter(valid_batch, model)
-                    correct_sum += correct
-                valid_accuracy = correct_sum / data.num_valid
-                scheduler.step(valid_accuracy)
-                logging.info(f'Epoch {progress:.2f}: '
-                             f'valid accuracy = {valid_accuracy:.4f}')
-                if valid_accuracy > best_vaild_accuacy:
-                    correct_sum = 0
-                    for test_batch in data.test_minibatch_generator():
-                        correct, supplements = eval_iter(test_batch, model)
-                        correct_sum += correct
-                    test_accuracy = correct_sum / data.num_test
-                    best_vaild_accuacy = valid_accuracy
-                    model_filename = (f'model-{progress:.2f}'
-                            f'-{valid_accuracy:.3f}'
-                            f'-{test_accuracy:.3f}.pkl')
-                    model_path = os.path.join(args.save_dir, model_filename)
-                    save_checkpoint(model, model_kwargs, model_path) 
-
-def save_checkpoint(model, model_kwargs, path):
+    best_test_accuracy = None
+    dev_batches = test_batches = None # built at the first evaluation, then reused
+    start_epoch, start_batch, elapsed = 0, 0, 0
+    resume_state = None
+    if args.resume:
+        resume_path = latest_checkpoint(args.save_dir)
+        if resume_path is None:
+            logging.info('* No checkpoint to resume from, start from scratch')
+        else:
+            logging.info(f'* Resume from {resume_path}')
+            resume_state = load_checkpoint(resume_path)
+            model.load_state_dict(resume_state['model'])
+            optimizer.load_state_dict(resume_state['optimizer'])
+            scheduler.load_state_dict(resume_state['scheduler'])
+            best_vaild_accuacy = resume_state['best_valid_accuracy']
+            best_test_accuracy = resume_state.get('best_test_accuracy')
+            start_epoch, start_batch = resume_state['epoch'], resume_state['batch_iter'] + 1
+            elapsed = resume_state['elapsed']
+            rank_rngs = resume_state.get('rank_rngs')
+            if rank_rngs is not None and len(rank_rngs) == args.world_size:
+                resume_state['epoch_rng'], resume_state['rng'] = rank_rngs[args.rank]
+            elif args.rank > 0:
+                # the checkpoint only has the streams of rank 0, give this rank its own
+                logging.warning(f'* No random state of rank {args.rank} in the checkpoint, reseeding it')
+                reseed = random.Random(((args.seed or 0) + args.rank) * 100003 + resume_state['batch_iter'])
+                for key in ['epoch_rng', 'rng']:
+                    random.seed(reseed.getrandbits(32))
+                    np.random.seed(reseed.getrandbits(32))
+                    torch.manual_seed(reseed.getrandbits(32))
+                    resume_state[key] = get_rng_state()
+    checkpointer = AsyncCheckpointer(args.save_dir, keep=args.keep_checkpoints) if is_master else None
+    if args.timing_every > 0 and is_master:
+        timing.set_timer(timing.PhaseTimer(os.path.join(args.save_dir, 'timing.jsonl'),
+            log_every=args.timing_every, window=args.timing_window, sync_cuda=args.cuda))
+    profiler = None
+    if args.profile_steps is not None and is_master:
+        profiler = StepProfiler(args.profile_steps, args.save_dir, 'train', use_cuda=args.cuda)
+    tic = time.time() - elapsed
+    global_step = start_epoch * num_train_batches + start_batch
+    num_steps = num_sentences = num_tokens = 0 # of this process, for the summary
+    split_stats = SplitStats()
+    eval_seconds = 0.
+
+    finished = False
+    try:
+        for epoch_num in range(start_epoch, args.max_epoch):
+            if resume_state is not None and epoch_num == start_epoch:
+                # replay the data order of the interrupted epoch
+                set_rng_state(resume_state['epoch_rng'])
+            epoch_rng = get_rng_state()
+            if args.world_size > 1:
+                data.set_epoch(epoch_num)
+            for batch_iter, train_batch in enumerate(timing.timed_iter(data.train_minibatch_generator())):
+                if resume_state is not None:
+                    if batch_iter < start_batch:
+                        continue
+                    set_rng_state(resume_state['rng'])
+                    resume_state = None
+                progress = epoch_num + batch_iter / num_train_batches
+                if profiler is not None:
+                    profiler.before_step(global_step)
+                ################################# train iteration ####################################
+                if args.memory_budget:
+                    micro_batches = split_batch(train_batch, args.memory_budget, args)
+                    split_stats.update(len(micro_batches))
+                else:
+                    micro_batches = [train_batch]
+                if args.model_type == 'Choi':
+                    train_loss, train_accuracy = train_iter(args, micro_batches, *trpack)
+                elif args.model_type == 'RL':
+                    train_loss, train_rl_loss, train_accuracy = train_rl_iter(args, micro_batches, *trpack)
+                elif args.model_type == 'STG':
+                    train_loss, train_accuracy = train_iter(args, micro_batches, *trpack)
+                else:
+                    raise Exception('unknown model')
+                if profiler is not None:
+                    profiler.after_step(global_step)
+                global_step += 1
+                model_arg, label = train_batch
+                batch_tokens = sum(v.sum().item() for k, v in model_arg.items() if k.endswith('length'))
+                num_steps += 1
+                num_sentences += len(label)
+                num_tokens += batch_tokens
+                if timing.get_timer() is not None:
+                    timing.get_timer().end_step(num_sentences=len(label), num_tokens=batch_tokens)
+                ########################################################################################
+                if (batch_iter + 1) % print_every == 0 and is_master:
+                    tac = (time.time() - tic) / 60
+                    print(f'   {tac:.2f} minutes\tprogress: {progress:.2f}, loss: {train_loss.item():.4f}')
+                    if args.dedup:
+                        stats = model.dedup_stats
+                        print(f'   dedup hit rate: {stats.hit_rate():.2%} of {stats.num_sentences} sentences')
+                        stats.reset()
+                    if args.memory_budget:
+                        print(f'   memory budget: split {split_stats.split_rate():.2%} of {split_stats.num_batches} batches '
+                              f'into {split_stats.num_micro_batches} micro-batches')
+                        split_stats.reset()
+                with timing.suspend():
+                    eval_tic = time.time()
+                    if (batch_iter + 1) % validate_every == 0:
+                        if is_master:
+                            if dev_batches is None:
+                                dev_batches = CachedBatches(data.dev_minibatch_generator(), args.batch_size)
+                            correct_sum = 0
+                            for valid_batch in dev_batches:
+                                correct, supplements = eval_iter(valid_batch, model)
+                                correct_sum += correct
+                            valid_accuracy = correct_sum / data.num_valid
+                        if args.world_size > 1:
+                            # only rank 0 validates, the others follow its lr schedule
+                            valid_accuracy = broadcast_float(valid_accuracy if is_master else 0.)
+                        scheduler.step(valid_accuracy)
+                        if is_master:
+                            logging.info(f'Epoch {progress:.2f}: '
+                                         f'valid accuracy = {valid_accuracy:.4f}')
+                        if valid_accuracy > best_vaild_accuacy and is_master:
+                            if test_batches is None:
+                                test_batches = CachedBatches(data.test_minibatch_generator(), args.batch_size)
+                            correct_sum = 0
+                            for test_batch in test_batches:
+                                correct, supplements = eval_iter(test_batch, model)
+                                correct_sum += correct
+                            test_accuracy = correct_sum / data.num_test
+                            best_vaild_accuacy = valid_accuracy
+                            best_test_accuracy = test_accuracy
+                            model_filename = (f'model-{progress:.2f}'
+                                    f'-{valid_accuracy:.3f}'
+                                    f'-{test_accuracy:.3f}.pkl')
+                            model_path = os.path.join(args.save_dir, model_filename)
+                            save_checkpoint(checkpointer, model, model_kwargs, vocab, model_path)
+                    if (batch_iter + 1) % checkpoint_every == 0:
+                        # every rank saves its own random streams (dropout, tree sampling)
+                        rank_rngs = gather_objects((epoch_rng, get_rng_state()), args.world_size)
+                    if (batch_iter + 1) % checkpoint_every == 0 and is_master:
+                        state = {
+                                'model': model.state_dict(),
+                                'model_kwargs': model_kwargs,
+                                'vocab': vocab,
+                                'optimizer': optimizer.state_dict(),
+                                'scheduler': scheduler.state_dict(),
+                                'epoch': epoch_num,
+                                'batch_iter': batch_iter,
+                                'epoch_rng': epoch_rng,
+                                'rng': get_rng_state(),
+                                'rank_rngs': rank_rngs,
+                                'best_valid_accuracy': best_vaild_accuacy,
+                                'best_test_accuracy': best_test_accuracy,
+                                'elapsed': time.time() - tic,
+                                }
+                        checkpointer.save_state(state, global_step)
+                    eval_seconds += time.time() - eval_tic
+                if args.max_steps and global_step >= args.max_steps:
+                    finished = True
+                    break
+            if resume_state is not None:
+                # the interrupted epoch was finished before being checkpointed
+                set_rng_state(resume_state['rng'])
+                resume_state = None
+            if finished:
+                break
+    finally:
+        # also on errors, so that the checkpoints already queued are written
+        if checkpointer is not None:
+            checkpointer.close()
+        timing.set_timer(None)
+        if profiler is not None:
+            profiler.stop()
+    train_seconds = time.time() - tic - elapsed - eval_seconds
+    return {
+            'best_valid_accuracy': best_vaild_accuacy,
+            'test_accuracy': best_test_accuracy,
+            'steps': num_steps,
+            'train_seconds': train_seconds,
+            'sentences_per_sec': num_sentences / train_seconds if train_seconds > 0 else None,
+            'tokens_per_sec': num_tokens / train_seconds if train_seconds > 0 else None,
+            }
+
+
+def load_data(args):
+    # some extra info (num_classes, num_words, vocab) will be appended into args
+    if getattr(args, 'stream', False):
+        return StreamData(args)
+    if args.data_type == 'sst2':
+        args.fine_grained = False
+        return SST(args)
+    elif args.data_type == 'sst5':
+        args.fine_grained = True
+        return SST(args)
+    elif args.data_type == 'age':
+        return AGE2(args)
+    elif args.data_type == 'snli':
+        return SNLI(args)
+
+def save_checkpoint(checkpointer, model, model_kwargs, vocab, path):
     state = {
             'model': model.state_dict(),
-            'model_kwargs': model_kwargs
+            'model_kwargs': model_kwargs,
+            'vocab': vocab,
             }
-    torch.save(state, path)
-    print(f'Saved the new best model to {path}')
+    checkpointer.save(state, path)
+    print(f'Saving the new best model to {path}')
 
 
+def gather_objects(obj, world_size):
+    # the objects of all ranks, in the order of the ranks
+    if world_size == 1:
+        return [obj]
+    objects = [None] * world_size
+    dist.all_gather_object(objects, obj)
+    return objects
 
-def main():
+
+def broadcast_float(value, src=0):
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.broadcast(tensor, src=src)
+    return tensor.item()
+
+
+def setup_logging(save_dir, to_file):
+    # a simple log file, the same content as stdout
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+    if to_file:
+        logFormatter = logging.Formatter('%(asctime)s %(levelname)-8s %(message)s')
+        rootLogger = logging.getLogger()
+        fileHandler = logging.FileHandler(os.path.join(save_dir, 'stdout.log'))
+        fileHandler.setFormatter(logFormatter)
+        rootLogger.addHandler(fileHandler)
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def distributed_worker(rank, args, port):
+    args.rank = rank
+    setup_logging(args.save_dir, to_file=rank == 0)
+    if rank != 0:
+        logging.getLogger().setLevel(logging.WARNING)
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=args.world_size)
+    # share the cores among the ranks instead of oversubscribing them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.world_size))
+    try:
+        train(args)
+    finally:
+        dist.destroy_process_group()
+
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser() 
     # path parameters
     parser.add_argument('--save-dir', required=True)
     parser.add_argument('--data-path', required=True)
-    parser.add_argument('--glove-path')
-    parser.add_argument('--glove', default='glove.840B.300d', help='used only by torchtext')
+    parser.add_argument('--glove-path', help='pickled GloVe dict produced by pickle_glove.py')
     # model parameters, required when evaluate
     parser.add_argument('--data-type', required=True, choices=['sst2', 'sst5', 'age', 'snli'])
     parser.add_argument('--model-type', required=True, choices=['Choi', 'RL', 'STG'])
@@ -205,26 +492,59 @@ def main():
     parser.add_argument('--optimizer')
     parser.add_argument('--patience', type=int)
     parser.add_argument('--fix-word-embedding', action='store_true')
+    parser.add_argument('--checkpoint-every', type=int, help='number of batches between full-state checkpoints, default is the validation interval')
+    parser.add_argument('--keep-checkpoints', default=3, type=int, help='number of full-state checkpoints to keep, at least 1')
+    parser.add_argument('--resume', action='store_true', help='resume from the latest full-state checkpoint in --save-dir')
+    parser.add_argument('--profile-steps', type=step_range, help='START:END, run torch.profiler over these training steps and save the trace into --save-dir')
+    parser.add_argument('--timing-every', default=0, type=int, help='write per-phase step timings to timing.jsonl every n steps, 0 (default) disables the timing')
+    parser.add_argument('--timing-window', default=1000, type=int, help='number of recent steps summarized in timing.jsonl')
+    parser.add_argument('--max-steps', type=int, help='stop after this number of training steps')
+    parser.add_argument('--world-size', default=1, type=int, help='number of data parallel cpu processes, gradients are all-reduced over gloo')
+    parser.add_argument('--seed', type=int, help='random seed, rank r uses seed+r')
+    parser.add_argument('--sparse-embedding', action='store_true', help='sparse word embedding gradients, updated by SparseAdam (--optimizer adam) or sparse Adagrad (--optimizer adagrad)')
+    parser.add_argument('--sparse-lr', type=float, help='learning rate of the sparse word embedding updates, default is --lr')
+    parser.add_argument('--dedup', action='store_true', help='encode each distinct sentence of a batch only once, e.g. SNLI premises and repeated SST phrases')
+    parser.add_argument('--tree-threads', default=1, type=int, help='number of threads building the trees of a batch (RL and STG), the intra-op threads are divided among them')
+    parser.add_argument('--chunk-size', default=0, type=int, help='split longer inputs into segments of at most this many words, encoded as a batch and composed by a second-level tree (RL and STG)')
+    parser.add_argument('--chunk-by', default='window', choices=['window', 'sentence'], help='with --chunk-size, whether segments also end after . ! and ?')
+    parser.add_argument('--max-tree-depth', default=0, type=int, help='pool the words below this depth of the RL and STG trees into one leaf (mean of their states), 0 builds the full tree')
+    parser.add_argument('--memory-budget', type=float, help='estimated activation memory (MB) a training batch may take, larger batches are split into micro-batches whose gradients are accumulated')
+    parser.add_argument('--stream', action='store_true', help='stream the training data from the shards in --data-path written by stream/dump_shards.py, instead of loading it into memory')
+    parser.add_argument('--shuffle-buffer', default=10000, type=int, help='with --stream, number of examples of the shuffle buffer')
+    parser.add_argument('--bucket-batches', default=100, type=int, help='with --stream, batches sorted by length together')
+    parser.add_argument('--stream-workers', default=0, type=int, help='with --stream, number of loader processes reading the shards')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.world_size > 1 and args.cuda:
+        parser.error('--world-size > 1 is only supported for cpu training')
+    if args.chunk_size and args.model_type == 'Choi':
+        parser.error('--chunk-size needs an AR-Tree encoder (RL or STG)')
+    if args.sparse_embedding and args.optimizer not in {'adam', 'adagrad'}:
+        parser.error('--sparse-embedding needs --optimizer adam or adagrad')
+    if args.keep_checkpoints < 1:
+        parser.error('--keep-checkpoints must be at least 1, the latest checkpoint is needed by --resume')
+    if args.stream_workers and not args.stream:
+        parser.error('--stream-workers needs --stream')
+    return args
 
-    #######################################
-    # a simple log file, the same content as stdout
-    if os.path.exists(args.save_dir):
-        shutil.rmtree(args.save_dir)
-    os.mkdir(args.save_dir)
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
-    logFormatter = logging.Formatter('%(asctime)s %(levelname)-8s %(message)s')
-    rootLogger = logging.getLogger()
-    fileHandler = logging.FileHandler(os.path.join(args.save_dir, 'stdout.log'))
-    fileHandler.setFormatter(logFormatter)
-    rootLogger.addHandler(fileHandler)
-    ########################################
 
-    for k, v in vars(args).items():
-        logging.info(k+':'+str(v))
+def main():
+    args = parse_args()
+
+    if os.path.exists(args.save_dir) and not args.resume:
+        shutil.rmtree(args.save_dir)
+    os.makedirs(args.save_dir, exist_ok=True)
 
-    train(args)
+    if args.world_size > 1:
+        for k, v in vars(args).items():
+            print(k+':'+str(v))
+        mp.spawn(distributed_worker, args=(args, find_free_port()), nprocs=args.world_size)
+    else:
+        args.rank = 0
+        setup_logging(args.save_dir, to_file=True)
+        for k, v in vars(args).items():
+            logging.info(k+':'+str(v))
+        train(args)
 
 
 if __name__ == '__main__':
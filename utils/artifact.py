@@ -0,0 +1,106 @@
+"""
+Self-contained inference artifacts: model kwargs, vocab and weights in one file that
+is loaded with torch.load(mmap=True), so that no dataset is needed to build the model,
+the weights are paged in lazily and processes loading the same file share its pages.
+"""
+import zipfile
+
+import torch
+
+from utils.vocab import IdVocab, id_to_word_list
+
+
+FORMAT = 'artree-inference'
+VERSION = 1
+
+
+def make_artifact(checkpoint, vocab=None):
+    """
+    Args:
+        checkpoint: dict loaded from a checkpoint of train.py or prune_vocab.py
+        vocab: only needed if the checkpoint has no vocab, see ARTreeEncoder.from_checkpoint
+    """
+    if vocab is None:
+        if 'vocab' not in checkpoint:
+            raise ValueError('the checkpoint has no vocab, pass the vocab of its training data')
+        vocab = checkpoint['vocab']
+    state_dict = { k: v.detach().cpu().contiguous() for k, v in checkpoint['model'].items() }
+    model_kwargs = dict(checkpoint['model_kwargs'])
+    model_kwargs['num_words'] = state_dict['word_embedding.weight'].size(0)
+    model_kwargs['num_classes'] = state_dict['classifier.clf_linear.weight'].size(0)
+    artifact = {
+            'format': FORMAT,
+            'version': VERSION,
+            'model_kwargs': model_kwargs,
+            'vocab': id_to_word_list(vocab),
+            'model': state_dict,
+            }
+    if checkpoint.get('vocab_remap') is not None:
+        artifact['vocab_remap'] = checkpoint['vocab_remap']
+    return artifact
+
+
+def save_artifact(artifact, path):
+    # the zip format of torch.save keeps every storage as one uncompressed record, which mmap can map
+    torch.save(artifact, path)
+
+
+def is_artifact(loaded):
+    return isinstance(loaded, dict) and loaded.get('format') == FORMAT
+
+
+def load_file(path):
+    """
+    torch.load a checkpoint or an artifact, memory-mapped unless it is in the legacy
+    (pre zip) format of old torch versions.
+    """
+    return torch.load(path, map_location='cpu', mmap=zipfile.is_zipfile(path), weights_only=False)
+
+
+def read_artifact(path):
+    """
+    Returns:
+        the artifact dict, whose tensors are backed by the mapped file
+    """
+    loaded = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    if not is_artifact(loaded):
+        raise ValueError(f'{path} is not an inference artifact, export it with export_artifact.py')
+    if loaded['version'] > VERSION:
+        raise ValueError(f'{path} has artifact version {loaded["version"]}, this code reads up to {VERSION}')
+    return loaded
+
+
+def build_model(artifact, device='cpu', **kwargs):
+    """
+    Construct the model on the meta device, so that no memory is allocated or initialized
+    for parameters, then take the mapped tensors of the artifact as its parameters.
+    Args:
+        kwargs: runtime options of the model, e.g. tree_threads, dedup
+    Returns:
+        model: in eval mode, without gradients
+        vocab: IdVocab
+    """
+    from model.SingleModel import SingleModel
+    from model.PairModel import PairModel
+    vocab = IdVocab(artifact['vocab'])
+    model_kwargs = dict(artifact['model_kwargs'], vocab=vocab, **kwargs)
+    Model = PairModel if model_kwargs['data_type'] == 'snli' else SingleModel
+    with torch.device('meta'):
+        model = Model(**model_kwargs)
+    model.load_state_dict(artifact['model'], assign=True)
+    for name, tensor in list(model.named_parameters()) + list(model.named_buffers()):
+        if tensor.is_meta:
+            raise ValueError(f'{name} is missing from the artifact')
+    model.requires_grad_(False)
+    model.eval()
+    return model.to(device), vocab
+
+
+def load_artifact(path, device='cpu', **kwargs):
+    """
+    Returns:
+        model, vocab, the artifact dict (for its vocab_remap and model_kwargs)
+    """
+    artifact = read_artifact(path)
+    model, vocab = build_model(artifact, device, **kwargs)
+    return model, vocab, artifact
@@ -0,0 +1,125 @@
+import glob
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+STATE_PATTERN = 'state-%09d.pt'
+
+
+def get_rng_state():
+    state = {
+            'python': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+            }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def cpu_copy(obj):
+    """
+    Snapshot a (nested) state so that training can go on modifying the original tensors
+    while the copy is being written.
+    """
+    if torch.is_tensor(obj):
+        obj = obj.detach()
+        return obj.clone() if obj.device.type == 'cpu' else obj.cpu()
+    elif isinstance(obj, dict):
+        return type(obj)((k, cpu_copy(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return obj
+
+
+def list_checkpoints(save_dir):
+    return sorted(glob.glob(os.path.join(save_dir, STATE_PATTERN.replace('%09d', '[0-9]' * 9))))
+
+
+def latest_checkpoint(save_dir):
+    paths = list_checkpoints(save_dir)
+    return paths[-1] if paths else None
+
+
+def load_checkpoint(path):
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+
+class AsyncCheckpointer(object):
+    """
+    Write checkpoints from a background thread. The state is copied to cpu in the calling
+    thread, then serialized to a temporary file and atomically renamed. Only the last
+    `keep` full-state checkpoints are kept. close() waits for the pending writes, it is
+    also called when used as a context manager.
+    """
+    def __init__(self, save_dir, keep=3):
+        if keep < 1:
+            raise ValueError(f'keep must be at least 1, got {keep}')
+        self.save_dir = save_dir
+        self.keep = keep
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            state, path, rotate = item
+            try:
+                tmp_path = path + '.tmp'
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+                if rotate:
+                    for old in list_checkpoints(self.save_dir)[:-self.keep]:
+                        os.remove(old)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('failed to write checkpoint') from error
+
+    def save(self, state, path, rotate=False):
+        self._check()
+        self.queue.put((cpu_copy(state), path, rotate))
+
+    def save_state(self, state, step):
+        path = os.path.join(self.save_dir, STATE_PATTERN % step)
+        self.save(state, path, rotate=True)
+        return path
+
+    def wait(self):
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        if not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,73 @@
+import torch
+
+
+# word id tensors of the model kwargs of the loaders, and their length tensors
+LENGTH_KEYS = {'words': 'length', 'pre': 'pre_length', 'hyp': 'hyp_length'}
+
+
+def padding_value(words, length):
+    # the id the loader pads with, 0 if no sentence of the batch is padded
+    padded = torch.arange(words.size(1), device=words.device).unsqueeze(0) >= length.unsqueeze(1)
+    return words[padded][0].item() if padded.any() else 0
+
+
+class CachedBatches(object):
+    """
+    The batches of an evaluation split, built once and reused by every evaluation pass.
+    The examples are sorted by length and batched again, so each batch is padded to the
+    minimal width, and every tensor is already on the device of the loader.
+
+        dev_batches = CachedBatches(data.dev_minibatch_generator(), args.batch_size)
+        for model_arg, label in dev_batches:
+            logits, _ = model(**model_arg)
+        logits = dev_batches.restore(list_of_batch_logits) # in the order of the loader
+    """
+    def __init__(self, generator, batch_size):
+        rows, lengths, pads, labels = {}, {}, {}, []
+        for model_arg, label in generator:
+            for k in LENGTH_KEYS:
+                if k not in model_arg:
+                    continue
+                words, length = model_arg[k], model_arg[LENGTH_KEYS[k]]
+                pads.setdefault(k, padding_value(words, length))
+                length_list = length.tolist()
+                rows.setdefault(k, []).extend(words[i, :l] for i, l in enumerate(length_list))
+                lengths.setdefault(k, []).extend(length_list)
+            labels.append(label)
+        labels = torch.cat(labels)
+        self.num_examples = len(labels)
+        keys = list(rows)
+        order = sorted(range(self.num_examples), key=lambda i: tuple(lengths[k][i] for k in keys))
+        self.order = torch.LongTensor(order)
+        self.inverse = torch.empty_like(self.order)
+        self.inverse[self.order] = torch.arange(self.num_examples)
+
+        device = labels.device
+        self.batches = []
+        for b in range(0, self.num_examples, batch_size):
+            index = order[b:b+batch_size]
+            model_arg = {}
+            for k in keys:
+                length = [lengths[k][i] for i in index]
+                words = rows[k][0].new_full((len(index), max(length)), pads[k])
+                for j, i in enumerate(index):
+                    words[j, :length[j]] = rows[k][i]
+                model_arg[k] = words
+                model_arg[LENGTH_KEYS[k]] = torch.LongTensor(length).to(device)
+            self.batches.append((model_arg, labels[torch.LongTensor(index).to(device)].contiguous()))
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def restore(self, outputs):
+        """
+        Args:
+            outputs: list of the tensors computed on each batch, in the order of iteration
+        Returns:
+            the concatenated outputs in the order of the examples of the original generator
+        """
+        outputs = torch.cat(outputs)
+        return outputs[self.inverse.to(outputs.device)]
@@ -2,80 +2,131 @@ import torch
 import numpy as np
 
 
-def _parse_word_depth(length, select_masks):
+def decode_select_masks(length, select_masks):
     """
+    Replay the compositions of <BinaryTreeLSTM> on word spans for the whole batch at once.
+    At step i there are max_len-i nodes, and the selected node pair (j, j+1) is merged
+    into one node covering both spans.
     Args:
-        length: (batch_size, ). IntTensor
-            the sentence length of a batch
+        length: (batch_size, ). the sentence length of a batch
         select_masks: a list of length (max_len-2), i-th element is a Tensor of shape (batch_size, max_len-1-i)
-            parse results from <BinaryTreeLSTM.select_composition>
+            parse results from <BinaryTreeLSTM.select_composition>. The last composition
+            has a single option and no mask.
     Return:
-        Parsed results for each sentence. 
-        Specifically, parsed_results[i][j] is the depth of j-th word of i-th sentence. 
+        spans: (batch_size, max_len-1, 2). [first word, last word] of the node composed at each step
+        span_mask: (batch_size, max_len-1). whether the step composed a node, i.e. step < length-1
+        depths: (batch_size, max_len). depth of each word, the number of composed nodes covering it
     """
     batch_size = length.size(0)
-    length = unwrap_variable(length)
-    parsed_results = [] # for each batch/sentence
-    for idx in range(batch_size):
-    # idx-th batch, length of sentence = l
-        l = length[idx]
-        chart = np.zeros((l, l))
-        for i in range(l-1,0,-1):
-            # i-th row of chart, update (i-1)-th row of chart based on (i-1)-th element of select_masks
-            bias = 0 # next row bias
-            for j in range(l-i):
-                # j-th element of chart[i] and select_masks[i-1][idx]
-                # Note: len(select_masks)==(max_len-2), so the case of l==max_len should be considered
-                if i > len(select_masks) or select_masks[i-1][idx][j] == 1:
-                    chart[i-1][j+bias] = chart[i][j]+1
-                    bias += 1
-                    chart[i-1][j+bias] = chart[i][j]+1
-                else:
-                    chart[i-1][j+bias] = chart[i][j]
-            assert bias==1, 'Wrong select_masks!'
-        # from IPython import embed; embed()
-        parsed_results.append(chart[0])
-    return parsed_results
+    max_len = len(select_masks) + 2 if select_masks else int(length.max())
+    device = select_masks[0].device if select_masks else length.device
+    length = length.to(device)
+    positions = torch.arange(max_len, device=device)
+    start = positions.unsqueeze(0).expand(batch_size, max_len) # first word of each node
+    end = start # last word of each node
+    spans, span_mask = [], []
+    for i in range(max_len - 1):
+        if i < len(select_masks):
+            select = select_masks[i].long()
+        else:
+            select = torch.ones(batch_size, 1, dtype=torch.long, device=device)
+        cumsum = select.cumsum(1)
+        left = 1 - cumsum # nodes before the selected pair are kept
+        right = cumsum - select # nodes after it shift left
+        spans.append(torch.stack([(select * start[:, :-1]).sum(1), (select * end[:, 1:]).sum(1)], dim=1))
+        active = i + 1 < length # sentences that are not done yet
+        span_mask.append(active)
+        new_start = (left + select) * start[:, :-1] + right * start[:, 1:]
+        new_end = left * end[:, :-1] + (select + right) * end[:, 1:]
+        active = active.unsqueeze(1)
+        start = torch.where(active, new_start, start[:, :-1])
+        end = torch.where(active, new_end, end[:, :-1])
+    if spans:
+        spans = torch.stack(spans, dim=1)
+        span_mask = torch.stack(span_mask, dim=1)
+    else: # all sentences have a single word
+        spans = torch.zeros(batch_size, 0, 2, dtype=torch.long, device=device)
+        span_mask = torch.zeros(batch_size, 0, dtype=torch.bool, device=device)
+    covered = ((spans[:, :, :1] <= positions) & (positions <= spans[:, :, 1:])) & span_mask.unsqueeze(2)
+    depths = covered.long().sum(1)
+    return spans, span_mask, depths
 
 
+def decode_parents(length, select_masks):
+    """
+    The binary tree of each sentence as a parent array. Nodes 0..l-1 are the words and
+    node l+i is the one composed at step i, so that the root is node 2l-2.
+    Args:
+        length, select_masks: see decode_select_masks
+    Return:
+        parents: (batch_size, 2*max_len-1). parent node of each node, -1 for the root and padding
+    """
+    batch_size = length.size(0)
+    max_len = len(select_masks) + 2 if select_masks else int(length.max())
+    device = select_masks[0].device if select_masks else length.device
+    length = length.to(device)
+    ids = torch.arange(max_len, device=device).unsqueeze(0).expand(batch_size, max_len) # node id at each position
+    parents = torch.full((batch_size, 2 * max_len - 1), -1, dtype=torch.long, device=device)
+    rows = torch.arange(batch_size, device=device)
+    for i in range(max_len - 1):
+        if i < len(select_masks):
+            select = select_masks[i].long()
+        else:
+            select = torch.ones(batch_size, 1, dtype=torch.long, device=device)
+        cumsum = select.cumsum(1)
+        left = 1 - cumsum
+        right = cumsum - select
+        new_id = length + i
+        active = i + 1 < length
+        # padding positions share ids with composed nodes, so only write the active sentences
+        for children in [ids[:, :-1], ids[:, 1:]]:
+            child = (select * children).sum(1)
+            parents[rows[active], child[active]] = new_id[active]
+        new_ids = left * ids[:, :-1] + select * new_id.unsqueeze(1) + right * ids[:, 1:]
+        ids = torch.where(active.unsqueeze(1), new_ids, ids[:, :-1])
+    return parents
+
+
+def _parse_word_depth(length, select_masks):
+    """
+    Return:
+        Parsed results for each sentence.
+        Specifically, parsed_results[i][j] is the depth of j-th word of i-th sentence.
+    """
+    _, _, depths = decode_select_masks(length, select_masks)
+    depths = depths.cpu().numpy()
+    return [depths[idx, :l] for idx, l in enumerate(length.tolist())]
+
 
 def parse_tree_avg_depth(length, select_masks):
-    depth_cumsum = word_cumsum = 0
-    parsed_results = _parse_word_depth(length, select_masks)
-    for sent in parsed_results:
-        depth_cumsum += sent.sum()
-        word_cumsum += sent.shape[0]
-    return depth_cumsum, word_cumsum
+    """
+    Return:
+        the sum of the word depths and the number of words in the batch
+    """
+    _, _, depths = decode_select_masks(length, select_masks)
+    return depths.sum().item(), length.sum().item()
 
 
 def parse_tree(vocab, words, length, select_masks):
     """
     Args:
-        vocab: Vocab instance, whose id_to_word method will be used to convert words 
+        vocab: vocab whose id_to_word (a list, dict or method) converts words
         words: Tensor, id for words in sentences, (batch_size, max_len)
     Return:
         Parse tree represented by brackets, a list of string whose len=batch_size
     """
-    batch_size = length.size(0)
-    length = unwrap_variable(length)
-    parsed_results = _parse_word_depth(length, select_masks)
+    spans, span_mask, _ = decode_select_masks(length, select_masks)
+    max_len = words.size(1)
+    # count the brackets opened before and closed after each word
+    span_mask = span_mask.long()
+    opens = torch.zeros(words.size(0), max_len + 1, dtype=torch.long, device=spans.device)
+    closes = torch.zeros_like(opens)
+    opens.scatter_add_(1, spans[:, :, 0], span_mask)
+    closes.scatter_add_(1, spans[:, :, 1], span_mask)
+    id_to_word = vocab.id_to_word
+    lookup = id_to_word if callable(id_to_word) else id_to_word.__getitem__
     trees = []
-    for idx in range(batch_size):
-    # idx-th batch/sentence
-        l = length[idx]
-        words_ = [vocab.id_to_word(words[idx][j]) for j in range(l)]
-        depths = [parsed_results[idx][j] for j in range(l)]
-        stack = []
-        ptr = 0
-        for j in range(2*l-1):
-            if len(stack) < 2 or stack[-1][1] != stack[-2][1]:
-                stack.append((words_[ptr], depths[ptr]))
-                ptr += 1
-            else:
-                parent = (f'({stack[-2][0]} {stack[-1][0]})', stack[-1][1]-1)
-                stack.pop(); stack.pop()
-                stack.append(parent)
-        assert len(stack)==1 and stack[0][1]==0, 'Wrong final stack states!'
-        trees.append(stack[0][0])
+    for ids, l, o, c in zip(words.tolist(), length.tolist(), opens.tolist(), closes.tolist()):
+        tokens = ['(' * o[j] + lookup(ids[j]) + ')' * c[j] for j in range(l)]
+        trees.append(' '.join(tokens))
     return trees
-        
@@ -0,0 +1,133 @@
+import torch
+
+from utils.eval_cache import LENGTH_KEYS
+
+
+FLOAT_BYTES = 4
+# floats kept for backward, in units of hidden_dim: per step of the leaf rnn (gates, cell
+# and hidden state of both directions) and per composition of TriPadLSTMLayer (gates,
+# states of the children, cell and hidden state)
+LEAF_FLOATS = 8
+COMPOSE_FLOATS = 12
+
+
+def sentence_mb(length, max_length, args):
+    """
+    Estimated activation memory of the sentences of a batch, which is padded to max_length.
+    Args:
+        length: list of the lengths of the sentences
+    Returns:
+        megabytes
+    """
+    batch_size = len(length)
+    # word embeddings and leaf rnn states, computed for the padded batch
+    floats = batch_size * max_length * (args.word_dim + LEAF_FLOATS * args.hidden_dim)
+    if args.model_type == 'Choi':
+        # every level composes all the adjacent pairs of the padded batch
+        floats += batch_size * max_length * (max_length - 1) // 2 * COMPOSE_FLOATS * args.hidden_dim
+    else:
+        # one composition per word of each tree; RL also builds sample_num sampled trees
+        trees = 1 + args.sample_num if args.model_type == 'RL' else 1
+        floats += trees * sum(max(0, l - 1) for l in length) * COMPOSE_FLOATS * args.hidden_dim
+    return floats * FLOAT_BYTES / 2**20
+
+
+def batch_mb(lengths, args):
+    """
+    Args:
+        lengths: list of the length lists of the batch, one per sentence field
+            (the words of SST and Age, the premises and hypotheses of SNLI)
+    """
+    # PairModel encodes the premises and hypotheses as one batch, padded to the longest of both
+    max_length = max(max(length) for length in lengths)
+    return sentence_mb([l for length in lengths for l in length], max_length, args)
+
+
+def split_batch(batch, budget_mb, args):
+    """
+    Split a batch into micro-batches whose estimated activation memory is within the
+    budget. The examples are grouped in decreasing length, so that each micro-batch is
+    padded to its own longest sentence. An example over the budget is a micro-batch alone,
+    except with --use-batchnorm: BatchNorm1d needs at least 2 examples in training, so a
+    micro-batch of one takes an adjacent example of its neighbour (or is merged into it),
+    and goes over the budget.
+    Returns:
+        list of (model_arg, label), the batch itself if it fits
+    """
+    model_arg, label = batch
+    keys = [k for k in LENGTH_KEYS if k in model_arg]
+    lengths = [model_arg[LENGTH_KEYS[k]].tolist() for k in keys]
+    if batch_mb(lengths, args) <= budget_mb:
+        return [batch]
+    order = sorted(range(len(label)), key=lambda i: tuple(-length[i] for length in lengths))
+    groups, group = [], []
+    for i in order:
+        if group and batch_mb([[length[j] for j in group + [i]] for length in lengths], args) > budget_mb:
+            groups.append(group)
+            group = []
+        group.append(i)
+    groups.append(group)
+    if args.use_batchnorm:
+        groups = merge_singletons(groups)
+
+    micro_batches = []
+    for group in groups:
+        index = torch.LongTensor(group).to(label.device)
+        micro_arg = {}
+        for k, length in zip(keys, lengths):
+            width = max(length[i] for i in group)
+            micro_arg[k] = model_arg[k][index, :width]
+            micro_arg[LENGTH_KEYS[k]] = model_arg[LENGTH_KEYS[k]][index]
+        micro_batches.append((micro_arg, label[index]))
+    return micro_batches
+
+
+def merge_singletons(groups):
+    """
+    Give every group of a list of at least 2 examples at least 2 of them. The groups are
+    in decreasing length, a singleton takes the closest example in length of its
+    neighbour, the first (longest) one of the next group or the last one of the previous
+    group, or is merged into a neighbour of 2 examples.
+    """
+    if len(groups) < 2:
+        return groups
+    groups = [list(group) for group in groups]
+    g = 0
+    while g < len(groups):
+        if len(groups[g]) == 1:
+            if g == 0:
+                if len(groups[1]) > 2:
+                    groups[0].append(groups[1].pop(0))
+                else:
+                    groups[:2] = [groups[0] + groups[1]]
+            elif len(groups[g-1]) > 2:
+                groups[g].insert(0, groups[g-1].pop())
+            else:
+                groups[g-1:g+1] = [groups[g-1] + groups[g]]
+                continue
+        g += 1
+    return groups
+
+
+class SplitStats(object):
+    """
+    Count the training batches and those split by --memory-budget.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.num_batches = 0
+        self.num_split = 0
+        self.num_micro_batches = 0
+
+    def update(self, num_micro_batches):
+        self.num_batches += 1
+        self.num_micro_batches += num_micro_batches
+        if num_micro_batches > 1:
+            self.num_split += 1
+
+    def split_rate(self):
+        if self.num_batches == 0:
+            return 0.
+        return self.num_split / self.num_batches
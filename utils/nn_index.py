@@ -0,0 +1,223 @@
+"""
+Nearest-neighbour search over a (memory-mapped) matrix of sentence embeddings, e.g. the
+embeddings.npy written by encode_corpus.py.
+
+    embeddings = load_embeddings('encoded/')
+    index = ExactIndex(embeddings)
+    scores, ids = index.search(queries, k=10)  # (num_queries, k) each
+
+ExactIndex scans the matrix block by block with one matmul per block, so that it never
+holds more than block_size rows in memory. IVFIndex clusters the rows with k-means and
+only scans the nprobe lists closest to a query: more lists probed means higher recall
+and higher latency.
+"""
+import os
+
+import numpy as np
+import torch
+
+
+def load_embeddings(path):
+    """
+    Args:
+        path: a .npy file, or an output directory of encode_corpus.py
+    Returns:
+        read-only memory-mapped numpy array (num_vectors, dim)
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, 'embeddings.npy')
+    return np.load(path, mmap_mode='r')
+
+
+def to_tensor(rows):
+    return torch.from_numpy(np.ascontiguousarray(rows, dtype=np.float32))
+
+
+def merge_topk(scores, ids, new_scores, new_ids, k):
+    """
+    Merge the running top-k with the scores of a new block.
+    """
+    if scores is not None:
+        new_scores = torch.cat([scores, new_scores], dim=1)
+        new_ids = torch.cat([ids, new_ids], dim=1)
+    k = min(k, new_scores.size(1))
+    scores, pos = new_scores.topk(k, dim=1)
+    return scores, new_ids.gather(1, pos)
+
+
+class ExactIndex(object):
+    """
+    Exact top-k by inner product, or by cosine similarity with metric='cosine'.
+    """
+    def __init__(self, embeddings, metric='cosine', block_size=65536):
+        if metric not in {'cosine', 'dot'}:
+            raise ValueError(f'unknown metric {metric}')
+        self.embeddings = embeddings
+        self.metric = metric
+        self.block_size = block_size
+        self.inv_norms = None
+        if metric == 'cosine':
+            # computed once, rows of zeros (empty sentences) get a score of 0
+            self.inv_norms = torch.cat([to_tensor(block).norm(dim=1).clamp(min=1e-12).reciprocal()
+                                        for _, block in self.blocks()])
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def blocks(self):
+        for start in range(0, len(self.embeddings), self.block_size):
+            yield start, self.embeddings[start:start+self.block_size]
+
+    def prepare_queries(self, queries):
+        queries = queries.float() if torch.is_tensor(queries) else to_tensor(queries)
+        if self.metric == 'cosine':
+            queries = queries / queries.norm(dim=1, keepdim=True).clamp(min=1e-12)
+        return queries
+
+    def search(self, queries, k=10):
+        """
+        Args:
+            queries: (num_queries, dim) tensor or array
+        Returns:
+            scores: (num_queries, k) in descending order
+            ids: (num_queries, k) row ids of the embeddings
+        """
+        queries = self.prepare_queries(queries)
+        scores = ids = None
+        with torch.no_grad():
+            for start, block in self.blocks():
+                block_scores = queries @ to_tensor(block).t()
+                if self.inv_norms is not None:
+                    block_scores *= self.inv_norms[start:start+len(block)]
+                block_ids = torch.arange(start, start + len(block)).expand_as(block_scores)
+                scores, ids = merge_topk(scores, ids, block_scores, block_ids, k)
+        return scores, ids
+
+
+class IVFIndex(ExactIndex):
+    """
+    Inverted file index: the rows are partitioned into num_lists k-means clusters and a
+    query only scans the rows of its nprobe closest clusters.
+    """
+    def __init__(self, embeddings, metric='cosine', block_size=65536, num_lists=1024, nprobe=8):
+        super().__init__(embeddings, metric, block_size)
+        self.num_lists = num_lists
+        self.nprobe = nprobe
+        self.centroids = None
+        self.list_ids = None # row ids sorted by list
+        self.offsets = None # list i is list_ids[offsets[i]:offsets[i+1]]
+
+    def normalized_block(self, start, block):
+        block = to_tensor(block)
+        if self.inv_norms is not None:
+            block = block * self.inv_norms[start:start+len(block)].unsqueeze(1)
+        return block
+
+    def normalized_rows(self, ids):
+        vectors = to_tensor(self.embeddings[ids.numpy()])
+        if self.inv_norms is not None:
+            vectors = vectors * self.inv_norms[ids].unsqueeze(1)
+        return vectors
+
+    def assign(self, vectors):
+        return (vectors @ self.centroids.t()).max(1)[1]
+
+    def train(self, sample_size=100000, iters=20, seed=0):
+        """
+        Spherical (cosine) or inner product k-means on a random sample of the rows, then
+        assign every row to its closest centroid.
+        """
+        generator = torch.Generator().manual_seed(seed)
+        sample_size = min(sample_size, len(self))
+        sample = torch.randperm(len(self), generator=generator)[:sample_size].sort()[0]
+        vectors = self.normalized_rows(sample)
+        num_lists = min(self.num_lists, sample_size)
+        centroids = vectors[torch.randperm(sample_size, generator=generator)[:num_lists]].clone()
+        with torch.no_grad():
+            for _ in range(iters):
+                self.centroids = centroids
+                assignment = self.assign(vectors)
+                sums = torch.zeros_like(centroids).index_add_(0, assignment, vectors)
+                counts = torch.bincount(assignment, minlength=num_lists)
+                empty = counts == 0
+                # empty clusters restart from random sample vectors
+                if empty.any():
+                    sums[empty] = vectors[torch.randint(sample_size, (int(empty.sum()),), generator=generator)]
+                    counts[empty] = 1
+                centroids = sums / counts.unsqueeze(1).float()
+                if self.metric == 'cosine':
+                    centroids = centroids / centroids.norm(dim=1, keepdim=True).clamp(min=1e-12)
+            self.centroids = centroids
+            self.num_lists = num_lists
+            assignment = torch.cat([self.assign(self.normalized_block(start, block)) for start, block in self.blocks()])
+        self.list_ids = assignment.argsort(stable=True)
+        self.offsets = torch.zeros(num_lists + 1, dtype=torch.long)
+        self.offsets[1:] = torch.bincount(assignment, minlength=num_lists).cumsum(0)
+        return self
+
+    def search(self, queries, k=10, nprobe=None):
+        """
+        Args:
+            nprobe: number of lists scanned per query, default self.nprobe
+        Returns:
+            scores, ids: (num_queries, k), ids are -1 (and scores -inf) if the probed
+                lists have less than k rows
+        """
+        if self.centroids is None:
+            raise ValueError('the index is not trained, call train() or IVFIndex.load()')
+        nprobe = min(nprobe or self.nprobe, self.num_lists)
+        queries = self.prepare_queries(queries)
+        scores = torch.full((len(queries), k), -float('inf'))
+        ids = torch.full((len(queries), k), -1, dtype=torch.long)
+        with torch.no_grad():
+            probes = (queries @ self.centroids.t()).topk(nprobe, dim=1)[1]
+            # group the (query, list) pairs by list: each probed list is read once and
+            # scored against all the queries probing it with one matrix multiplication
+            probed = probes.flatten()
+            order = probed.argsort(stable=True)
+            query_ids = order // nprobe
+            lists, counts = probed[order].unique_consecutive(return_counts=True)
+            start = 0
+            for l, count in zip(lists.tolist(), counts.tolist()):
+                # a query probes distinct lists, so qs has no duplicates
+                qs = query_ids[start:start+count]
+                start += count
+                # sorted row ids, the memory map is read sequentially
+                candidates = self.list_ids[self.offsets[l]:self.offsets[l+1]]
+                if len(candidates) == 0:
+                    continue
+                vectors = to_tensor(self.embeddings[candidates.numpy()])
+                candidate_scores = queries[qs] @ vectors.t()
+                if self.inv_norms is not None:
+                    candidate_scores *= self.inv_norms[candidates]
+                scores[qs], ids[qs] = merge_topk(scores[qs], ids[qs], candidate_scores,
+                                                 candidates.expand_as(candidate_scores), k)
+        return scores, ids
+
+    def save(self, path):
+        torch.save({
+            'metric': self.metric,
+            'num_vectors': len(self),
+            'centroids': self.centroids,
+            'list_ids': self.list_ids,
+            'offsets': self.offsets,
+            }, path)
+
+    @classmethod
+    def load(cls, path, embeddings, block_size=65536, nprobe=8):
+        loaded = torch.load(path, map_location='cpu')
+        if loaded['num_vectors'] != len(embeddings):
+            raise ValueError(f'{path} indexes {loaded["num_vectors"]} vectors, the embeddings have {len(embeddings)}')
+        index = cls(embeddings, loaded['metric'], block_size, len(loaded['centroids']), nprobe)
+        index.centroids = loaded['centroids']
+        index.list_ids = loaded['list_ids']
+        index.offsets = loaded['offsets']
+        return index
+
+
+def recall_at_k(exact_ids, ids):
+    """
+    Fraction of the exact top-k found by an approximate search.
+    """
+    found = (ids.unsqueeze(2) == exact_ids.unsqueeze(1)).any(1)
+    return found.float().mean().item()
@@ -0,0 +1,75 @@
+import torch
+
+
+class OptimizerGroup(object):
+    """
+    Several optimizers over disjoint parameters used as one, e.g. SparseAdam for a
+    sparse word embedding and Adam for the other parameters.
+    """
+    def __init__(self, optimizers):
+        self.optimizers = optimizers
+
+    @property
+    def param_groups(self):
+        return [g for o in self.optimizers for g in o.param_groups]
+
+    def zero_grad(self):
+        for o in self.optimizers:
+            o.zero_grad()
+
+    def step(self):
+        for o in self.optimizers:
+            o.step()
+
+    def state_dict(self):
+        return [o.state_dict() for o in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for o, s in zip(self.optimizers, state_dicts):
+            o.load_state_dict(s)
+
+
+class SchedulerGroup(object):
+    """
+    One lr scheduler per optimizer of an OptimizerGroup, stepped together.
+    """
+    def __init__(self, schedulers):
+        self.schedulers = schedulers
+
+    def step(self, *args, **kwargs):
+        for s in self.schedulers:
+            s.step(*args, **kwargs)
+
+    def state_dict(self):
+        return [s.state_dict() for s in self.schedulers]
+
+    def load_state_dict(self, state_dicts):
+        for s, d in zip(self.schedulers, state_dicts):
+            s.load_state_dict(d)
+
+
+def clip_grad_norm(parameters, max_norm):
+    """
+    Like torch.nn.utils.clip_grad_norm_ (2-norm over all gradients), but also accepts the
+    sparse gradients of nn.Embedding(sparse=True). Sparse gradients are coalesced first,
+    since the same row may appear several times in an uncoalesced gradient. Without
+    sparse gradients it is torch's, which clips without syncing with the device.
+    Returns:
+        the total norm of the gradients before clipping (a tensor without sparse gradients)
+    """
+    parameters = [p for p in parameters if p.grad is not None]
+    if not any(p.grad.is_sparse for p in parameters):
+        return torch.nn.utils.clip_grad_norm_(parameters, max_norm)
+    grads = []
+    for p in parameters:
+        if p.grad.is_sparse:
+            p.grad = p.grad.coalesce()
+            grads.append(p.grad._values())
+        else:
+            grads.append(p.grad)
+    total_norm = torch.stack([g.pow(2).sum() for g in grads]).sum().sqrt().item()
+    clip_coef = max_norm / (total_norm + 1e-6)
+    if clip_coef < 1:
+        for g in grads:
+            g.mul_(clip_coef)
+    return total_norm
@@ -0,0 +1,88 @@
+import functools
+import os
+
+import torch
+
+
+_active = False
+
+
+def is_active():
+    return _active
+
+
+def step_range(s):
+    """
+    argparse type of --profile-steps, 'START:END' means the steps START, ..., END-1
+    """
+    try:
+        start, end = map(int, s.split(':'))
+    except ValueError:
+        raise ValueError(f'expect START:END, got {s}')
+    if not 0 <= start < end:
+        raise ValueError(f'expect 0 <= START < END, got {s}')
+    return start, end
+
+
+def ranged(name):
+    """
+    Decorator that marks each call as a `name` range in the trace while profiling.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _active:
+                return fn(*args, **kwargs)
+            with torch.autograd.profiler.record_function(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class StepProfiler(object):
+    """
+    Run torch.profiler over the steps START, ..., END-1, then export a chrome trace and
+    a table of the top operators into save_dir.
+    """
+    def __init__(self, steps, save_dir, name, use_cuda=False, row_limit=40):
+        self.start, self.end = steps
+        self.save_dir = save_dir
+        self.name = name
+        self.use_cuda = use_cuda
+        self.row_limit = row_limit
+        self.prof = None
+
+    def before_step(self, step):
+        if step == self.start and self.prof is None:
+            global _active
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.prof = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.prof.__enter__()
+            _active = True
+        if self.prof is not None:
+            self.step_range = torch.autograd.profiler.record_function(f'{self.name}_step_{step}')
+            self.step_range.__enter__()
+
+    def after_step(self, step):
+        if self.prof is None:
+            return
+        self.step_range.__exit__(None, None, None)
+        if step + 1 >= self.end:
+            self.stop()
+
+    def stop(self):
+        global _active
+        if self.prof is None:
+            return
+        _active = False
+        self.prof.__exit__(None, None, None)
+        prefix = os.path.join(self.save_dir, f'profile-{self.name}-{self.start}-{self.end}')
+        self.prof.export_chrome_trace(prefix + '.json')
+        sort_by = 'self_cuda_time_total' if self.use_cuda else 'self_cpu_time_total'
+        table = self.prof.key_averages().table(sort_by=sort_by, row_limit=self.row_limit)
+        with open(prefix + '.txt', 'w') as f:
+            f.write(table + '\n')
+        print(f'Saved the profile of steps {self.start}:{self.end} to {prefix}.json/.txt')
+        self.prof = None
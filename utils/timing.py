@@ -0,0 +1,213 @@
+import functools
+import json
+import math
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+from utils import profiling
+
+
+_timer = None
+
+
+def set_timer(timer):
+    global _timer
+    _timer = timer
+
+
+def get_timer():
+    return _timer
+
+
+_no_phase = nullcontext()
+
+
+def phase(name):
+    """
+    Time a named phase of the current step. It is a no-op unless a PhaseTimer is installed
+    by set_timer or the profiler is running: it then returns a shared empty context.
+    Phases can be nested, and each phase only counts its exclusive time, e.g. time spent
+    in 'composition' inside 'tree' is not counted in 'tree'.
+    While torch.profiler is running (see utils.profiling), the phase is also marked as
+    a range in the trace.
+    Phases entered from other threads than the one that created the timer (e.g. the
+    tree threads of model.basic.parallel_map) are not recorded, their time is counted
+    in the enclosing phase of the main thread.
+    """
+    if _timer is None and not profiling.is_active():
+        return _no_phase
+    return _phase(name)
+
+
+def timed(name):
+    """
+    Decorator that runs each call in phase(name), for functions called per tree node:
+    when disabled, the only cost is the check of the timer and the profiler.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _timer is None and not profiling.is_active():
+                return fn(*args, **kwargs)
+            with _phase(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def _phase(name):
+    timer = _timer
+    if timer is not None and threading.get_ident() != timer.thread:
+        timer = None
+    if profiling.is_active():
+        with torch.autograd.profiler.record_function(name):
+            if timer is None:
+                yield
+                return
+            timer.enter(name)
+            try:
+                yield
+            finally:
+                timer.exit()
+        return
+    if timer is None:
+        yield
+        return
+    timer.enter(name)
+    try:
+        yield
+    finally:
+        timer.exit()
+
+
+_open_phases = threading.local()
+
+
+def begin(name):
+    """
+    Enter a phase without indenting the timed block, the phase is closed by end().
+    Only for straight-line blocks, an exception in between leaves the phase open.
+    """
+    context = phase(name)
+    context.__enter__()
+    _open_phases.__dict__.setdefault('stack', []).append(context)
+
+
+def end():
+    _open_phases.stack.pop().__exit__(None, None, None)
+
+
+@contextmanager
+def suspend():
+    # stop recording, e.g. during validation
+    timer = _timer
+    set_timer(None)
+    try:
+        yield
+    finally:
+        set_timer(timer)
+        if timer is not None:
+            timer.step_start = timer._now()
+
+
+def timed_iter(iterable, name='data'):
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class PhaseTimer(object):
+    """
+    Accumulate the exclusive time of each phase per step, keep the last `window` steps
+    and append a summary (percentiles, log2-bucketed histograms, throughput) as one json
+    line to `path` every `log_every` steps.
+    With sync_cuda, the device is synchronized at the boundaries of the steps and of the
+    outermost phases only: the nested phases (e.g. the composition of each tree node)
+    would otherwise sync several times per node, their time is not accurate on a gpu.
+    """
+    def __init__(self, path, log_every=100, window=1000, sync_cuda=False):
+        self.path = path
+        self.log_every = log_every
+        self.sync_cuda = sync_cuda
+        self.thread = threading.get_ident()
+        self.stack = []
+        self.current = defaultdict(float)
+        self.history = defaultdict(lambda: deque(maxlen=window))
+        self.step_history = deque(maxlen=window)
+        self.num_steps = 0
+        self.step_start = time.perf_counter()
+
+    def _now(self, sync=True):
+        if self.sync_cuda and sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def enter(self, name):
+        self.stack.append([name, self._now(sync=not self.stack), 0.])
+
+    def exit(self):
+        name, start, child_time = self.stack.pop()
+        elapsed = self._now(sync=not self.stack) - start
+        self.current[name] += elapsed - child_time
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def end_step(self, num_sentences, num_tokens):
+        now = self._now()
+        step_time = now - self.step_start
+        self.step_start = now
+        for name in set(self.history) | set(self.current):
+            self.history[name].append(self.current.get(name, 0.))
+        self.current = defaultdict(float)
+        self.step_history.append((step_time, num_sentences, num_tokens))
+        self.num_steps += 1
+        if self.log_every and self.num_steps % self.log_every == 0:
+            self.dump()
+
+    @staticmethod
+    def histogram(values):
+        # bucket k counts the values in [2^k, 2^(k+1)) microseconds
+        hist = defaultdict(int)
+        for v in values:
+            hist[int(math.log2(v * 1e6)) if v > 1e-6 else 0] += 1
+        return dict(sorted(hist.items()))
+
+    @staticmethod
+    def percentile(sorted_values, q):
+        return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+    def summary(self):
+        total_time = sum(s[0] for s in self.step_history)
+        phases = {}
+        for name, values in self.history.items():
+            ordered = sorted(values)
+            phases[name] = {
+                    'mean_ms': 1e3 * sum(ordered) / len(ordered),
+                    'p50_ms': 1e3 * self.percentile(ordered, 0.5),
+                    'p90_ms': 1e3 * self.percentile(ordered, 0.9),
+                    'p99_ms': 1e3 * self.percentile(ordered, 0.99),
+                    'fraction': sum(ordered) / total_time if total_time > 0 else 0.,
+                    'hist_log2_us': self.histogram(ordered),
+                    }
+        return {
+                'step': self.num_steps,
+                'window': len(self.step_history),
+                'step_ms': 1e3 * total_time / max(1, len(self.step_history)),
+                'sentences_per_sec': sum(s[1] for s in self.step_history) / total_time if total_time > 0 else 0.,
+                'tokens_per_sec': sum(s[2] for s in self.step_history) / total_time if total_time > 0 else 0.,
+                'phases': phases,
+                }
+
+    def dump(self):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(self.summary()) + '\n')
@@ -54,3 +54,33 @@ class Vocab(object):
 
     def __len__(self):
         return len(self._vocab_dict)
+
+
+def id_to_word_list(vocab):
+    """
+    The words indexed by id, of a loader (id_to_word is a list or a dict), an IdVocab or a word list.
+    """
+    id_to_word = vocab.id_to_word if hasattr(vocab, 'id_to_word') else vocab
+    if isinstance(id_to_word, dict):
+        return [id_to_word[i] for i in range(len(id_to_word))]
+    return list(id_to_word)
+
+
+class IdVocab(object):
+    """
+    The minimal vocab the encoders need, built from the word list saved in checkpoints.
+    """
+    def __init__(self, id_to_word):
+        self.id_to_word = list(id_to_word)
+        self.word_to_id = { w:i for i,w in enumerate(self.id_to_word) }
+
+
+def remap_words(model_arg, remap):
+    """
+    Map the word ids of a batch to the ids of a pruned vocab.
+    Args:
+        model_arg: dict of model.forward kwargs, as yielded by the data loaders
+        remap: LongTensor (num_words, ), new id of each old id, see prune_vocab.py
+    """
+    remap = remap.to(next(iter(model_arg.values())).device)
+    return { k: remap[v] if k in {'words', 'pre', 'hyp'} else v for k, v in model_arg.items() }